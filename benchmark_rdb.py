@@ -0,0 +1,139 @@
+"""Concatenate vs sliced convs in the dense blocks (model.dense_conv). Checks that both give the same outputs and
+gradients with the same weights, then times one training step (forward + backward) of each in its own process
+and reports the allocator peak (GPU) or the peak RSS growth (CPU), next to the bytes of concatenation
+copies the sliced version does not make.
+
+python benchmark_rdb.py --block_type rrdb_ca --num_blocks 23 --size 32 --batch_size 16
+python benchmark_rdb.py --weights_file outputs/weights/psnr/best_weights.h5 --attention_every 6
+"""
+import sys
+import time
+import json
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Concatenate
+
+from models.model_builder import build_generator
+from models.backbone.RDB import DENSE_CONVS
+from train_utils.losses import make_pixel_loss
+from utils.memory import device_memory_info, reset_device_peak, process_rss_bytes, peak_rss_bytes
+
+
+def build(args, dense_conv):
+    model = build_generator(block_type=args.block_type, num_blocks=args.num_blocks,
+                            attention_every=args.attention_every, attention_type=args.attention_type,
+                            cross_scale_attention=args.attention_every > 0, dense_conv=dense_conv)
+    if args.weights_file:
+        model.load_weights(args.weights_file)
+    return model
+
+
+def concat_bytes(model, batch_size, size):
+    """bytes of the concatenations inside the dense blocks for one batch (the trunk runs at LR size)"""
+    total = 0
+    for layer in model.layers:
+        if isinstance(layer, Concatenate) and getattr(layer, 'block_path', '').split('/')[-1] == 'rdb':
+            total += batch_size * size * size * int(layer.output.shape[-1]) * 4
+    return total
+
+
+def check_equivalence(args, size=16):
+    """max abs difference of outputs and gradients of both versions with the same weights"""
+    concat_model = build(args, 'concat')
+    sliced_model = build(args, 'sliced')
+    # .h5 files load into either, in memory the weight lists are in the same order
+    sliced_model.set_weights(concat_model.get_weights())
+    x = tf.random.uniform((2, size, size, 3), maxval=255)
+    differences = {}
+    outputs = {}
+    gradients = {}
+    for name, model in (('concat', concat_model), ('sliced', sliced_model)):
+        with tf.GradientTape() as tape:
+            outputs[name] = model(x, training=True)
+            loss = tf.reduce_mean(tf.abs(outputs[name]))
+        gradients[name] = tape.gradient(loss, model.trainable_variables)
+    differences['output'] = float(tf.reduce_max(tf.abs(outputs['concat'] - outputs['sliced'])))
+    differences['gradient'] = max(float(tf.reduce_max(tf.abs(a - b)))
+                                  for a, b in zip(gradients['concat'], gradients['sliced']))
+    differences['concat_bytes'] = concat_bytes(concat_model, args.batch_size, args.size)
+    return differences
+
+
+def measure_step(args, dense_conv):
+    model = build(args, dense_conv)
+    loss_fn = make_pixel_loss(criterion='l1')
+    scale = 4
+    x = tf.random.uniform((args.batch_size, args.size, args.size, 3), maxval=255)
+    y = tf.random.uniform((args.batch_size, args.size * scale, args.size * scale, 3), maxval=255)
+
+    @tf.function
+    def train_step(x_batch, y_batch):
+        with tf.GradientTape() as tape:
+            loss = loss_fn(y_true=y_batch, y_pred=model(x_batch, training=True))
+        return tape.gradient(loss, model.trainable_variables)
+
+    rss_before = process_rss_bytes()
+    reset_device_peak()
+    for _ in range(args.warmup):
+        gradient = train_step(x, y)
+        gradient[0].numpy()
+    times = []
+    for _ in range(args.steps):
+        start = time.perf_counter()
+        gradient = train_step(x, y)
+        gradient[0].numpy()
+        times.append((time.perf_counter() - start) * 1000)
+    result = {'dense_conv': dense_conv, 'median_ms': float(np.median(times)),
+              'p90_ms': float(np.percentile(times, 90)), 'rss_growth_bytes': peak_rss_bytes() - rss_before}
+    info = device_memory_info()
+    if info is not None:
+        result['device_peak_bytes'] = info['peak']
+    return result
+
+
+def benchmark_rdb(args):
+    differences = check_equivalence(args)
+    print(f"max abs difference, output: {differences['output']:.3g}, gradient: {differences['gradient']:.3g}")
+    results = []
+    for dense_conv in DENSE_CONVS:
+        # one process per version, peaks of the first do not hide the second
+        child = subprocess.run([sys.executable, 'benchmark_rdb.py'] + sys.argv[1:] + ['--dense_conv', dense_conv],
+                               capture_output=True, text=True, check=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    memory_key = 'device_peak_bytes' if 'device_peak_bytes' in results[0] else 'rss_growth_bytes'
+    print(f"{'dense_conv':<12}{'ms':>10}{'p90 ms':>10}{memory_key:>20}")
+    for r in results:
+        print(f"{r['dense_conv']:<12}{r['median_ms']:>10.1f}{r['p90_ms']:>10.1f}{r[memory_key] / 2 ** 20:>17.1f} MB")
+    concat, sliced = results
+    print(f"sliced: x{concat['median_ms'] / sliced['median_ms']:.2f} speed, "
+          f"{(concat[memory_key] - sliced[memory_key]) / 2 ** 20:.1f} MB less, "
+          f"concatenations of the concat version {differences['concat_bytes'] / 2 ** 20:.1f} MB")
+    summary = {'differences': differences, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--block_type', choices=['rrdb_ca', 'rrdb', 'rdb'], default='rrdb_ca')
+    parser.add_argument('--num_blocks', type=int, default=23)
+    parser.add_argument('--attention_every', type=int, default=0, help='0 = trunk without attention')
+    parser.add_argument('--attention_type', choices=['global', 'window'], default='window')
+    parser.add_argument('--size', type=int, default=32, help='LR patch size')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--weights_file', default='', help='.h5 weights, loaded into both versions')
+    parser.add_argument('--json', default='')
+    parser.add_argument('--dense_conv', choices=DENSE_CONVS, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.dense_conv:
+        # child process of benchmark_rdb
+        print(json.dumps(measure_step(args, args.dense_conv)))
+    else:
+        benchmark_rdb(args)
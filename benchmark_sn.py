@@ -0,0 +1,89 @@
+"""Discriminator step time of discriminator_model_sn with the current SpectralNormalization (power iteration
+once per step, w / sigma swapped in functionally) against the previous wrapper (power iteration and an in place
+kernel assign on every training call, sigma not differentiable), both run eagerly as in train_gan.py.
+"""
+import time
+import argparse
+import tensorflow as tf
+import tensorflow.keras as keras
+
+from models.model_builder import discriminator_model_sn
+from train_utils.losses import make_discriminator_loss
+from train_utils.sn import SpectralNormalization, update_spectral_normalization
+
+
+class LegacySpectralNormalization(SpectralNormalization):
+    """the previous call / normalize_weights, for the comparison only"""
+
+    def call(self, inputs, training=None):
+        if training is None:
+            training = tf.keras.backend.learning_phase()
+        if training:
+            self.normalize_weights()
+        return self.layer(inputs)
+
+    def normalize_weights(self):
+        w = tf.reshape(self.w, [-1, self.w_shape[-1]])
+        u = self.u
+        with tf.name_scope("spectral_normalize"):
+            for _ in range(self.power_iterations):
+                v = tf.math.l2_normalize(tf.matmul(u, w, transpose_b=True))
+                u = tf.math.l2_normalize(tf.matmul(v, w))
+            u = tf.stop_gradient(u)
+            v = tf.stop_gradient(v)
+            sigma = tf.matmul(tf.matmul(v, w), u, transpose_b=True)
+            self.u.assign(tf.cast(u, self.u.dtype))
+            self.w.assign(tf.cast(tf.reshape(self.w / sigma, self.w_shape), self.w.dtype))
+
+
+def legacy_discriminator(discriminator):
+    # same architecture, every SpectralNormalization replaced by the previous wrapper
+    def clone_layer(layer):
+        if isinstance(layer, SpectralNormalization):
+            inner = layer.layer.__class__.from_config(layer.layer.get_config())
+            return LegacySpectralNormalization(inner, power_iterations=layer.power_iterations, name=layer.name)
+        return layer.__class__.from_config(layer.get_config())
+    return keras.models.clone_model(discriminator, clone_function=clone_layer)
+
+
+def benchmark_sn(batch_size=16, steps=50, warmup=5):
+    dis_adv_loss_fn = make_discriminator_loss(gan_type='ragan')
+    real = tf.random.uniform((batch_size, 128, 128, 3), maxval=255)
+    fake = tf.random.uniform((batch_size, 128, 128, 3), maxval=255)
+    current = discriminator_model_sn()
+    variants = (('current', current, True), ('previous', legacy_discriminator(current), False))
+
+    results = {}
+    for name, discriminator, per_step in variants:
+        optimizer = keras.optimizers.Adam(learning_rate=1e-4, epsilon=1e-8)
+
+        # the discriminator part of the train_gan.py step, eager
+        def step():
+            if per_step:
+                update_spectral_normalization(discriminator)
+            with tf.GradientTape() as tape:
+                real_output = discriminator(real, training=True)
+                fake_output = discriminator(fake, training=True)
+                disc_loss = dis_adv_loss_fn(real_output=real_output, fake_output=fake_output)
+            gradients = tape.gradient(disc_loss, discriminator.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, discriminator.trainable_variables))
+            return disc_loss
+
+        for _ in range(warmup):
+            step().numpy()
+        start = time.perf_counter()
+        for _ in range(steps):
+            loss = step()
+        loss.numpy()
+        results[name] = (time.perf_counter() - start) / steps * 1000
+        print(f'{name}: {results[name]:.2f} ms/step')
+    print(f"saving: {results['previous'] - results['current']:.2f} ms/step")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=50)
+    args = parser.parse_args()
+    benchmark_sn(batch_size=args.batch_size, steps=args.steps)
@@ -0,0 +1,134 @@
+"""CPU latency of the generator tiers in configs/generator_tiers.yaml on one 256x256 LR image.
+--write stores the medians (and the machine) in the tiers file. --budget_ms picks the largest tier within a
+latency budget on this machine, measuring (and writing) the tiers not measured here first.
+
+python benchmark_tiers.py --write
+python benchmark_tiers.py --tiers mobile medium --size 128 --threads 4
+python benchmark_tiers.py --budget_ms 500
+"""
+import os
+import re
+import sys
+import time
+import json
+import argparse
+import platform
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from models.model_builder import build_generator, load_tier, TIERS_FILE
+from utils.runtime import configure_threads
+
+
+def machine_name():
+    # cpu model from /proc/cpuinfo where available
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    return platform.processor() or platform.machine()
+
+
+def measure_latency(model, size, steps=10, warmup=2, device='/CPU:0'):
+    """median and p90 ms of one size x size LR image"""
+    with tf.device(device):
+        step = tf.function(lambda x: model(x, training=False))
+        x = tf.random.uniform((1, size, size, 3), maxval=255)
+        for _ in range(warmup):
+            step(x).numpy()
+        times = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            step(x).numpy()
+            times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), float(np.percentile(times, 90))
+
+
+def benchmark_tier(tier, size, steps, warmup):
+    with tf.device('/CPU:0'):
+        model = build_generator(**load_tier(tier))
+    median_ms, p90_ms = measure_latency(model, size, steps, warmup)
+    return {'tier': tier, 'params': model.count_params(), 'median_ms': median_ms, 'p90_ms': p90_ms}
+
+
+def write_latency(tiers_file, tier, latency_ms, machine):
+    """replace the latency lines of one tier in place, keeping the comments of the file"""
+    with open(tiers_file, 'r') as f:
+        lines = f.readlines()
+    current = None
+    for index, line in enumerate(lines):
+        match = re.match(r'^(\w+):\s*$', line)
+        if match:
+            current = match.group(1)
+        elif current == tier and line.strip().startswith('cpu_latency_ms_256:'):
+            lines[index] = f'  cpu_latency_ms_256: {latency_ms:.1f}\n'
+        elif current == tier and line.strip().startswith('cpu_latency_machine:'):
+            lines[index] = f'  cpu_latency_machine: {json.dumps(machine)}\n'
+    with open(tiers_file, 'w') as f:
+        f.writelines(lines)
+
+
+def benchmark_tiers(tiers, size, steps, warmup, threads, write):
+    if threads:
+        configure_threads(threads, 1)
+    if not tiers:
+        with open(TIERS_FILE, 'r') as f:
+            tiers = list(yaml.safe_load(f))
+    machine = f'{machine_name()}, {threads or os.cpu_count()} threads'
+    results = []
+    for tier in tiers:
+        result = benchmark_tier(tier, size, steps, warmup)
+        results.append(result)
+        print(f"{tier:<10}{result['params'] / 1e6:>8.2f} M params{result['median_ms']:>12.1f} ms "
+              f"(p90 {result['p90_ms']:.1f} ms)")
+        tf.keras.backend.clear_session()
+        # latency in the tiers file is defined at 256x256
+        if write and size == 256:
+            write_latency(TIERS_FILE, tier, result['median_ms'], machine)
+    return results
+
+
+def tier_latencies(tiers_file=TIERS_FILE, steps=10, warmup=2):
+    """{tier: cpu_latency_ms_256} on this machine; tiers without a latency, or measured on another machine,
+    are benchmarked and written to the tiers file first"""
+    with open(tiers_file, 'r') as f:
+        tiers = yaml.safe_load(f)
+    machine = f'{machine_name()}, {os.cpu_count()} threads'
+    latencies = {}
+    for tier, settings in tiers.items():
+        if settings.get('cpu_latency_ms_256') is None or settings.get('cpu_latency_machine') != machine:
+            result = benchmark_tier(tier, 256, steps, warmup)
+            tf.keras.backend.clear_session()
+            write_latency(tiers_file, tier, result['median_ms'], machine)
+            latencies[tier] = result['median_ms']
+        else:
+            latencies[tier] = settings['cpu_latency_ms_256']
+    return latencies
+
+
+def select_tier(budget_ms, tiers_file=TIERS_FILE):
+    """the slowest (largest) tier within budget_ms at 256x256 on this machine, the fastest one if none is"""
+    latencies = tier_latencies(tiers_file)
+    within = [tier for tier, ms in latencies.items() if ms <= budget_ms]
+    if not within:
+        return min(latencies, key=latencies.get)
+    return max(within, key=latencies.get)
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiers', nargs='*', default=[])
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 = all cores')
+    parser.add_argument('--write', action='store_true', help='store the 256x256 medians in the tiers file')
+    parser.add_argument('--budget_ms', type=float, default=0, help='print the tier for this 256x256 cpu budget')
+    args = parser.parse_args()
+    if args.budget_ms:
+        print(select_tier(args.budget_ms))
+    else:
+        benchmark_tiers(args.tiers, args.size, args.steps, args.warmup, args.threads, args.write)
@@ -0,0 +1,161 @@
+"""Low-rank factorization of the trained 3x3 convs of a generator for faster CPU inference. Every 3x3 conv kernel,
+as a (3 c_in, 3 c_out) matrix, is split by svd into a rank-r 3x1 + 1x3 pair (models/low_rank.LowRankConv2D).
+The rank of a conv is the smallest that keeps --thresholds of its energy (sum of squared singular values), or for
+--budgets the one threshold over all convs that fits them into that fraction of their MACs at --latency_size;
+convs a pair would not make cheaper stay 3x3. Every setting is optionally fine-tuned with train_psnr.py and exported
+as conv_ranks.yaml + weights.h5; report.json / curve.png give MACs, cpu latency and eval psnr per setting.
+
+python compress_conv.py --thresholds 0.9 0.95 0.99 --budgets 0.5
+python compress_conv.py -o model.tier=large --budgets 0.4 0.6 --finetune_iterations 5000
+python eval.py -o model.conv_ranks_file=outputs/low_rank/threshold_0.950/conv_ranks.yaml \
+    checkpoint.best_weights_file=outputs/low_rank/threshold_0.950/weights.h5
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import build_generator, generator_settings
+from models.low_rank import factorizable_convs, low_rank_model, svd_factors
+from profile_flops import profile_flops
+from prune import finetune_config, measure, plot_curve
+
+
+def conv_spectra(model, convs, latency_size):
+    """singular values, channels and output pixels at latency_size of every factorizable conv"""
+    pixels = {r['layer']: int(np.prod(r['output_shape'][:-1]))
+              for r in profile_flops(model, (1, latency_size, latency_size, 3))}
+    spectra = []
+    for conv in convs:
+        kernel = conv.kernel.numpy()
+        kh, kw, c_in, c_out = kernel.shape
+        s = np.linalg.svd(kernel.transpose(0, 2, 1, 3).reshape(kh * c_in, kw * c_out), compute_uv=False)
+        spectra.append({'energy': np.cumsum(s ** 2) / (s ** 2).sum(), 'c_in': c_in, 'c_out': c_out,
+                        'pixels': pixels[conv.name], 'macs': pixels[conv.name] * 9 * c_in * c_out})
+    return spectra
+
+
+def ranks_for_threshold(spectra, threshold, round_to=4):
+    """{conv index: rank} of the convs whose pair keeping `threshold` of the energy costs less than the 3x3 conv,
+    ranks rounded up to multiples of round_to"""
+    ranks = {}
+    for index, s in enumerate(spectra):
+        rank = int(np.searchsorted(s['energy'], threshold - 1e-9)) + 1
+        rank = min(len(s['energy']), round_to * -(-rank // round_to))
+        if 3 * rank * (s['c_in'] + s['c_out']) < 9 * s['c_in'] * s['c_out']:
+            ranks[index] = rank
+    return ranks
+
+
+def conv_macs(spectra, ranks):
+    return sum(3 * ranks[i] * (s['c_in'] + s['c_out']) * s['pixels'] if i in ranks else s['macs']
+               for i, s in enumerate(spectra))
+
+
+def ranks_for_budget(spectra, budget, round_to=4, steps=40):
+    """ranks of the highest threshold whose convs fit into budget x their 3x3 MACs (bisection, MACs grow with the
+    threshold); the lowest ranks if none does"""
+    target = budget * sum(s['macs'] for s in spectra)
+    low, high = 0.0, 1.0
+    for _ in range(steps):
+        middle = (low + high) / 2
+        if conv_macs(spectra, ranks_for_threshold(spectra, middle, round_to)) <= target:
+            low = middle
+        else:
+            high = middle
+    return ranks_for_threshold(spectra, low, round_to)
+
+
+def factorize(model, ranks):
+    """low_rank_model of model with the svd factors of its trained kernels, and the energy every pair keeps"""
+    convs = factorizable_convs(model)
+    low_rank = low_rank_model(model, ranks)
+    energies = {}
+    for index, rank in ranks.items():
+        kernel, bias = convs[index].get_weights()
+        vertical, horizontal, energies[index] = svd_factors(kernel, rank)
+        low_rank.get_layer(convs[index].name + '_low_rank').set_weights([vertical, horizontal, bias])
+    return low_rank, energies
+
+
+def compress(cfg, weights_file, thresholds, budgets, round_to=4, finetune_iterations=0, finetune_lr=2e-5,
+             output_dir='outputs/low_rank', latency_size=64, latency_steps=10):
+    settings = generator_settings(cfg)
+    if settings.get('conv_ranks'):
+        raise ValueError('model.conv_ranks_file is set, factorize the full 3x3 model')
+    os.makedirs(output_dir, exist_ok=True)
+    model = build_generator(**settings)
+    model.load_weights(weights_file)
+    spectra = conv_spectra(model, factorizable_convs(model), latency_size)
+    full_macs = sum(s['macs'] for s in spectra)
+
+    results = [{'mode': 'full', 'value': 1.0, 'factorized_convs': 0, 'conv_macs_ratio': 1.0,
+                'factorized': measure(model, cfg, latency_size, latency_steps)}]
+    for mode, value in [('threshold', t) for t in thresholds] + [('budget', b) for b in budgets]:
+        if mode == 'threshold':
+            ranks = ranks_for_threshold(spectra, value, round_to)
+        else:
+            ranks = ranks_for_budget(spectra, value, round_to)
+        low_rank, energies = factorize(model, ranks)
+        run_dir = os.path.join(output_dir, f'{mode}_{value:.3f}')
+        os.makedirs(run_dir, exist_ok=True)
+        ranks_file = os.path.join(run_dir, 'conv_ranks.yaml')
+        with open(ranks_file, 'w') as f:
+            yaml.safe_dump(ranks, f)
+        factorized_weights_file = os.path.join(run_dir, 'factorized_weights.h5')
+        low_rank.save_weights(factorized_weights_file)
+        result = {'mode': mode, 'value': value, 'factorized_convs': len(ranks),
+                  'conv_macs_ratio': conv_macs(spectra, ranks) / full_macs,
+                  'min_energy': min(energies.values()) if energies else 1.0,
+                  'factorized': measure(low_rank, cfg, latency_size, latency_steps)}
+
+        if finetune_iterations:
+            config_file = finetune_config(cfg, settings, factorized_weights_file, run_dir, finetune_iterations,
+                                          finetune_lr, extra_overrides={'model.conv_ranks_file': ranks_file})
+            subprocess.run([sys.executable, 'train_psnr.py', '--config', config_file], check=True)
+            low_rank.load_weights(os.path.join(run_dir, 'finetune', 'best_weights.h5'))
+            result['finetuned'] = measure(low_rank, cfg, latency_size, latency_steps)
+
+        # export: -o model.conv_ranks_file=conv_ranks.yaml checkpoint.best_weights_file=weights.h5
+        low_rank.save_weights(os.path.join(run_dir, 'weights.h5'))
+        results.append(result)
+        tf.keras.backend.clear_session()
+
+    print(f"{'setting':<18}{'convs':>7}{'conv MACs':>11}{'GMACs':>9}{'ms':>9}{'psnr':>9}{'tuned psnr':>12}")
+    for r in results:
+        tuned = f"{r['finetuned']['psnr']:.3f}" if 'finetuned' in r else '-'
+        print(f"{r['mode'] + ' ' + format(r['value'], '.3f'):<18}{r['factorized_convs']:>7}"
+              f"{r['conv_macs_ratio']:>11.2f}{r['factorized']['gmacs']:>9.2f}{r['factorized']['cpu_latency_ms']:>9.1f}"
+              f"{r['factorized']['psnr']:>9.3f}{tuned:>12}")
+    report = {'weights_file': weights_file, 'round_to': round_to, 'latency_size': latency_size, 'results': results}
+    with open(os.path.join(output_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    plot_curve(results, os.path.join(output_dir, 'curve.png'),
+               series=(('factorized', 'factorized'), ('finetuned', 'factorized + fine-tuned')), label_key='value')
+    return report
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--weights_file', default='', help='weights to factorize, default checkpoint.best_weights_file')
+    parser.add_argument('--thresholds', type=float, nargs='*', default=[0.9, 0.95, 0.99],
+                        help='energy kept by every factorized conv')
+    parser.add_argument('--budgets', type=float, nargs='*', default=[],
+                        help='MACs of the factorizable convs, as a fraction of their 3x3 MACs')
+    parser.add_argument('--round_to', type=int, default=4)
+    parser.add_argument('--finetune_iterations', type=int, default=0, help='0 = no fine-tuning')
+    parser.add_argument('--finetune_lr', type=float, default=2e-5)
+    parser.add_argument('--output_dir', default='outputs/low_rank')
+    parser.add_argument('--latency_size', type=int, default=64)
+    parser.add_argument('--latency_steps', type=int, default=10)
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    compress(cfg, args.weights_file or cfg.best_weights_file, args.thresholds, args.budgets, args.round_to,
+             args.finetune_iterations, args.finetune_lr, args.output_dir, args.latency_size, args.latency_steps)
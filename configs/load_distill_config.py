@@ -0,0 +1,104 @@
+import yaml
+import sys
+from configs.overrides import apply_overrides, override_list
+
+sys.path.append('../')
+
+
+class Config:
+    __instance = None
+
+    def __init__(self, config_file="configs/config_distill.yaml", overrides=None):
+        with open(config_file, "r") as f:
+            self.config_data = yaml.safe_load(f)
+        apply_overrides(self.config_data, overrides)
+        # kept to hand the same settings to child processes
+        self.config_file = config_file
+        self.overrides = override_list(overrides)
+
+        # Data settings
+        data = self.config_data['data']
+        self.Use_TFRecord = data['Use_TFRecord']
+        self.TFRecord_file = data['TFRecord_file']
+        self.train_lr_dir = data['train_lr_dir']
+        self.train_hr_dir = data['train_hr_dir']
+        self.val_lr_dir = data['val_lr_dir']
+        self.val_hr_dir = data['val_hr_dir']
+        self.eval_lr_dir = data['eval_lr_dir']
+        self.eval_hr_dir = data['eval_hr_dir']
+        self.cache_dir = data['cache_dir']
+        self.hr_size = data['hr_size']
+        self.upscale_factor = data['upscale_factor']
+        self.batch_size = data['batch_size']
+
+        # Teacher
+        teacher = self.config_data['teacher']
+        self.teacher_weights_file = teacher['weights_file']
+        self.teacher_tier = teacher['tier']
+        self.teacher_architecture = teacher['architecture']
+        self.teacher_batch_size = teacher['batch_size']
+
+        # Student
+        student = self.config_data['student']
+        self.student_tier = student['tier']
+        self.student_architecture = student['architecture']
+
+        # Distillation
+        distill = self.config_data['distill']
+        self.cache_file = distill['cache_file']
+        self.crops_per_image = distill['crops_per_image']
+        self.cache_features = distill['cache_features']
+        self.teacher_weight = distill['teacher_weight']
+        self.gt_weight = distill['gt_weight']
+        self.perceptual_weight = distill['perceptual_weight']
+        self.feature_weight = distill['feature_weight']
+
+        # Training settings
+        training = self.config_data['training']
+        self.iterations = training['iterations']
+        self.save_every = training['save_every']
+        self.init_learning_rate = training['init_learning_rate']
+        self.lr_decay_rate = training['lr_decay_rate']
+        self.lr_decay_iter_list = training['lr_decay_iter_list']
+
+        # Validation settings
+        validation = self.config_data['validation']
+        self.val_batch_size = validation['batch_size']
+
+        # Report
+        report = self.config_data['report']
+        self.latency_size = report['latency_size']
+        self.latency_steps = report['latency_steps']
+        self.report_file = report['report_file']
+
+        # Runtime
+        runtime = self.config_data['runtime']
+        self.intra_op_threads = runtime['intra_op_threads']
+        self.inter_op_threads = runtime['inter_op_threads']
+
+        # Model checkpoints
+        checkpoint = self.config_data['checkpoint']
+        self.latest_checkpoint_dir = checkpoint['latest_checkpoint_dir']
+        self.best_weights_file = checkpoint['best_weights_file']
+        self.history_file = checkpoint['history_file']
+
+    @staticmethod
+    def getInstance():
+        """process wide default config, loaded from the default yaml on first use"""
+        if Config.__instance is None:
+            Config.__instance = Config()
+        return Config.__instance
+
+
+def load_config(config_file="configs/config_distill.yaml", overrides=None):
+    """explicit config, independent of the default instance
+    :param overrides: ['section.key=value', ...] or {'section.key': value}
+    """
+    return Config(config_file, overrides)
+
+
+def __getattr__(name):
+    # `from configs.load_distill_config import cfg` loads the default config lazily
+    if name == 'cfg':
+        return Config.getInstance()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,6 @@
 import yaml
 import sys
+from configs.overrides import apply_overrides, override_list
 
 sys.path.append('../')
 
@@ -7,51 +8,109 @@ sys.path.append('../')
 class Config:
     __instance = None
 
-    def __init__(self):
-        if Config.__instance is not None:
-            raise Exception("Config class is a singleton!")
-        else:
-            with open("configs/config_gan.yaml", "r") as f:
-                self.config_data = yaml.safe_load(f)
-
-            # Data settings
-            data = self.config_data['data']
-            self.Use_TFRecord = data['Use_TFRecord']
-            self.TFRecord_file = data['TFRecord_file']
-            self.train_lr_dir = data['train_lr_dir']
-            self.train_hr_dir = data['train_hr_dir']
-            self.test_lr_dir = data['test_lr_dir']
-            self.test_hr_dir = data['test_hr_dir']
-            self.cache_dir = data['cache_dir']
-            self.lr_size = data['lr_size']
-            self.hr_size = data['hr_size']
-            self.upscale_factor = data['upscale_factor']
-            self.channels = data['channels']
-            self.batch_size = data['batch_size']
-
-            # Training settings
-            training = self.config_data['training']
-            self.iterations = training['iterations']
-            self.save_every = training['save_every']
-            self.gen_init_learning_rate = training['gen_init_learning_rate']
-            self.dis_init_learning_rate = training['dis_init_learning_rate']
-            self.lr_decay_rate = training['lr_decay_rate']
-            self.lr_decay_iter_list = training['lr_decay_iter_list']
-
-            # Model checkpoints
-            checkpoint = self.config_data['checkpoint']
-            self.latest_checkpoint_dir = checkpoint['latest_checkpoint_dir']
-            self.gen_weights_file = checkpoint['gen_weights_file']
-            self.gen_pretrained_weight_file = checkpoint['gen_pretrained_weight_file']
-            self.history_file = checkpoint['history_file']
-
-            Config.__instance = self
+    def __init__(self, config_file="configs/config_gan.yaml", overrides=None):
+        with open(config_file, "r") as f:
+            self.config_data = yaml.safe_load(f)
+        apply_overrides(self.config_data, overrides)
+        # kept to hand the same settings to child processes
+        self.config_file = config_file
+        self.overrides = override_list(overrides)
+
+        # Data settings
+        data = self.config_data['data']
+        self.Use_TFRecord = data['Use_TFRecord']
+        self.TFRecord_file = data['TFRecord_file']
+        self.train_lr_dir = data['train_lr_dir']
+        self.train_hr_dir = data['train_hr_dir']
+        self.test_lr_dir = data['test_lr_dir']
+        self.test_hr_dir = data['test_hr_dir']
+        self.cache_dir = data['cache_dir']
+        self.lr_size = data['lr_size']
+        self.hr_size = data['hr_size']
+        self.upscale_factor = data['upscale_factor']
+        self.channels = data['channels']
+        self.batch_size = data['batch_size']
+
+        # Model settings
+        model = self.config_data['model']
+        self.tier = model['tier']
+        self.block_type = model['block_type']
+        self.num_blocks = model['num_blocks']
+        self.model_channels = model['channels']
+        self.growth_channels = model['growth_channels']
+        self.attention_every = model['attention_every']
+        self.cross_scale_attention = model['cross_scale_attention']
+        self.upsampler = model['upsampler']
+        self.attention_type = model['attention_type']
+        self.window_size = model['window_size']
+        self.cross_scale_top_k = model['cross_scale_top_k']
+        self.dense_conv = model['dense_conv']
+        self.conv_ranks_file = model['conv_ranks_file']
+
+        # Training settings
+        training = self.config_data['training']
+        self.iterations = training['iterations']
+        self.save_every = training['save_every']
+        self.gen_init_learning_rate = training['gen_init_learning_rate']
+        self.dis_init_learning_rate = training['dis_init_learning_rate']
+        self.lr_decay_rate = training['lr_decay_rate']
+        self.lr_decay_iter_list = training['lr_decay_iter_list']
+        self.fused_discriminator = training['fused_discriminator']
+
+        # Loss weights
+        loss = self.config_data['loss']
+        self.perceptual_weight = loss['perceptual_weight']
+        self.adversarial_weight = loss['adversarial_weight']
+        self.content_weight = loss['content_weight']
+        self.gradient_weight = loss['gradient_weight']
+
+        # Runtime
+        runtime = self.config_data['runtime']
+        self.intra_op_threads = runtime['intra_op_threads']
+        self.inter_op_threads = runtime['inter_op_threads']
+        self.inference_precision = runtime['inference_precision']
+        self.self_ensemble = runtime['self_ensemble']
+        self.ensemble_max_batch = runtime['ensemble_max_batch']
+        self.tile_size = runtime['tile_size']
+        self.tile_overlap = runtime['tile_overlap']
+
+        # Instrumentation
+        instrumentation = self.config_data['instrumentation']
+        self.timing = instrumentation['timing']
+        self.timing_window = instrumentation['timing_window']
+        self.timing_file = instrumentation['timing_file']
+        self.memory_tracking = instrumentation['memory_tracking']
+        self.profile_start_step = instrumentation['profile_start_step']
+        self.profile_stop_step = instrumentation['profile_stop_step']
+        self.profile_signal_steps = instrumentation['profile_signal_steps']
+        self.profile_dir = instrumentation['profile_dir']
+
+        # Model checkpoints
+        checkpoint = self.config_data['checkpoint']
+        self.latest_checkpoint_dir = checkpoint['latest_checkpoint_dir']
+        self.gen_weights_file = checkpoint['gen_weights_file']
+        self.gen_pretrained_weight_file = checkpoint['gen_pretrained_weight_file']
+        self.history_file = checkpoint['history_file']
+        self.archive_every = checkpoint['archive_every']
+        self.archive_dir = checkpoint['archive_dir']
 
     @staticmethod
     def getInstance():
+        """process wide default config, loaded from the default yaml on first use"""
         if Config.__instance is None:
-            Config()
+            Config.__instance = Config()
         return Config.__instance
 
 
-cfg = Config.getInstance()
+def load_config(config_file="configs/config_gan.yaml", overrides=None):
+    """explicit config, independent of the default instance
+    :param overrides: ['section.key=value', ...] or {'section.key': value}
+    """
+    return Config(config_file, overrides)
+
+
+def __getattr__(name):
+    # `from configs.load_gan_config import cfg` loads the default config lazily
+    if name == 'cfg':
+        return Config.getInstance()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,57 @@
+import json
+import yaml
+
+
+def parse_overrides(overrides):
+    """['training.init_learning_rate=2e-4', ...] or {'training.init_learning_rate': 2e-4} -> dict,
+    string values are parsed as yaml scalars/lists"""
+    if not overrides:
+        return {}
+    if isinstance(overrides, dict):
+        return dict(overrides)
+    parsed = {}
+    for override in overrides:
+        if '=' not in override:
+            raise ValueError(
+                'Override {} is not of the form section.key=value.'.format(override))
+        key, value = override.split('=', 1)
+        value = yaml.safe_load(value)
+        if isinstance(value, str):
+            # yaml 1.1 reads 1e-4 (no dot) as a string
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        parsed[key.strip()] = value
+    return parsed
+
+
+def override_list(overrides):
+    """overrides as ['section.key=value', ...], the form accepted by --override"""
+    return ['{}={}'.format(key, json.dumps(value) if not isinstance(value, str) else value)
+            for key, value in parse_overrides(overrides).items()]
+
+
+def apply_overrides(config_data, overrides):
+    """set dotted keys in the loaded yaml, unknown keys are rejected to catch typos"""
+    for dotted_key, value in parse_overrides(overrides).items():
+        keys = dotted_key.split('.')
+        node = config_data
+        for key in keys[:-1]:
+            if not isinstance(node, dict) or key not in node:
+                raise KeyError(
+                    'Config section {} of override {} is not recognized.'.format(key, dotted_key))
+            node = node[key]
+        if keys[-1] not in node:
+            raise KeyError(
+                'Config key {} is not recognized.'.format(dotted_key))
+        node[keys[-1]] = value
+    return config_data
+
+
+def add_config_arguments(parser, default_config_file):
+    """--config path.yaml and repeated --override section.key=value"""
+    parser.add_argument('--config', default=default_config_file)
+    parser.add_argument('--override', '-o', action='append', default=[],
+                        help='section.key=value, may be repeated')
+    return parser
@@ -1,4 +1,6 @@
+import os
 import tensorflow as tf
+from tensorflow.keras.utils import load_img, img_to_array
 from datasets.data_augmentation import flip_left_right, random_crop, random_rotate
 
 
@@ -66,6 +68,21 @@ def dataset_object(dataset_cache, hr_img_size, scale, batch_size, training=True)
     return ds
 
 
+def curriculum_stage(stages, iteration):
+    """index of the curriculum stage active at iteration"""
+    stage = 0
+    for index, stage_cfg in enumerate(stages):
+        if iteration >= stage_cfg['start_iteration']:
+            stage = index
+    return stage
+
+
+def curriculum_datasets(dataset_cache, stages, scale):
+    """one training pipeline per curriculum stage, all cropping from the same cached dataset"""
+    return [dataset_object(dataset_cache, stage_cfg['hr_size'], scale, stage_cfg['batch_size'], training=True)
+            for stage_cfg in stages]
+
+
 def sr_input_pipline_from_dir(lr_dir, hr_dir, cache_file, hr_img_size, scale, batch_size, training=True):
     return dataset_object(load_img_pair_from_dir(lr_dir, hr_dir, cache_file), hr_img_size, scale, batch_size, training)
 
@@ -73,3 +90,31 @@ def sr_input_pipline_from_dir(lr_dir, hr_dir, cache_file, hr_img_size, scale, ba
 def sr_input_pipline_from_tfrecord(record_file, cache_file, hr_img_size, scale, batch_size, training=True):
     return dataset_object(load_img_pair_from_tfrecord(record_file, cache_file), hr_img_size, scale, batch_size,
                           training)
+
+
+def load_img_pairs_to_memory(lr_dir, hr_dir):
+    """decode every lr,hr image pair of the dirs once and keep them resident"""
+    lr_img_paths = sorted(os.listdir(lr_dir))
+    hr_img_paths = sorted(os.listdir(hr_dir))
+    img_pairs = []
+    for lr_path, hr_path in zip(lr_img_paths, hr_img_paths):
+        lr_img = tf.constant(img_to_array(load_img(os.path.join(lr_dir, lr_path))))
+        hr_img = tf.constant(img_to_array(load_img(os.path.join(hr_dir, hr_path))))
+        img_pairs.append((lr_img, hr_img))
+    return img_pairs
+
+
+def batch_img_pairs_by_shape(img_pairs, batch_size):
+    """stack full size image pairs of identical shape into batches of at most batch_size"""
+    groups = {}
+    for lr_img, hr_img in img_pairs:
+        key = (tuple(lr_img.shape), tuple(hr_img.shape))
+        groups.setdefault(key, []).append((lr_img, hr_img))
+    batches = []
+    for pairs in groups.values():
+        for start in range(0, len(pairs), batch_size):
+            chunk = pairs[start:start + batch_size]
+            lr_batch = tf.stack([lr_img for lr_img, _ in chunk])
+            hr_batch = tf.stack([hr_img for _, hr_img in chunk])
+            batches.append((lr_batch, hr_batch))
+    return batches
@@ -0,0 +1,116 @@
+"""Teacher outputs for distillation, computed once on fixed training crops.
+cache_file is a TFRecord of (lr, hr, teacher sr) as uint8 png plus, optionally, the teacher trunk
+features as a float16 tensor; cache_file + '.meta.json' describes it.
+"""
+import os
+import json
+import tensorflow as tf
+from tensorflow.keras.models import Model
+from datasets.data_augmentation import random_crop
+
+
+def meta_file_of(cache_file):
+    return cache_file + '.meta.json'
+
+
+def load_cache_meta(cache_file):
+    if not os.path.exists(cache_file) or not os.path.exists(meta_file_of(cache_file)):
+        return None
+    with open(meta_file_of(cache_file), 'r') as f:
+        return json.load(f)
+
+
+def teacher_with_features(teacher):
+    # sr output and the trunk features of a build_generator model
+    return Model(teacher.input, [teacher.output, teacher.get_layer('trunk_output').output])
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def to_png(img):
+    return tf.io.encode_png(tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8)).numpy()
+
+
+def write_distill_cache(teacher, dataset_cache, cache_file, hr_size, scale, crops_per_image, batch_size,
+                        cache_features=False, seed=0):
+    """run the teacher once over crops_per_image fixed random crops of every training image"""
+    tf.random.set_seed(seed)
+    crops = dataset_cache.flat_map(
+        lambda lr_img, hr_img: tf.data.Dataset.from_tensors((lr_img, hr_img)).repeat(crops_per_image))
+    crops = crops.map(lambda lr_img, hr_img: random_crop(lr_img, hr_img, hr_crop_size=hr_size, scale=scale),
+                      num_parallel_calls=tf.data.AUTOTUNE)
+    crops = crops.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    if cache_features:
+        teacher = teacher_with_features(teacher)
+    predict = tf.function(lambda x: teacher(x, training=False))
+
+    num = 0
+    feature_shape = None
+    tmp_file = cache_file + '.tmp'
+    with tf.io.TFRecordWriter(tmp_file) as writer:
+        for lr_batch, hr_batch in crops:
+            outputs = predict(lr_batch)
+            sr_batch = outputs[0] if cache_features else outputs
+            for index in range(lr_batch.shape[0]):
+                feature = {
+                    'lr': _bytes_feature(to_png(lr_batch[index])),
+                    'hr': _bytes_feature(to_png(hr_batch[index])),
+                    'sr': _bytes_feature(to_png(sr_batch[index])),
+                }
+                if cache_features:
+                    teacher_feature = tf.cast(outputs[1][index], tf.float16)
+                    feature_shape = teacher_feature.shape.as_list()
+                    feature['feature'] = _bytes_feature(tf.io.serialize_tensor(teacher_feature).numpy())
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+                num += 1
+            print(f'Cached teacher outputs of {num} patches')
+    # only complete caches get the final name
+    os.replace(tmp_file, cache_file)
+    meta = {'num_patches': num, 'hr_size': hr_size, 'scale': scale, 'crops_per_image': crops_per_image,
+            'features': cache_features, 'feature_shape': feature_shape}
+    with open(meta_file_of(cache_file), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def augment_together(*images):
+    """the same random rotation and flip for every image of a training sample"""
+    k = tf.random.uniform(shape=(), minval=0, maxval=4, dtype=tf.int32)
+    flip = tf.random.uniform(shape=(), minval=0, maxval=1, dtype=tf.float32) < 0.5
+    images = [tf.image.rot90(img, k=k) for img in images]
+    return tuple(tf.cond(flip, lambda img=img: tf.image.flip_left_right(img), lambda img=img: img) for img in images)
+
+
+def load_distill_dataset(cache_file, meta, batch_size, with_features=False):
+    """(lr, hr, teacher_sr[, teacher_feature]) float32 training batches, shuffled and augmented"""
+    feature_description = {
+        'lr': tf.io.FixedLenFeature([], tf.string),
+        'hr': tf.io.FixedLenFeature([], tf.string),
+        'sr': tf.io.FixedLenFeature([], tf.string),
+    }
+    if with_features:
+        feature_description['feature'] = tf.io.FixedLenFeature([], tf.string)
+    lr_size = meta['hr_size'] // meta['scale']
+
+    def parse(example_proto):
+        example = tf.io.parse_single_example(example_proto, feature_description)
+        lr_img = tf.cast(tf.image.decode_png(example['lr'], channels=3), tf.float32)
+        hr_img = tf.cast(tf.image.decode_png(example['hr'], channels=3), tf.float32)
+        sr_img = tf.cast(tf.image.decode_png(example['sr'], channels=3), tf.float32)
+        lr_img = tf.ensure_shape(lr_img, (lr_size, lr_size, 3))
+        hr_img = tf.ensure_shape(hr_img, (meta['hr_size'], meta['hr_size'], 3))
+        sr_img = tf.ensure_shape(sr_img, (meta['hr_size'], meta['hr_size'], 3))
+        if not with_features:
+            return lr_img, hr_img, sr_img
+        feature = tf.io.parse_tensor(example['feature'], tf.float16)
+        feature = tf.cast(tf.ensure_shape(feature, meta['feature_shape']), tf.float32)
+        return lr_img, hr_img, sr_img, feature
+
+    ds = tf.data.TFRecordDataset(cache_file)
+    ds = ds.shuffle(buffer_size=min(meta['num_patches'], 10000)).repeat(-1)
+    ds = ds.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(augment_together, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE)
@@ -1,51 +1,192 @@
 import os
+import sys
+import time
+import json
+import argparse
+import subprocess
 from tensorflow.keras.utils import load_img, img_to_array
 import tensorflow as tf
-from train_utils.metrics import calculate_psnr, calculate_ssim
-from configs.load_psnr_config import cfg
-from models.model_builder import generator_x4
+from train_utils.metrics import MetricsEngine, METRICS_VERSION
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import generator_from_config, generator_settings
+from utils.runtime import set_inference_precision, configure_threads
+from utils.postprocess import post_process
+from utils.eval_cache import EvalCache, model_key, image_pair_key
+from utils.inference import Upscaler
 
 
-def eval():
-    physical_devices = tf.config.list_physical_devices('GPU')
-    for device in physical_devices:
-        tf.config.experimental.set_memory_growth(device, True)
-    # load model
-    model = generator_x4()
-    model.load_weights(cfg.best_weights_file)
-
-    # load eval data
-    lr_dir = cfg.eval_lr_dir
-    hr_dir = cfg.eval_hr_dir
+def evaluate_images(model, lr_dir, hr_dir, scale, cache=None, cache_key=''):
+    """per image psnr / ssim (y channel) of the model (or an Upscaler) over the image pairs of lr_dir / hr_dir:
+    hr names, {metric: array}.
+    with an EvalCache, images already evaluated under cache_key (eval_cache_key) are not run"""
     lr_img_paths = sorted(os.listdir(lr_dir))
     hr_img_paths = sorted(os.listdir(hr_dir))
-    total_psnr = 0.0
-    total_ssim = 0.0
-    num = 0
+    metrics = MetricsEngine(scale, y_only=True)
     for lr_path, hr_path in zip(lr_img_paths, hr_img_paths):
-        lr_img = img_to_array(load_img(os.path.join(lr_dir, lr_path)))
-        hr_img = img_to_array(load_img(os.path.join(hr_dir, hr_path)))
+        lr_file = os.path.join(lr_dir, lr_path)
+        hr_file = os.path.join(hr_dir, hr_path)
+        if cache is not None:
+            image_key = image_pair_key(lr_file, hr_file)
+            cached = cache.get(cache_key, image_key, METRICS_VERSION)
+            if cached is not None:
+                metrics.add(cached)
+                continue
+        lr_img = img_to_array(load_img(lr_file))
+        hr_img = img_to_array(load_img(hr_file))
         lr_img = tf.expand_dims(lr_img, axis=0)
         hr_img = tf.expand_dims(hr_img, axis=0)
         sr_img = model(lr_img, training=False)
-        cur_psnr = calculate_psnr(
-            y_true=hr_img, y_pred=sr_img, scale=cfg.upscale_factor, y_only=True)
-        cur_ssim = calculate_ssim(
-            y_true=hr_img, y_pred=sr_img, scale=cfg.upscale_factor, y_only=True)
-        total_psnr += cur_psnr
-        total_ssim += cur_ssim
-        num += 1
+        image_metrics = metrics.update(hr_img, sr_img)
+        if cache is not None:
+            output = tf.io.encode_png(post_process(sr_img[0])).numpy() if cache.store_outputs else None
+            cache.put(cache_key, image_key, METRICS_VERSION,
+                      {key: float(value[0]) for key, value in image_metrics.items()}, output)
+    if cache is not None:
+        cache.flush()
+    return hr_img_paths[:len(lr_img_paths)], metrics.per_image()
+
+
+def evaluate(model, lr_dir, hr_dir, scale, cache=None, cache_key=''):
+    """mean psnr / ssim (y channel) of the model over the image pairs of lr_dir / hr_dir"""
+    _, per_image = evaluate_images(model, lr_dir, hr_dir, scale, cache, cache_key)
+    return float(per_image['psnr'].mean()), float(per_image['ssim'].mean())
+
+
+def upscaler_from_config(model, cfg):
+    """the Upscaler of the runtime section (self_ensemble, ensemble_max_batch, tile_size, tile_overlap)"""
+    return Upscaler(model, cfg.upscale_factor, cfg.self_ensemble, cfg.ensemble_max_batch, cfg.tile_size,
+                    cfg.tile_overlap)
+
+
+def eval_cache_key(cfg, weights_files):
+    """eval cache model key of weights_files evaluated through upscaler_from_config, the same in every eval tool"""
+    # the ensemble and the tiling change the outputs, the batching of the ensemble does not
+    settings = dict(generator_settings(cfg), self_ensemble=cfg.self_ensemble, tile_size=cfg.tile_size,
+                    tile_overlap=cfg.tile_overlap)
+    return model_key(weights_files, settings, cfg.inference_precision)
+
+
+def eval_dataset_dirs(cfg):
+    """{name: (lr_dir, hr_dir)} of evaluation.datasets, or data.eval_lr_dir / eval_hr_dir as 'eval'"""
+    if not cfg.eval_datasets:
+        return {'eval': (cfg.eval_lr_dir, cfg.eval_hr_dir)}
+    return {d['name']: (d['lr_dir'], d['hr_dir']) for d in cfg.eval_datasets}
+
+
+def eval_datasets(cfg, names):
+    """per dataset results of one model for the named datasets, the model is built once"""
+    start = time.perf_counter()
+    configure_threads(cfg.intra_op_threads, cfg.inter_op_threads)
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+    # load model
+    set_inference_precision(cfg.inference_precision)
+    model = generator_from_config(cfg)
+    model.load_weights(cfg.best_weights_file)
+    upscaler = upscaler_from_config(model, cfg)
+
+    cache = None
+    cache_key = ''
+    if cfg.eval_cache_file:
+        cache = EvalCache(cfg.eval_cache_file, cfg.eval_cache_max_mb * 2 ** 20, cfg.eval_cache_outputs)
+        cache_key = eval_cache_key(cfg, cfg.best_weights_file)
+    startup_seconds = time.perf_counter() - start
+
+    dirs = eval_dataset_dirs(cfg)
+    results = {}
+    for name in names:
+        start = time.perf_counter()
+        upscaler.reset_cost()
+        images, per_image = evaluate_images(upscaler, *dirs[name], cfg.upscale_factor, cache, cache_key)
+        results[name] = {
+            'num_images': len(images), 'psnr': float(per_image['psnr'].mean()),
+            'ssim': float(per_image['ssim'].mean()), 'seconds': time.perf_counter() - start,
+            'startup_seconds': startup_seconds, 'cost_multiplier': upscaler.cost_multiplier,
+            'images': [{'image': image, 'psnr': float(psnr), 'ssim': float(ssim)}
+                       for image, psnr, ssim in zip(images, per_image['psnr'], per_image['ssim'])]}
+    if cache is not None:
+        print(f'eval cache: {cache.hits} cached, {cache.misses} computed')
+        cache.close()
+    return results
+
+
+def split_datasets(cfg, names, workers):
+    """names split over workers, balanced by hr bytes (largest first onto the least loaded worker)"""
+    dirs = eval_dataset_dirs(cfg)
+
+    def cost(name):
+        hr_dir = dirs[name][1]
+        return sum(os.path.getsize(os.path.join(hr_dir, f)) for f in os.listdir(hr_dir))
+
+    shares = [[] for _ in range(min(workers, len(names)))]
+    loads = [0] * len(shares)
+    for name in sorted(names, key=cost, reverse=True):
+        least = loads.index(min(loads))
+        shares[least].append(name)
+        loads[least] += cost(name)
+    return shares
+
 
-    mean_psnr = total_psnr / num
-    mean_ssim = total_ssim / num
+def eval(cfg, names=None, workers=1):
+    start = time.perf_counter()
+    dirs = eval_dataset_dirs(cfg)
+    names = names or list(dirs)
+    unknown = [name for name in names if name not in dirs]
+    if unknown:
+        raise ValueError(f'Unknown eval datasets {unknown}, one of {list(dirs)}')
+    if workers <= 1 or len(names) == 1:
+        results = eval_datasets(cfg, names)
+    else:
+        # one model per worker, not per dataset; the cpu cores are split between the workers
+        threads = []
+        if not cfg.intra_op_threads:
+            threads = ['-o', f'runtime.intra_op_threads={max(1, os.cpu_count() // workers)}']
+        children = [subprocess.Popen([sys.executable, 'eval.py'] + sys.argv[1:] + threads +
+                                     ['--worker_datasets'] + share, stdout=subprocess.PIPE, text=True)
+                    for share in split_datasets(cfg, names, workers)]
+        results = {}
+        for child in children:
+            stdout, _ = child.communicate()
+            if child.returncode:
+                raise RuntimeError(f'eval worker failed with exit code {child.returncode}')
+            results.update(json.loads(stdout.strip().splitlines()[-1]))
+    results = {name: results[name] for name in names}
 
     with open(cfg.eval_log_file, "w") as f:
-        f.write(f'Mean PSNR: {mean_psnr}\n')
-        f.write(f'Mean SSIM: {mean_ssim}\n')
+        for name, r in results.items():
+            f.write(f"{name} Mean PSNR: {r['psnr']}\n")
+            f.write(f"{name} Mean SSIM: {r['ssim']}\n")
+    report = {'weights_file': cfg.best_weights_file, 'workers': workers,
+              'wall_seconds': time.perf_counter() - start, 'datasets': results}
+    if cfg.eval_report_file:
+        os.makedirs(os.path.dirname(cfg.eval_report_file) or '.', exist_ok=True)
+        with open(cfg.eval_report_file, 'w') as f:
+            json.dump(report, f, indent=2)
 
-    print(f'Mean PSNR: {mean_psnr}')
-    print(f'Mean SSIM: {mean_ssim}')
+    print(f"{'dataset':<16}{'images':>8}{'psnr':>10}{'ssim':>9}{'seconds':>10}{'cost':>7}")
+    for name, r in results.items():
+        print(f"{name:<16}{r['num_images']:>8}{r['psnr']:>10.4f}{r['ssim']:>9.4f}{r['seconds']:>10.1f}"
+              f"{r['cost_multiplier']:>6.1f}x")
+    print(f"wall time {report['wall_seconds']:.1f} s")
+    return report
 
 
 if __name__ == '__main__':
-    eval()
+    sys.setrecursionlimit(2000)
+    # e.g. python eval.py -o model.attention_type=window -o runtime.inference_precision=mixed_float16
+    # python eval.py --datasets Set5 Set14 Urban100 --workers 2
+    # python eval.py -o runtime.self_ensemble=True -o runtime.tile_size=128
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--datasets', nargs='+', default=None,
+                        help='names of evaluation.datasets, default all')
+    parser.add_argument('--workers', type=int, default=1, help='processes the datasets are split over')
+    parser.add_argument('--worker_datasets', nargs='+', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    if args.worker_datasets:
+        # child process of eval
+        print(json.dumps(eval_datasets(cfg, args.worker_datasets)))
+    else:
+        eval(cfg, args.datasets, args.workers)
@@ -0,0 +1,118 @@
+"""Eval set PSNR / SSIM of many generator checkpoints, e.g. the archive of a gan run (checkpoint.archive_every).
+The model is built once and the eval images are decoded once, every checkpoint only swaps the weights in place.
+Checkpoints are .h5 weights files or train_psnr.py / train_gan.py checkpoint prefixes, directories are expanded.
+Inference goes through the runtime self_ensemble / tiling like eval.py, and results already in the eval cache
+(evaluation.cache_file), also those of eval.py runs on the same weights, are not recomputed.
+
+python eval_checkpoints.py outputs/checkpoints/gan_archive outputs/weights/gan/gen/gen_weights.h5
+python eval_checkpoints.py outputs/checkpoints/psnr_archive --sort psnr --csv outputs/logs/eval/checkpoints.csv
+"""
+import os
+import re
+import sys
+import csv
+import json
+import argparse
+import tensorflow as tf
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from datasets.dataloader import load_img_pairs_to_memory
+from models.model_builder import generator_from_config
+from train_utils.checkpoints import list_checkpoints, checkpoint_files, load_generator_weights
+from train_utils.metrics import MetricsEngine, METRICS_VERSION
+from utils.eval_cache import EvalCache, image_pair_key
+from utils.runtime import set_inference_precision
+from eval import upscaler_from_config, eval_cache_key
+
+
+def iteration_of(checkpoint):
+    # ckpt-00001500 -> 1500, None for names without a number
+    numbers = re.findall(r'\d+', os.path.basename(checkpoint))
+    return int(numbers[-1]) if numbers else None
+
+
+def eval_checkpoints(cfg, checkpoints, sort_key='', json_file='', csv_file=''):
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+    set_inference_precision(cfg.inference_precision)
+    checkpoints = list_checkpoints(checkpoints)
+    if not checkpoints:
+        raise ValueError('no checkpoints found')
+    model = generator_from_config(cfg)
+    # the weights are loaded into model in place, the upscaler sees every checkpoint
+    upscaler = upscaler_from_config(model, cfg)
+
+    # decoded once, evaluated for every checkpoint
+    img_pairs = load_img_pairs_to_memory(cfg.eval_lr_dir, cfg.eval_hr_dir)
+    lr_img_paths = sorted(os.listdir(cfg.eval_lr_dir))
+    hr_img_paths = sorted(os.listdir(cfg.eval_hr_dir))
+    image_keys = [image_pair_key(os.path.join(cfg.eval_lr_dir, lr_path), os.path.join(cfg.eval_hr_dir, hr_path))
+                  for lr_path, hr_path in zip(lr_img_paths, hr_img_paths)]
+    cache = None
+    if cfg.eval_cache_file:
+        cache = EvalCache(cfg.eval_cache_file, cfg.eval_cache_max_mb * 2 ** 20)
+    metrics = MetricsEngine(cfg.upscale_factor, y_only=True)
+
+    results = []
+    for checkpoint in checkpoints:
+        metrics.reset()
+        cache_key = ''
+        cached = [None] * len(img_pairs)
+        if cache is not None:
+            cache_key = eval_cache_key(cfg, checkpoint_files(checkpoint))
+            cached = [cache.get(cache_key, image_key, METRICS_VERSION) for image_key in image_keys]
+        # fully cached checkpoints are not even loaded
+        if any(c is None for c in cached):
+            load_generator_weights(model, checkpoint)
+        for (lr_img, hr_img), image_key, image_cached in zip(img_pairs, image_keys, cached):
+            if image_cached is not None:
+                metrics.add(image_cached)
+                continue
+            sr_img = upscaler(lr_img[None])
+            image_metrics = metrics.update(hr_img[None], sr_img)
+            if cache is not None:
+                cache.put(cache_key, image_key, METRICS_VERSION,
+                          {key: float(value[0]) for key, value in image_metrics.items()})
+        if cache is not None:
+            cache.flush()
+        result = metrics.result()
+        results.append({'checkpoint': checkpoint, 'iteration': iteration_of(checkpoint),
+                        'psnr': result['psnr'], 'ssim': result['ssim'],
+                        'cached': sum(c is not None for c in cached)})
+        print(f"{checkpoint}: psnr {result['psnr']:.4f}, ssim {result['ssim']:.4f}")
+    if cache is not None:
+        cache.close()
+
+    if sort_key:
+        # metrics best first, iterations in training order
+        results.sort(key=lambda r: r[sort_key] if r[sort_key] is not None else -1, reverse=sort_key != 'iteration')
+    best = max(results, key=lambda r: r['psnr'])
+    width = max(len(r['checkpoint']) for r in results) + 2
+    print(f"\n{'checkpoint':<{width}}{'iteration':>10}{'psnr':>10}{'ssim':>9}{'cached':>8}")
+    for r in results:
+        iteration = r['iteration'] if r['iteration'] is not None else '-'
+        print(f"{r['checkpoint']:<{width}}{iteration:>10}{r['psnr']:>10.4f}{r['ssim']:>9.4f}"
+              f"{r['cached']:>8}{'  best' if r is best else ''}")
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'best': best['checkpoint'], 'results': results}, f, indent=2)
+    if csv_file:
+        with open(csv_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    return results
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('checkpoints', nargs='+', help='.h5 files, checkpoint prefixes or directories of them')
+    parser.add_argument('--sort', choices=['psnr', 'ssim', 'iteration'], default='',
+                        help='sort the table, default checkpoint order')
+    parser.add_argument('--json', default='')
+    parser.add_argument('--csv', default='')
+    args = parser.parse_args()
+    eval_checkpoints(load_config(args.config, args.override), args.checkpoints, args.sort, args.json, args.csv)
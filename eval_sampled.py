@@ -0,0 +1,158 @@
+"""Sampled evaluation for quick model comparisons: eval images in a seeded random order, running mean PSNR / SSIM
+with t or bootstrap confidence intervals, stopped as soon as the PSNR interval is narrower than
++-target_half_width dB. With --compare_weights both models see the same images and the interval is the one of
+the paired per image PSNR difference, stopped early when it excludes 0 (significantly different) or is narrower
+than +-target_half_width (equivalent within the target). Reports how many images were needed.
+The stop rule is checked every --check_every images from --min_images on, each check at the Bonferroni corrected
+level 1 - (1 - confidence) / planned checks, so the reported intervals and the stop decision hold at `confidence`
+however early the run stops.
+
+python eval_sampled.py --target_half_width 0.05
+python eval_sampled.py --compare_weights outputs/prune/ratio_0.50/weights.h5 \
+    --compare_override model.growth_channels=16 --method bootstrap
+"""
+import os
+import sys
+import json
+import argparse
+from statistics import NormalDist
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.utils import load_img, img_to_array
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import generator_from_config
+from train_utils.metrics import MetricsEngine
+from utils.runtime import set_inference_precision
+from eval import eval_dataset_dirs, upscaler_from_config
+
+
+def t_quantile(p, dof):
+    """quantile of the t distribution, Cornish-Fisher expansion around the normal one (good for dof >= 3)"""
+    z = NormalDist().inv_cdf(p)
+    return (z + (z ** 3 + z) / (4 * dof) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * dof ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * dof ** 3))
+
+
+def mean_interval(values, confidence=0.95, method='t', num_bootstrap=2000, rng=None):
+    """mean and (low, high) confidence interval of the mean of values"""
+    values = np.asarray(values, dtype=np.float64)
+    mean = float(values.mean())
+    if len(values) < 2:
+        return mean, (-np.inf, np.inf)
+    if method == 'bootstrap':
+        rng = rng or np.random.default_rng(0)
+        means = rng.choice(values, size=(num_bootstrap, len(values))).mean(axis=1)
+        alpha = (1 - confidence) / 2
+        return mean, (float(np.quantile(means, alpha)), float(np.quantile(means, 1 - alpha)))
+    half_width = t_quantile(1 - (1 - confidence) / 2, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values))
+    return mean, (mean - half_width, mean + half_width)
+
+
+def planned_checks(num_images, min_images, check_every):
+    """image counts after which the stop rule is checked"""
+    checks = list(range(min_images, num_images + 1, check_every))
+    return checks or [num_images]
+
+
+def build_upscaler(cfg, weights_file):
+    model = generator_from_config(cfg)
+    model.load_weights(weights_file)
+    return upscaler_from_config(model, cfg)
+
+
+def eval_sampled(cfg, dataset='', compare_cfg=None, target_half_width=0.05, confidence=0.95, method='t',
+                 min_images=10, max_images=0, check_every=5, seed=0, json_file=''):
+    set_inference_precision(cfg.inference_precision)
+    dirs = eval_dataset_dirs(cfg)
+    lr_dir, hr_dir = dirs[dataset or next(iter(dirs))]
+    pairs = list(zip(sorted(os.listdir(lr_dir)), sorted(os.listdir(hr_dir))))
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(pairs))
+    if max_images:
+        order = order[:max_images]
+    # every check spends an equal share of 1 - confidence
+    checks = planned_checks(len(order), min_images, max(1, check_every))
+    check_confidence = 1 - (1 - confidence) / len(checks)
+    # enough resamples for the tail quantiles of the corrected level
+    num_bootstrap = max(2000, int(np.ceil(20 / (1 - check_confidence))))
+
+    upscalers = {'model': build_upscaler(cfg, cfg.best_weights_file)}
+    if compare_cfg is not None:
+        upscalers['compare'] = build_upscaler(compare_cfg, compare_cfg.best_weights_file)
+    metrics = {name: MetricsEngine(cfg.upscale_factor, y_only=True) for name in upscalers}
+
+    stop_reason = 'all images'
+    for n, index in enumerate(order, start=1):
+        lr_path, hr_path = pairs[index]
+        lr_img = tf.expand_dims(img_to_array(load_img(os.path.join(lr_dir, lr_path))), axis=0)
+        hr_img = tf.expand_dims(img_to_array(load_img(os.path.join(hr_dir, hr_path))), axis=0)
+        for name, upscaler in upscalers.items():
+            metrics[name].update(hr_img, upscaler(lr_img))
+        if n not in checks:
+            continue
+        psnr = metrics['model'].per_image()['psnr']
+        if compare_cfg is None:
+            _, (low, high) = mean_interval(psnr, check_confidence, method, num_bootstrap, rng)
+            if (high - low) / 2 < target_half_width:
+                stop_reason = 'target half width'
+                break
+        else:
+            difference = psnr - metrics['compare'].per_image()['psnr']
+            _, (low, high) = mean_interval(difference, check_confidence, method, num_bootstrap, rng)
+            if low > 0 or high < 0:
+                stop_reason = 'significant difference'
+                break
+            if (high - low) / 2 < target_half_width:
+                stop_reason = 'equivalent within target'
+                break
+
+    report = {'dataset': dataset or next(iter(dirs)), 'num_images': int(metrics['model'].count),
+              'total_images': len(pairs), 'stop_reason': stop_reason, 'confidence': confidence, 'method': method,
+              'target_half_width': target_half_width, 'correction': 'bonferroni', 'planned_checks': len(checks),
+              'checks_done': sum(c <= metrics['model'].count for c in checks), 'check_confidence': check_confidence}
+    for name, engine in metrics.items():
+        per_image = engine.per_image()
+        for key in ('psnr', 'ssim'):
+            mean, (low, high) = mean_interval(per_image[key], check_confidence, method, num_bootstrap, rng)
+            report[f'{name}_{key}'] = {'mean': mean, 'low': low, 'high': high}
+    if compare_cfg is not None:
+        difference = metrics['model'].per_image()['psnr'] - metrics['compare'].per_image()['psnr']
+        mean, (low, high) = mean_interval(difference, check_confidence, method, num_bootstrap, rng)
+        report['psnr_difference'] = {'mean': mean, 'low': low, 'high': high}
+
+    print(f"{report['num_images']} of {report['total_images']} images, stopped on {stop_reason} "
+          f"({report['checks_done']} of {len(checks)} checks, each at {check_confidence:.4f})")
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{key:<18}{value['mean']:>10.4f}  [{value['low']:.4f}, {value['high']:.4f}]")
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--dataset', default='', help='name of evaluation.datasets, default the first')
+    parser.add_argument('--compare_weights', default='', help='weights of a second model, evaluated on the same images')
+    parser.add_argument('--compare_override', action='append', default=[],
+                        help='section.key=value of the second model on top of the config, may be repeated')
+    parser.add_argument('--target_half_width', type=float, default=0.05, help='PSNR interval half width in dB')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--method', choices=['t', 'bootstrap'], default='t')
+    parser.add_argument('--min_images', type=int, default=10)
+    parser.add_argument('--max_images', type=int, default=0, help='0 = the whole set')
+    parser.add_argument('--check_every', type=int, default=5, help='images between checks of the stop rule')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default='')
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    compare_cfg = None
+    if args.compare_weights or args.compare_override:
+        compare_cfg = load_config(args.config, args.override + args.compare_override +
+                                  [f'checkpoint.best_weights_file={args.compare_weights or cfg.best_weights_file}'])
+    eval_sampled(cfg, args.dataset, compare_cfg, args.target_half_width, args.confidence, args.method,
+                 args.min_images, args.max_images, args.check_every, args.seed, args.json)
@@ -0,0 +1,79 @@
+"""PSNR / SSIM, time and memory on the eval set of the best weights with the cross-scale attention
+reconstructing from the top k matching patches, for every k (0 = all patches, the reference).
+Every k runs in its own process so that the memory peak of one k does not hide the next, and is warmed up
+on one eval image before the clock starts.
+
+python eval_top_k.py --top_k 0 4 8 16 32
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import tensorflow as tf
+from tensorflow.keras.utils import load_img, img_to_array
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import generator_from_config
+from utils.memory import device_memory_info, reset_device_peak, process_rss_bytes, peak_rss_bytes
+from utils.runtime import set_inference_precision
+from eval import evaluate, upscaler_from_config
+
+
+def measure_top_k(cfg, k):
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+    set_inference_precision(cfg.inference_precision)
+    # top_k adds no weights, every k loads the same file
+    model = generator_from_config(cfg, cross_scale_top_k=k)
+    model.load_weights(cfg.best_weights_file)
+    upscaler = upscaler_from_config(model, cfg)
+    rss_before = process_rss_bytes()
+    reset_device_peak()
+    # trace the forward pass before timing
+    lr_file = os.path.join(cfg.eval_lr_dir, sorted(os.listdir(cfg.eval_lr_dir))[0])
+    upscaler(tf.expand_dims(img_to_array(load_img(lr_file)), axis=0))
+    start = time.perf_counter()
+    mean_psnr, mean_ssim = evaluate(upscaler, cfg.eval_lr_dir, cfg.eval_hr_dir, cfg.upscale_factor)
+    result = {'top_k': k, 'psnr': float(mean_psnr), 'ssim': float(mean_ssim),
+              'seconds': time.perf_counter() - start, 'rss_growth_bytes': peak_rss_bytes() - rss_before}
+    info = device_memory_info()
+    if info is not None:
+        result['device_peak_bytes'] = info['peak']
+    return result
+
+
+def eval_top_k(top_ks, json_file=''):
+    results = []
+    for k in top_ks:
+        child = subprocess.run([sys.executable, 'eval_top_k.py'] + sys.argv[1:] + ['--worker_top_k', str(k)],
+                               capture_output=True, text=True, check=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    reference = next((r for r in results if r['top_k'] == 0), results[0])
+    memory_key = 'device_peak_bytes' if 'device_peak_bytes' in reference else 'rss_growth_bytes'
+    print(f"{'top_k':>6}{'psnr':>10}{'d_psnr':>10}{'ssim':>10}{'seconds':>10}{'memory MB':>11}")
+    for r in results:
+        print(f"{r['top_k']:>6}{r['psnr']:>10.3f}{r['psnr'] - reference['psnr']:>10.3f}"
+              f"{r['ssim']:>10.4f}{r['seconds']:>10.1f}{r[memory_key] / 2 ** 20:>11.1f}")
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'memory': memory_key, 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[0, 4, 8, 16, 32])
+    parser.add_argument('--json', default='')
+    parser.add_argument('--worker_top_k', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_top_k is not None:
+        # child process of eval_top_k
+        print(json.dumps(measure_top_k(load_config(args.config, args.override), args.worker_top_k)))
+    else:
+        eval_top_k(args.top_k, args.json)
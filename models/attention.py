@@ -1,16 +1,35 @@
 import tensorflow as tf
 import numpy as np
 from tensorflow.keras.layers import Conv2D, Reshape, Softmax, add, PReLU, Layer, GlobalAveragePooling2D, multiply
+from utils.model_walk import tag_block
+
+
+def softmax_float32(logits, softmax_factor, mask=None):
+    """softmax(logits * softmax_factor) over the last axis, computed in float32 with the row max subtracted,
+    so float16 / bfloat16 logits neither overflow nor lose the small weights. mask: False entries get ~0 weight
+    :return: float32 weights, cast them back to the compute dtype
+    """
+    logits = tf.cast(logits, tf.float32) * softmax_factor
+    if mask is not None:
+        logits = tf.where(mask, logits, -1e9)
+    logits -= tf.stop_gradient(tf.reduce_max(logits, axis=-1, keepdims=True))
+    return tf.nn.softmax(logits, axis=-1)
 
 
 class CrossScaleNonLocalAttention(Layer):
-    def __init__(self, channel_reduction=2, scale=4, patch_size=3, softmax_factor=10, kernel_initializer=tf.keras.initializers.GlorotNormal(), **kwargs):
+    """top_k > 0: every query location is reconstructed from its top_k best matching patches only
+    (softmax over those k scores), O(hw*k) instead of O(hw*N) for the reconstruction. top_k=0: all N patches
+    """
+
+    def __init__(self, channel_reduction=2, scale=4, patch_size=3, softmax_factor=10, kernel_initializer=tf.keras.initializers.GlorotNormal(),
+                 top_k=0, **kwargs):
         super(CrossScaleNonLocalAttention, self).__init__(**kwargs)
         self.channel_reduction = channel_reduction
         self.scale = scale
         self.patch_size = patch_size
         self.softmax_factor = softmax_factor
         self.kernel_initializer = kernel_initializer
+        self.top_k = top_k
 
     def build(self, input_shape):
         channels = input_shape[-1]
@@ -38,6 +57,46 @@ class CrossScaleNonLocalAttention(Layer):
         self.g_PRelu = PReLU(shared_axes=[1, 2])
         return super().build(input_shape)
 
+    def sparse_reconstruction(self, y_i, g_patch_i, height, width, channels):
+        """same result as the conv2d_transpose of the softmax map when top_k = N
+        :param y_i: (1,h,w,N) matching scores
+        :param g_patch_i: (N,s*p,s*p,c)
+        """
+        p, s = self.patch_size, self.scale
+        num_patches = tf.shape(g_patch_i)[0]
+        k = tf.minimum(self.top_k, num_patches)
+        scores = tf.reshape(y_i, shape=(height * width, num_patches))
+        top_scores, top_indices = tf.math.top_k(scores, k=k)  # (h*w,k)
+        weights = softmax_float32(top_scores, self.softmax_factor)
+        # (h*w,N) with k entries per row
+        rows = tf.repeat(tf.range(height * width, dtype=tf.int64), k)
+        attention = tf.SparseTensor(indices=tf.stack([rows, tf.reshape(tf.cast(top_indices, tf.int64), [-1])], axis=1),
+                                    values=tf.reshape(weights, [-1]),
+                                    dense_shape=tf.cast(tf.stack([height * width, num_patches]), tf.int64))
+
+        # overlap-add the (s*p,s*p) patches with stride s, as conv2d_transpose(padding='SAME'):
+        # each of the p*p (s,s) sub-blocks of the patches is weighted on its own, a depth_to_space image shifted by
+        # multiples of s, so no intermediate is larger than the (1,s*h,s*w,c) output
+        g_patch_i = tf.reshape(g_patch_i, shape=(num_patches, p, s, p, s, channels))
+        offset = s * (p - 1) // 2
+        y_i = 0.0
+        for a in range(p):
+            for b in range(p):
+                g_block = tf.reshape(g_patch_i[:, a, :, b, :, :], shape=(num_patches, s * s * channels))
+                block = tf.sparse.sparse_dense_matmul(attention, tf.cast(g_block, tf.float32))  # (h*w,s*s*c)
+                block = tf.reshape(tf.cast(block, g_patch_i.dtype), shape=(1, height, width, s * s * channels))
+                block = tf.nn.depth_to_space(block, block_size=s)  # (1,s*h,s*w,c)
+                y_i += self._shift(block, a * s - offset, b * s - offset)
+        y_i = y_i / 6
+        return y_i
+
+    @staticmethod
+    def _shift(x, dy, dx):
+        # x moved down by dy and right by dx, zeros shifted in, same shape
+        x = tf.pad(x, [[0, 0], [max(dy, 0), max(-dy, 0)], [max(dx, 0), max(-dx, 0)], [0, 0]])
+        size = tf.shape(x)
+        return x[:, max(-dy, 0):size[1] - max(dy, 0), max(-dx, 0):size[2] - max(dx, 0), :]
+
     # @tf.function
     def call(self, inputs, *args, **kwargs):
         input_shape = tf.shape(inputs)
@@ -78,10 +137,13 @@ class CrossScaleNonLocalAttention(Layer):
             theta_i, phi_patch_i, g_patch_i = args
             theta_i = tf.expand_dims(theta_i, axis=0)  # (1,h,w,c/2)
 
+            # patch norms in float32, the squares overflow float16
+            compute_dtype = phi_patch_i.dtype
+            phi_patch_i = tf.cast(phi_patch_i, tf.float32)
             max_phi_patch_i = tf.sqrt(tf.reduce_sum(
                 tf.square(phi_patch_i), axis=[1, 2, 3], keepdims=True))
             max_phi_patch_i = tf.maximum(max_phi_patch_i, 1e-6)
-            phi_patch_i = phi_patch_i / max_phi_patch_i
+            phi_patch_i = tf.cast(phi_patch_i / max_phi_patch_i, compute_dtype)
 
             phi_patch_i = tf.transpose(phi_patch_i,
                                        perm=(1, 2, 3, 0))  # (p,p,c/2,N)
@@ -91,8 +153,10 @@ class CrossScaleNonLocalAttention(Layer):
                                strides=(1, 1),
                                padding='SAME',
                                data_format='NHWC')  # (1,h,w,N)
-            y_i_softmax = tf.nn.softmax(
-                y_i*self.softmax_factor, axis=-1)  # feature map
+            if self.top_k > 0:
+                return self.sparse_reconstruction(y_i, g_patch_i, height, width, channels)
+            y_i_softmax = tf.cast(softmax_float32(
+                y_i, self.softmax_factor), y_i.dtype)  # feature map
 
             # g_patch_i (s*p,s*p,c,N)
             g_patch_i = tf.transpose(g_patch_i, perm=[1, 2, 3, 0])
@@ -107,7 +171,7 @@ class CrossScaleNonLocalAttention(Layer):
             return y_i
 
         y = tf.map_fn(process_patches, (theta, phi_patch,
-                      g_patch), dtype=tf.float32)
+                      g_patch), fn_output_signature=g_patch.dtype)  # (b,1,s*h,s*w,c)
         y = tf.squeeze(y, axis=1)
         output_shape = (batch_size, self.scale * height,
                         self.scale * width, channels)
@@ -209,8 +273,8 @@ class InsclaeNonLocalAttention(Layer):
 
         attention_map = tf.matmul(
             theta_flat, phi_flat, transpose_b=True)  # (b,h*w,h*w)
-        attention_map_softmax = tf.nn.softmax(
-            attention_map*self.softmax_factor, axis=-1)  # feature map
+        attention_map_softmax = tf.cast(softmax_float32(
+            attention_map, self.softmax_factor), g_flat.dtype)  # feature map
 
         y = tf.matmul(attention_map_softmax, g_flat)  # (b,h*w,c/2)
         # y = Reshape(target_shape=(height, width, inter_channels))(y)  # (b,h,w,c/2)
@@ -219,11 +283,153 @@ class InsclaeNonLocalAttention(Layer):
         return y
 
 
-def in_scale_non_local_attention_residual_block(input_tensor, channel_reduction=2, softmax_factor=6, kernel_initializer=tf.keras.initializers.GlorotNormal()):
-    x = InsclaeNonLocalAttention(channel_reduction=channel_reduction,
-                                 softmax_factor=softmax_factor,
-                                 kernel_initializer=kernel_initializer,)(input_tensor)
-    return add([input_tensor, x])
+class WindowNonLocalAttention(Layer):
+    """InsclaeNonLocalAttention restricted to non-overlapping window_size x window_size windows,
+    O(h*w*window_size^2) instead of O((h*w)^2). Same theta/phi/g/y convs, so weights are interchangeable.
+    shift > 0 rolls the windows by shift pixels (alternate with unshifted blocks to connect windows)
+    """
+
+    def __init__(self, channel_reduction=2, softmax_factor=6, window_size=8, shift=0,
+                 kernel_initializer=tf.keras.initializers.GlorotNormal(), **kwargs):
+        super(WindowNonLocalAttention, self).__init__(**kwargs)
+        self.channel_reduction = channel_reduction
+        self.softmax_factor = softmax_factor
+        self.window_size = window_size
+        self.shift = shift
+        self.kernel_initializer = kernel_initializer
+
+    def build(self, input_shape):
+        channels = input_shape[-1]
+        inter_channels = channels // self.channel_reduction
+
+        self.theta = Conv2D(filters=inter_channels,
+                            kernel_size=(1, 1),
+                            strides=(1, 1),
+                            padding='same',
+                            kernel_initializer=self.kernel_initializer,)
+
+        self.phi = Conv2D(filters=inter_channels,
+                          kernel_size=(1, 1),
+                          strides=(1, 1),
+                          padding='same',
+                          kernel_initializer=self.kernel_initializer,)
+        self.g = Conv2D(filters=inter_channels,
+                        kernel_size=(1, 1),
+                        strides=(1, 1),
+                        padding='same',
+                        kernel_initializer=self.kernel_initializer,)
+        self.y = Conv2D(filters=channels,
+                        kernel_size=(1, 1),
+                        strides=(1, 1),
+                        padding='same',
+                        kernel_initializer=self.kernel_initializer,)
+
+        return super().build(input_shape)
+
+    def window_partition(self, x, padded_height, padded_width):
+        # (b,hp,wp,c) -> (b,nW,ws*ws,c)
+        ws = self.window_size
+        channels = tf.shape(x)[-1]
+        x = tf.reshape(x, shape=(-1, padded_height // ws, ws, padded_width // ws, ws, channels))
+        x = tf.transpose(x, perm=(0, 1, 3, 2, 4, 5))
+        return tf.reshape(x, shape=(-1, (padded_height // ws) * (padded_width // ws), ws * ws, channels))
+
+    def window_reverse(self, x, padded_height, padded_width):
+        # (b,nW,ws*ws,c) -> (b,hp,wp,c)
+        ws = self.window_size
+        channels = tf.shape(x)[-1]
+        x = tf.reshape(x, shape=(-1, padded_height // ws, padded_width // ws, ws, ws, channels))
+        x = tf.transpose(x, perm=(0, 1, 3, 2, 4, 5))
+        return tf.reshape(x, shape=(-1, padded_height, padded_width, channels))
+
+    def attention_mask(self, height, width, padded_height, padded_width):
+        """(nW,ws*ws,ws*ws) bool, a query only sees keys of the same window region that are not padding.
+        after the cyclic shift a window can hold pixels from opposite borders, those regions are kept apart
+        """
+        def regions(size, padded_size):
+            positions = tf.range(padded_size)
+            # position before the shift, padding is at the end
+            valid = tf.math.floormod(positions + self.shift, padded_size) < size
+            if self.shift > 0:
+                region = tf.where(positions < padded_size - self.window_size, 0,
+                                  tf.where(positions < padded_size - self.shift, 1, 2))
+            else:
+                region = tf.zeros_like(positions)
+            return region, valid
+
+        row_region, row_valid = regions(height, padded_height)
+        col_region, col_valid = regions(width, padded_width)
+        label = row_region[:, None] * 3 + col_region[None, :]
+        # invalid keys get their own label so they never match a query
+        label = tf.where(row_valid[:, None] & col_valid[None, :], label, -1)
+        label = self.window_partition(label[None, :, :, None], padded_height, padded_width)
+        label = label[0, :, :, 0]  # (nW,ws*ws)
+        return tf.equal(label[:, :, None], label[:, None, :])
+
+    def call(self, inputs, *args, **kwargs):
+        dynamic_shape = tf.shape(inputs)
+        height, width = dynamic_shape[1], dynamic_shape[2]
+        ws = self.window_size
+        padded_height = (height + ws - 1) // ws * ws
+        padded_width = (width + ws - 1) // ws * ws
+
+        theta = self.theta(inputs)  # (b,h,w,c/2)
+        phi = self.phi(inputs)  # (b,h,w,c/2)
+        g = self.g(inputs)  # (b,h,w,c/2)
+        qkv = tf.concat([theta, phi, g], axis=-1)
+        qkv = tf.pad(qkv, [[0, 0], [0, padded_height - height], [0, padded_width - width], [0, 0]])
+        if self.shift > 0:
+            qkv = tf.roll(qkv, shift=(-self.shift, -self.shift), axis=(1, 2))
+        qkv = self.window_partition(qkv, padded_height, padded_width)  # (b,nW,ws*ws,3*c/2)
+        theta_win, phi_win, g_win = tf.split(qkv, 3, axis=-1)
+
+        attention_map = tf.matmul(
+            theta_win, phi_win, transpose_b=True)  # (b,nW,ws*ws,ws*ws)
+        mask = self.attention_mask(height, width, padded_height, padded_width)
+        attention_map_softmax = tf.cast(softmax_float32(
+            attention_map, self.softmax_factor, mask), g_win.dtype)
+
+        y = tf.matmul(attention_map_softmax, g_win)  # (b,nW,ws*ws,c/2)
+        y = self.window_reverse(y, padded_height, padded_width)
+        if self.shift > 0:
+            y = tf.roll(y, shift=(self.shift, self.shift), axis=(1, 2))
+        y = y[:, :height, :width, :]
+        y = self.y(y)  # (b,h,w,c)
+        return y
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'channel_reduction': self.channel_reduction,
+            'softmax_factor': self.softmax_factor,
+            'window_size': self.window_size,
+            'shift': self.shift,
+            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer),
+        })
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config['kernel_initializer'] = tf.keras.initializers.deserialize(config['kernel_initializer'])
+        return cls(**config)
+
+
+def in_scale_non_local_attention_residual_block(input_tensor, channel_reduction=2, softmax_factor=6, kernel_initializer=tf.keras.initializers.GlorotNormal(),
+                                                attention_type='global', window_size=8, shift=0):
+    """attention_type 'global': every pixel attends to every pixel, 'window': only within window_size windows"""
+    if attention_type == 'global':
+        x = InsclaeNonLocalAttention(channel_reduction=channel_reduction,
+                                     softmax_factor=softmax_factor,
+                                     kernel_initializer=kernel_initializer,)(input_tensor)
+    elif attention_type == 'window':
+        x = WindowNonLocalAttention(channel_reduction=channel_reduction,
+                                    softmax_factor=softmax_factor,
+                                    window_size=window_size,
+                                    shift=shift,
+                                    kernel_initializer=kernel_initializer,)(input_tensor)
+    else:
+        raise ValueError(f'Unknown attention_type {attention_type}')
+    return tag_block(input_tensor, add([input_tensor, x]), 'attention')
 
 
 class ChannelAttention(Layer):
@@ -2,29 +2,33 @@ import tensorflow as tf
 from tensorflow.keras.layers import Conv2D, ReLU, GlobalAveragePooling2D, add, multiply
 
 
-def rcab(x):
+def rcab(x, channels=64, reduction=16, kernel_initializer='glorot_uniform'):
     identity = x
-    x = Conv2D(filters=64,
+    x = Conv2D(filters=channels,
                kernel_size=(3, 3),
                strides=(1, 1),
-               padding='same', )(x)
+               padding='same',
+               kernel_initializer=kernel_initializer, )(x)
     x = ReLU()(x)
-    x = Conv2D(filters=64,
+    x = Conv2D(filters=channels,
                kernel_size=(3, 3),
                strides=(1, 1),
-               padding='same', )(x)
+               padding='same',
+               kernel_initializer=kernel_initializer, )(x)
     # channel attention
     ca = GlobalAveragePooling2D(keepdims=True)(x)
-    ca = Conv2D(filters=4,
+    ca = Conv2D(filters=channels // reduction,
                 kernel_size=(1, 1),
                 strides=(1, 1),
-                padding='same', )(ca)
+                padding='same',
+                kernel_initializer=kernel_initializer, )(ca)
     ca = ReLU()(ca)
-    ca = Conv2D(filters=64,
+    ca = Conv2D(filters=channels,
                 kernel_size=(1, 1),
                 strides=(1, 1),
                 padding='same',
-                activation='sigmoid',)(ca)
+                activation='sigmoid',
+                kernel_initializer=kernel_initializer, )(ca)
     x = multiply([x, ca])
     x = add([x, identity])
     return x
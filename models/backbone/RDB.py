@@ -1,71 +1,94 @@
 import tensorflow as tf
 from tensorflow.keras.layers import Conv2D, LeakyReLU, concatenate, add
+from utils.model_walk import tag_block
 
+DENSE_CONVS = ['concat', 'sliced']
 
-def residual_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
+
+class SlicedConv2D(Conv2D):
+    """Conv2D over the channel concatenation of a list of inputs, computed as the sum of one convolution per input
+    with its slice of the kernel. The concatenation is never built, so it is neither copied nor kept for backprop.
+    Same variables (kernel over all input channels, bias) as the Conv2D it replaces.
+    """
+
+    def __init__(self, filters, kernel_size, **kwargs):
+        super().__init__(filters, kernel_size, **kwargs)
+        # the input spec of Conv2D describes a single input
+        self.input_spec = None
+
+    def build(self, input_shape):
+        self.input_channels = [int(shape[-1]) for shape in input_shape]
+        super().build(tf.TensorShape(input_shape[0])[:-1].concatenate([sum(self.input_channels)]))
+        self.input_spec = None
+
+    def call(self, inputs):
+        outputs = []
+        offset = 0
+        for x, channels in zip(inputs, self.input_channels):
+            outputs.append(tf.nn.conv2d(x, self.kernel[:, :, offset:offset + channels, :], strides=self.strides,
+                                        padding=self.padding.upper(), dilations=self.dilation_rate))
+            offset += channels
+        outputs = tf.add_n(outputs)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, self.bias)
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        channels = sum(int(shape[-1]) for shape in input_shape)
+        return super().compute_output_shape(tf.TensorShape(input_shape[0])[:-1].concatenate([channels]))
+
+
+def dense_conv_3x3(inputs, filters, kernel_initializer, dense_conv='concat'):
+    """3x3 conv of the concatenated inputs, 'concat': concatenate + Conv2D, 'sliced': SlicedConv2D"""
+    conv_args = dict(filters=filters, kernel_size=(3, 3), strides=(1, 1), padding='same',
+                     kernel_initializer=kernel_initializer)
+    if len(inputs) == 1:
+        return Conv2D(**conv_args)(inputs[0])
+    if dense_conv == 'concat':
+        return Conv2D(**conv_args)(concatenate(inputs))
+    if dense_conv == 'sliced':
+        return SlicedConv2D(**conv_args)(inputs)
+    raise ValueError(f'Unknown dense_conv {dense_conv}, one of {DENSE_CONVS}')
+
+
+def growth_list(growth_channels):
+    # one growth width per conv of the block, an int is the same for all four
+    if isinstance(growth_channels, (list, tuple)):
+        return list(growth_channels)
+    return [growth_channels] * 4
+
+
+def residual_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), channels=64, growth_channels=32,
+                         dense_conv='concat'):
+    """growth_channels: int, or 4 ints (one per growth conv, e.g. of a pruned block)
+    dense_conv: 'concat' or 'sliced' (no concatenation copies, same weights)"""
     identity = x
-    out1 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(x)
+    growth = growth_list(growth_channels)
+    out1 = dense_conv_3x3([x], growth[0], kernel_initializer, dense_conv)
     out1 = LeakyReLU(alpha=0.2)(out1)
-    out2 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1]))
+    out2 = dense_conv_3x3([x, out1], growth[1], kernel_initializer, dense_conv)
     out2 = LeakyReLU(alpha=0.2)(out2)
-    out3 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2]))
+    out3 = dense_conv_3x3([x, out1, out2], growth[2], kernel_initializer, dense_conv)
     out3 = LeakyReLU(alpha=0.2)(out3)
-    out4 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2, out3]))
+    out4 = dense_conv_3x3([x, out1, out2, out3], growth[3], kernel_initializer, dense_conv)
     out4 = LeakyReLU(alpha=0.2)(out4)
-    out5 = Conv2D(filters=64,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2, out3, out4]))
+    out5 = dense_conv_3x3([x, out1, out2, out3, out4], channels, kernel_initializer, dense_conv)
     out = out5 * 0.2
-    return add([identity, out])
+    return tag_block(identity, add([identity, out]), 'rdb')
 
 
-def dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), residual_scaling=0.2):
-    out1 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(x)
+def dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), residual_scaling=0.2, channels=64,
+                growth_channels=32, dense_conv='concat'):
+    out1 = dense_conv_3x3([x], growth_channels, kernel_initializer, dense_conv)
     out1 = LeakyReLU(alpha=0.2)(out1)
-    out2 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1]))
+    out2 = dense_conv_3x3([x, out1], growth_channels, kernel_initializer, dense_conv)
     out2 = LeakyReLU(alpha=0.2)(out2)
-    out3 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2]))
+    out3 = dense_conv_3x3([x, out1, out2], growth_channels, kernel_initializer, dense_conv)
     out3 = LeakyReLU(alpha=0.2)(out3)
-    out4 = Conv2D(filters=32,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2, out3]))
+    out4 = dense_conv_3x3([x, out1, out2, out3], growth_channels, kernel_initializer, dense_conv)
     out4 = LeakyReLU(alpha=0.2)(out4)
-    out5 = Conv2D(filters=64,
-                  kernel_size=(3, 3),
-                  strides=(1, 1),
-                  padding='same',
-                  kernel_initializer=kernel_initializer, )(concatenate([x, out1, out2, out3, out4]))
+    out5 = dense_conv_3x3([x, out1, out2, out3, out4], channels, kernel_initializer, dense_conv)
     out = out5 * residual_scaling
     return out
@@ -3,19 +3,23 @@ from tensorflow.keras.layers import add, concatenate, Conv2D
 from models.backbone.RDB import dense_block
 
 
-def rfa_3(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
+def rfa_3(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), channels=64, growth_channels=32,
+          dense_conv='concat'):
     """residual feature aggregate block"""
     identity = x
     out1 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = add([x, out1])
     out2 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = add([x, out2])
     out3 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = concatenate([out1, out2, out3])
-    x = Conv2D(filters=64,
+    x = Conv2D(filters=channels,
                kernel_size=(1, 1),
                strides=(1, 1),
                padding='same',
@@ -23,22 +27,27 @@ def rfa_3(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
     return add([x, identity])
 
 
-def rfa(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
+def rfa(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), channels=64, growth_channels=32,
+        dense_conv='concat'):
     """residual feature aggregate block"""
     identity = x
     out1 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = add([x, out1])
     out2 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = add([x, out2])
     out3 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = add([x, out3])
     out4 = dense_block(
-        x, kernel_initializer=kernel_initializer, residual_scaling=1)
+        x, kernel_initializer=kernel_initializer, residual_scaling=1,
+        channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
     x = concatenate([out1, out2, out3, out4])
-    x = Conv2D(filters=64,
+    x = Conv2D(filters=channels,
                kernel_size=(1, 1),
                strides=(1, 1),
                padding='same',
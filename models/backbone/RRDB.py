@@ -2,21 +2,33 @@ import tensorflow as tf
 from tensorflow.keras.layers import add
 from models.backbone.RDB import residual_dense_block
 from models.attention import ChannelAttention
+from utils.model_walk import tag_block
 
 
-def residual_in_residual_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
+def rdb_growth(growth_channels, k):
+    # growth_channels: int, or one entry per rdb (int or 4 ints)
+    return growth_channels[k] if isinstance(growth_channels, (list, tuple)) else growth_channels
+
+
+def residual_in_residual_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal(), channels=64,
+                                     growth_channels=32, dense_conv='concat'):
     identity = x
-    for _ in range(3):
-        x = residual_dense_block(x, kernel_initializer=kernel_initializer)
+    for k in range(3):
+        x = residual_dense_block(x, kernel_initializer=kernel_initializer,
+                                 channels=channels, growth_channels=rdb_growth(growth_channels, k),
+                                 dense_conv=dense_conv)
     x = x * 0.2
-    return add([x, identity])
+    return tag_block(identity, add([x, identity]), 'rrdb')
 
 
-def residual_in_residual_channel_attention_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal()):
+def residual_in_residual_channel_attention_dense_block(x, kernel_initializer=tf.keras.initializers.GlorotNormal(),
+                                                       channels=64, growth_channels=32, dense_conv='concat'):
     identity = x
-    for _ in range(3):
-        x = residual_dense_block(x, kernel_initializer=kernel_initializer)
+    for k in range(3):
+        x = residual_dense_block(x, kernel_initializer=kernel_initializer,
+                                 channels=channels, growth_channels=rdb_growth(growth_channels, k),
+                                 dense_conv=dense_conv)
     x = x * 0.2
     x = ChannelAttention(
         reduction=16, kernel_initializer=kernel_initializer)(x)
-    return add([x, identity])
+    return tag_block(identity, add([x, identity]), 'rrdb_ca')
@@ -0,0 +1,84 @@
+import numpy as np
+import tensorflow as tf
+import yaml
+from tensorflow.keras.layers import Layer, Conv2D
+
+
+class LowRankConv2D(Layer):
+    """3x3 'same' conv as a 3x1 conv (input channels -> rank) followed by a 1x3 conv (rank -> filters),
+    3 * rank * (input channels + filters) instead of 9 * input channels * filters MACs per pixel.
+    Zero padding commutes with the split, a full rank pair is exactly the 3x3 conv.
+    """
+
+    def __init__(self, filters, rank, use_bias=True, activation=None, **kwargs):
+        super().__init__(**kwargs)
+        self.filters = filters
+        self.rank = rank
+        self.use_bias = use_bias
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        channels = int(input_shape[-1])
+        self.vertical_kernel = self.add_weight(name='vertical_kernel', shape=(3, 1, channels, self.rank),
+                                               initializer='glorot_normal', trainable=True)
+        self.horizontal_kernel = self.add_weight(name='horizontal_kernel', shape=(1, 3, self.rank, self.filters),
+                                                 initializer='glorot_normal', trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(self.filters,), initializer='zeros', trainable=True)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        x = tf.nn.conv2d(inputs, self.vertical_kernel, strides=1, padding='SAME')
+        x = tf.nn.conv2d(x, self.horizontal_kernel, strides=1, padding='SAME')
+        if self.use_bias:
+            x = tf.nn.bias_add(x, self.bias)
+        return self.activation(x)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'filters': self.filters, 'rank': self.rank, 'use_bias': self.use_bias,
+                       'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+
+def factorizable_convs(model):
+    """3x3 stride 1 'same' Conv2D layers of a model in layer order, the conv indices of conv_ranks.
+    Subclasses (SlicedConv2D of dense_conv='sliced') are left out"""
+    return [layer for layer in model.layers
+            if type(layer) is Conv2D and tuple(layer.kernel_size) == (3, 3) and tuple(layer.strides) == (1, 1)
+            and tuple(layer.dilation_rate) == (1, 1) and layer.groups == 1 and layer.padding == 'same']
+
+
+def low_rank_model(model, conv_ranks):
+    """model with the convs of conv_ranks {conv index: rank} replaced by LowRankConv2D,
+    every other layer is shared with model (and keeps its weights)"""
+    convs = factorizable_convs(model)
+    ranks = {id(convs[int(index)]): int(rank) for index, rank in conv_ranks.items()}
+
+    def clone_layer(layer):
+        if id(layer) not in ranks:
+            return layer
+        low_rank = LowRankConv2D(filters=layer.filters, rank=ranks[id(layer)], use_bias=layer.use_bias,
+                                 activation=layer.activation, name=layer.name + '_low_rank')
+        low_rank.block_path = getattr(layer, 'block_path', '')
+        return low_rank
+
+    return tf.keras.models.clone_model(model, clone_function=clone_layer)
+
+
+def svd_factors(kernel, rank):
+    """(vertical kernel, horizontal kernel) of the best rank-r 3x1 + 1x3 pair of a (3, 3, c_in, c_out) kernel
+    and the energy (sum of squared singular values) it keeps.
+    w[i, j, c, o] ~ sum_r v[i, c, r] h[j, r, o]: svd of w as a (3 * c_in, 3 * c_out) matrix"""
+    kh, kw, c_in, c_out = kernel.shape
+    matrix = kernel.transpose(0, 2, 1, 3).reshape(kh * c_in, kw * c_out)
+    u, s, vt = np.linalg.svd(matrix, full_matrices=False)
+    root = np.sqrt(s[:rank])
+    vertical = (u[:, :rank] * root).reshape(kh, 1, c_in, rank)
+    horizontal = (root[:, None] * vt[:rank]).reshape(rank, kw, c_out).transpose(1, 0, 2)[None]
+    return vertical, horizontal, float((s[:rank] ** 2).sum() / (s ** 2).sum())
+
+
+def load_conv_ranks(conv_ranks_file):
+    with open(conv_ranks_file, 'r') as f:
+        return {int(index): int(rank) for index, rank in yaml.safe_load(f).items()}
@@ -1,144 +1,233 @@
+import yaml
 import tensorflow as tf
 from tensorflow.keras.layers import Input, Conv2D, BatchNormalization, LeakyReLU, UpSampling2D, Flatten, Dense, add, Lambda, concatenate
 from tensorflow.keras.models import Model
 from utils.conv2D_args import k3n64s1, k3n3s1
-from models.backbone.RRDB import residual_in_residual_channel_attention_dense_block
+from models.backbone.RB import residual_block_crc
+from models.backbone.RCAB import rcab
+from models.backbone.RDB import residual_dense_block, DENSE_CONVS
+from models.backbone.RRDB import residual_in_residual_dense_block, residual_in_residual_channel_attention_dense_block
+from models.backbone.RFA import rfa
+from models.backbone.RFB import receptive_field_block
+from models.backbone.RFDB import receptive_field_dense_block
+from models.backbone.RRFDB import residual_of_receptive_field_dense_block
 from train_utils.sn import SpectralNormalization
 from models.attention import in_scale_non_local_attention_residual_block, CrossScaleNonLocalAttention
+from models.low_rank import low_rank_model, load_conv_ranks
+from utils.model_walk import tag_block
+from utils.runtime import is_reduced_precision
+
+TIERS_FILE = 'configs/generator_tiers.yaml'
+BLOCK_TYPES = ['rrdb_ca', 'rrdb', 'rdb', 'rb', 'rcab', 'rfa', 'rfb', 'rfdb', 'rrfdb']
+UPSAMPLERS = ['nearest', 'pixel_shuffle', 'nearest_pixel_shuffle']
+
+
+def trunk_block(x, block_type, channels=64, growth_channels=32, kernel_initializer=tf.keras.initializers.GlorotNormal(),
+                dense_conv='concat'):
+    """one block of the generator trunk, channels in = channels out, dense_conv only applies to rdb based blocks"""
+    if block_type == 'rrdb_ca':
+        out = residual_in_residual_channel_attention_dense_block(
+            x, kernel_initializer=kernel_initializer, channels=channels, growth_channels=growth_channels,
+            dense_conv=dense_conv)
+    elif block_type == 'rrdb':
+        out = residual_in_residual_dense_block(
+            x, kernel_initializer=kernel_initializer, channels=channels, growth_channels=growth_channels,
+            dense_conv=dense_conv)
+    elif block_type == 'rdb':
+        out = residual_dense_block(
+            x, kernel_initializer=kernel_initializer, channels=channels, growth_channels=growth_channels,
+            dense_conv=dense_conv)
+    elif block_type == 'rb':
+        out = residual_block_crc(
+            x, filter_num=channels, kernel_initializer=kernel_initializer)
+    elif block_type == 'rcab':
+        out = rcab(x, channels=channels, kernel_initializer=kernel_initializer)
+    elif block_type == 'rfa':
+        out = rfa(x, kernel_initializer=kernel_initializer,
+                  channels=channels, growth_channels=growth_channels, dense_conv=dense_conv)
+    elif block_type == 'rfb':
+        out = receptive_field_block(x, input_channels=channels, output_channels=channels,
+                                    kernel_initializer=kernel_initializer)
+    elif block_type == 'rfdb':
+        out = receptive_field_dense_block(x, channels=channels, growth_channels=growth_channels,
+                                          kernel_initializer=kernel_initializer)
+    elif block_type == 'rrfdb':
+        out = residual_of_receptive_field_dense_block(x, channels=channels, growth_channels=growth_channels,
+                                                      kernel_initializer=kernel_initializer)
+    else:
+        raise ValueError(f'Unknown block_type {block_type}, one of {BLOCK_TYPES}')
+    return tag_block(x, out, block_type)
+
+
+def build_generator(block_type='rrdb_ca', num_blocks=23, channels=64, growth_channels=32,
+                    attention_type='global', attention_every=6, window_size=8,
+                    cross_scale_attention=True, cross_scale_top_k=0,
+                    upsampler='nearest_pixel_shuffle', scale=4, dense_conv='concat', conv_ranks=None,
+                    kernel_initializer=tf.keras.initializers.GlorotNormal()):
+    """
+    shallow conv -> [attention] -> num_blocks trunk blocks with attention after every attention_every blocks
+    -> conv + long skip -> [attention] -> upsampler -> [concat cross-scale attention outputs] -> reconstruction.
+    attention_every=0: no in-scale and no cross-scale attention.
+    cross-scale attention (one per in-scale attention) upsamples by `scale` itself and joins at the reconstruction.
+    growth_channels: int, or one entry per trunk block (rdb: 4 ints, rrdb / rrdb_ca: 3 x 4 ints), as written by prune.py
+    dense_conv: convs of the dense blocks on 'concat' (concatenate + Conv2D) or 'sliced' (SlicedConv2D, no
+    concatenation copies), same weights, .h5 weights load into either
+    conv_ranks: {3x3 conv index: rank}, those convs become rank-r 3x1 + 1x3 pairs (LowRankConv2D), as written by
+    compress_conv.py
+    upsampler, per x2 stage: 'nearest' (nearest + conv), 'pixel_shuffle' (conv + depth_to_space),
+    'nearest_pixel_shuffle' (nearest stages, last stage pixel shuffle)
+    """
+    num_stages = scale.bit_length() - 1
+    if 2 ** num_stages != scale:
+        raise ValueError(f'scale {scale} is not a power of 2')
+    if upsampler not in UPSAMPLERS:
+        raise ValueError(f'Unknown upsampler {upsampler}, one of {UPSAMPLERS}')
+    if dense_conv not in DENSE_CONVS:
+        raise ValueError(f'Unknown dense_conv {dense_conv}, one of {DENSE_CONVS}')
+    conv_args = dict(k3n64s1, filters=channels)
+    cross_scale_outputs = []
+    num_attention = 0
+
+    def attention(x):
+        nonlocal num_attention
+        # windows are shifted in every other attention block
+        x = in_scale_non_local_attention_residual_block(
+            input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer,
+            attention_type=attention_type, window_size=window_size,
+            shift=0 if num_attention % 2 == 0 else window_size // 2)
+        num_attention += 1
+        if cross_scale_attention:
+            cross_scale_outputs.append(CrossScaleNonLocalAttention(channel_reduction=2, scale=scale, patch_size=3,
+                                                                   softmax_factor=10, kernel_initializer=kernel_initializer,
+                                                                   top_k=cross_scale_top_k)(x))
+        return x
 
-
-def generator(kernel_initializer=tf.keras.initializers.GlorotNormal()):
     inputs = Input(shape=(None, None, 3))
     # pre-process
     x = tf.keras.layers.Rescaling(scale=1.0 / 255)(inputs)
+
     # shallow extraction
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
+    x = Conv2D(kernel_initializer=kernel_initializer, **conv_args)(x)
+    if attention_every:
+        x = attention(x)
 
     # trunk
     lsc = x
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-
-    for _ in range(5):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = add([x, lsc])
-
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    # upsample nearest
-    x = UpSampling2D(size=(2, 2), interpolation='nearest')(x)
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = LeakyReLU(alpha=0.2)(x)
+    for i in range(num_blocks):
+        block_growth = growth_channels[i] if isinstance(growth_channels, (list, tuple)) else growth_channels
+        x = trunk_block(x, block_type, channels=channels, growth_channels=block_growth,
+                        kernel_initializer=kernel_initializer, dense_conv=dense_conv)
+        if attention_every and (i + 1) % attention_every == 0 and i + 1 < num_blocks:
+            x = attention(x)
+
+    x = Conv2D(kernel_initializer=kernel_initializer, **conv_args)(x)
+    # named, distillation reads the trunk features from here
+    x = add([x, lsc], name='trunk_output')
+    if attention_every:
+        x = attention(x)
+
+    # upsample
+    upsampler_input = x
+    for stage in range(num_stages):
+        last_stage = stage == num_stages - 1
+        if upsampler == 'nearest' or (upsampler == 'nearest_pixel_shuffle' and not last_stage):
+            x = UpSampling2D(size=(2, 2), interpolation='nearest')(x)
+            x = Conv2D(kernel_initializer=kernel_initializer, **conv_args)(x)
+            x = LeakyReLU(alpha=0.2)(x)
+        else:
+            x = Conv2D(filters=4 * channels,
+                       kernel_size=(3, 3),
+                       strides=(1, 1),
+                       padding='same',
+                       kernel_initializer=kernel_initializer)(x)
+            x = tf.nn.depth_to_space(x, block_size=2)
+            if not last_stage:
+                x = LeakyReLU(alpha=0.2)(x)
+    tag_block(upsampler_input, x, 'upsampler')
 
     # reconstruct
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
+    if cross_scale_outputs:
+        x = concatenate([x] + cross_scale_outputs[::-1], axis=-1)
+    x = Conv2D(kernel_initializer=kernel_initializer, **conv_args)(x)
     x = LeakyReLU(alpha=0.2)(x)
     x = Conv2D(kernel_initializer=kernel_initializer, **k3n3s1)(x)
 
     # post-process
-    outputs = tf.keras.layers.Rescaling(scale=255)(x)
+    if is_reduced_precision():
+        # reduced precision inference (utils/runtime.set_inference_precision): float32 output, clamped first
+        x = Lambda(lambda t: tf.clip_by_value(t, 0.0, 1.0), dtype='float32')(x)
+        outputs = tf.keras.layers.Rescaling(scale=255, dtype='float32')(x)
+    else:
+        outputs = tf.keras.layers.Rescaling(scale=255)(x)
     model = Model(inputs=inputs, outputs=outputs)
+    if conv_ranks:
+        model = low_rank_model(model, conv_ranks)
     print(model.summary())
     return model
 
 
-def generator_x4(kernel_initializer=tf.keras.initializers.GlorotNormal()):
-    # inputs = Input(shape=(input_height, input_width, 3))
-    inputs = Input(shape=(None, None, 3))
-    # pre-process
-    x = tf.keras.layers.Rescaling(scale=1.0 / 255)(inputs)
-
-    # shallow extraction
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    c1 = CrossScaleNonLocalAttention(channel_reduction=2, scale=4, patch_size=3,
-                                     softmax_factor=10, kernel_initializer=kernel_initializer)(x)
-
-    # trunk
-    lsc = x
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    c2 = CrossScaleNonLocalAttention(channel_reduction=2, scale=4, patch_size=3,
-                                     softmax_factor=10, kernel_initializer=kernel_initializer)(x)
-
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    c3 = CrossScaleNonLocalAttention(channel_reduction=2, scale=4, patch_size=3,
-                                     softmax_factor=10, kernel_initializer=kernel_initializer)(x)
-
-    for _ in range(6):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    c4 = CrossScaleNonLocalAttention(channel_reduction=2, scale=4, patch_size=3,
-                                     softmax_factor=10, kernel_initializer=kernel_initializer)(x)
-
-    for _ in range(5):
-        x = residual_in_residual_channel_attention_dense_block(
-            x, kernel_initializer=kernel_initializer)
-
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = add([x, lsc])
-
-    x = in_scale_non_local_attention_residual_block(
-        input_tensor=x, channel_reduction=2, softmax_factor=6, kernel_initializer=kernel_initializer)
-    c5 = CrossScaleNonLocalAttention(channel_reduction=2, scale=4, patch_size=3,
-                                     softmax_factor=10, kernel_initializer=kernel_initializer)(x)
-    # upsample nearest
-    x = UpSampling2D(size=(2, 2), interpolation='nearest')(x)
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = LeakyReLU(alpha=0.2)(x)
-    # x = UpSampling2D(size=(2, 2), interpolation='nearest',
-    #                  name='additional_start_layer')(x)
-    # x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    # x = LeakyReLU(alpha=0.2, name='additional_end_layer')(x)
-    x = Conv2D(filters=256,
-               kernel_size=(3, 3),
-               strides=(1, 1),
-               padding='same',
-               kernel_initializer=kernel_initializer)(x)
-    x = tf.nn.depth_to_space(x, block_size=2)
-
-    # reconstruct
-    x = concatenate([x, c5, c4, c3, c2, c1], axis=-1)
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n64s1)(x)
-    x = LeakyReLU(alpha=0.2)(x)
-    x = Conv2D(kernel_initializer=kernel_initializer, **k3n3s1)(x)
-
-    # post-process
-    outputs = tf.keras.layers.Rescaling(scale=255)(x)
-    model = Model(inputs=inputs, outputs=outputs)
-    print(model.summary())
-    return model
+def load_tier(tier, tiers_file=TIERS_FILE):
+    """build_generator arguments of a named tier (latency entries dropped)"""
+    with open(tiers_file, 'r') as f:
+        tiers = yaml.safe_load(f)
+    if tier not in tiers:
+        raise KeyError(f'Unknown generator tier {tier}, one of {list(tiers)}')
+    return {key: value for key, value in tiers[tier].items() if not key.startswith('cpu_latency')}
+
+
+def generator_from_settings(tier='', architecture=None, **kwargs):
+    """build_generator from a tier and / or explicit build_generator arguments (these win), neither: generator_x4"""
+    settings = load_tier(tier) if tier else {}
+    settings.update(architecture or {})
+    settings.update(kwargs)
+    return build_generator(**settings)
+
+
+def generator_settings(cfg):
+    """build_generator arguments of the model section of a psnr / gan config, model.tier replaces the architecture keys"""
+    settings = {
+        'block_type': cfg.block_type,
+        'num_blocks': cfg.num_blocks,
+        'channels': cfg.model_channels,
+        'growth_channels': cfg.growth_channels,
+        'attention_type': cfg.attention_type,
+        'attention_every': cfg.attention_every,
+        'window_size': cfg.window_size,
+        'cross_scale_attention': cfg.cross_scale_attention,
+        'cross_scale_top_k': cfg.cross_scale_top_k,
+        'upsampler': cfg.upsampler,
+        'scale': cfg.upscale_factor,
+        'dense_conv': cfg.dense_conv,
+    }
+    if cfg.tier:
+        settings.update(load_tier(cfg.tier))
+    if cfg.conv_ranks_file:
+        settings['conv_ranks'] = load_conv_ranks(cfg.conv_ranks_file)
+    return settings
+
+
+def generator_from_config(cfg, **kwargs):
+    """generator of the model section of a psnr / gan config"""
+    settings = generator_settings(cfg)
+    settings.update(kwargs)
+    return build_generator(**settings)
+
+
+def generator(kernel_initializer=tf.keras.initializers.GlorotNormal(), attention_type='global', window_size=8):
+    # attention_type 'window': windowed in-scale attention, shifted by window_size // 2 in every other block
+    return build_generator(block_type='rrdb_ca', num_blocks=23, attention_type=attention_type,
+                           attention_every=6, window_size=window_size, cross_scale_attention=False,
+                           upsampler='nearest', scale=2, kernel_initializer=kernel_initializer)
+
+
+def generator_x4(kernel_initializer=tf.keras.initializers.GlorotNormal(), attention_type='global', window_size=8,
+                 cross_scale_top_k=0):
+    # attention_type 'window': windowed in-scale attention, shifted by window_size // 2 in every other block
+    # cross_scale_top_k > 0: cross-scale attention reconstructs from the top k matching patches only
+    return build_generator(block_type='rrdb_ca', num_blocks=23, attention_type=attention_type,
+                           attention_every=6, window_size=window_size, cross_scale_attention=True,
+                           cross_scale_top_k=cross_scale_top_k, upsampler='nearest_pixel_shuffle', scale=4,
+                           kernel_initializer=kernel_initializer)
 
 
 def discriminator_model(filter_num=64):
@@ -0,0 +1,210 @@
+"""Static cost of generator / generator_x4 / discriminator_model_sn or a generator tier for given LR sizes:
+MACs, parameters and activation size per layer (analytic for the attention layers), aggregated by block
+(rrdb_ca, rdb, attention, cross_scale_attention, upsampler, ...). Nothing is executed, the model is only traced.
+
+python profile_flops.py --model generator_x4 --lr_sizes 64 128 256x192 --json outputs/logs/flops_x4.json
+"""
+import sys
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, Dense
+
+from models.model_builder import generator, generator_x4, discriminator_model_sn, build_generator, load_tier
+from models.attention import CrossScaleNonLocalAttention, InsclaeNonLocalAttention, WindowNonLocalAttention, \
+    ChannelAttention
+from models.low_rank import LowRankConv2D
+from utils.model_walk import walk_layers
+
+MODELS = {
+    'generator': generator,
+    'generator_x4': generator_x4,
+    'discriminator_model_sn': discriminator_model_sn,
+}
+
+
+def num_elements(shape):
+    return int(np.prod(shape))
+
+
+def layer_macs(layer, input_shape, output_shape):
+    """multiply-accumulates of one call, element-wise ops are not counted"""
+    # e.g. SpectralNormalization wraps the conv that does the work
+    layer = getattr(layer, 'layer', layer)
+    if isinstance(layer, Conv2D):
+        kh, kw = layer.kernel_size
+        # per group, and over all inputs of a SlicedConv2D
+        in_channels = int(layer.kernel.shape[2])
+        return num_elements(output_shape) * kh * kw * in_channels
+    if isinstance(layer, LowRankConv2D):
+        # 3x1 conv at rank channels + 1x3 conv
+        return num_elements(output_shape[:-1]) * 3 * layer.rank * (input_shape[-1] + layer.filters)
+    if isinstance(layer, Dense):
+        return num_elements(output_shape) * input_shape[-1]
+    b, h, w, c = input_shape[:4] if len(input_shape) == 4 else (0, 0, 0, 0)
+    if isinstance(layer, ChannelAttention):
+        return b * 2 * c * (c // layer.reduction)
+    if isinstance(layer, InsclaeNonLocalAttention):
+        ci = c // layer.channel_reduction
+        # theta/phi/g/y convs + attention map + weighted sum
+        return b * (h * w * 4 * c * ci + 2 * (h * w) ** 2 * ci)
+    if isinstance(layer, WindowNonLocalAttention):
+        ci = c // layer.channel_reduction
+        ws = layer.window_size
+        padded_pixels = -(-h // ws) * ws * -(-w // ws) * ws
+        return b * (h * w * 4 * c * ci + 2 * padded_pixels * ws * ws * ci)
+    if isinstance(layer, CrossScaleNonLocalAttention):
+        ci = c // layer.channel_reduction
+        s, p = layer.scale, layer.patch_size
+        n = (h // s) * (w // s)
+        projections = h * w * c * ci + n * c * ci + h * w * c * c
+        matching = h * w * n * p * p * ci
+        # every location adds (s*p)^2*c values from each of its patches
+        patches = min(layer.top_k, n) if layer.top_k > 0 else n
+        reconstruction = h * w * patches * (s * p) ** 2 * c
+        return b * (projections + matching + reconstruction)
+    return 0
+
+
+def output_shape_of(layer, input_shape, outputs):
+    shape = tf.nest.flatten(outputs)[0].shape
+    if shape.is_fully_defined():
+        return shape.as_list()
+    # reshapes with dynamic sizes inside the attention layers
+    if isinstance(layer, CrossScaleNonLocalAttention):
+        b, h, w, c = input_shape
+        return [b, h * layer.scale, w * layer.scale, c]
+    return list(input_shape)
+
+
+def block_of(layer):
+    """outermost and innermost block of a layer, untagged attention layers by class"""
+    path = getattr(layer, 'block_path', '')
+    if not path:
+        if isinstance(layer, CrossScaleNonLocalAttention):
+            path = 'cross_scale_attention'
+        elif isinstance(layer, (InsclaeNonLocalAttention, WindowNonLocalAttention)):
+            path = 'attention'
+        else:
+            path = 'other'
+    blocks = path.split('/')
+    return blocks[0], blocks[-1]
+
+
+def profile_flops(model, input_shape, dtype_size=4):
+    rows = []
+
+    def record_layer(layer, args, kwargs):
+        outputs = layer(*args, **kwargs)
+        input_shape = [t.shape.as_list() for t in tf.nest.flatten(args) if hasattr(t, 'shape')][0]
+        output_shape = output_shape_of(layer, input_shape, outputs)
+        outer_block, inner_block = block_of(layer)
+        rows.append({
+            'layer': layer.name,
+            'type': type(layer).__name__,
+            'block': outer_block,
+            'inner_block': inner_block,
+            'input_shape': input_shape,
+            'output_shape': output_shape,
+            'macs': layer_macs(layer, input_shape, output_shape),
+            'params': layer.count_params(),
+            'activation_bytes': num_elements(output_shape) * dtype_size,
+        })
+        return outputs
+
+    # trace only, shapes are static inside the graph
+    @tf.function
+    def trace(x):
+        return walk_layers(model, x, run_layer=record_layer)
+
+    trace.get_concrete_function(tf.TensorSpec(input_shape, tf.float32))
+    return rows
+
+
+def aggregate(rows, key):
+    groups = {}
+    for r in rows:
+        group = groups.setdefault(r[key], {key: r[key], 'layers': 0, 'macs': 0, 'params': 0,
+                                           'activation_bytes': 0})
+        group['layers'] += 1
+        group['macs'] += r['macs']
+        group['params'] += r['params']
+        group['activation_bytes'] += r['activation_bytes']
+    return sorted(groups.values(), key=lambda g: g['macs'], reverse=True)
+
+
+def print_table(groups, key, total_macs):
+    print(f"{key:<24}{'layers':>8}{'GMACs':>12}{'%':>8}{'params (K)':>12}{'act MB':>10}")
+    for g in groups:
+        share = 100 * g['macs'] / total_macs if total_macs else 0
+        print(f"{g[key]:<24}{g['layers']:>8}{g['macs'] / 1e9:>12.3f}{share:>8.1f}"
+              f"{g['params'] / 1e3:>12.1f}{g['activation_bytes'] / 2 ** 20:>10.1f}")
+
+
+def parse_size(size):
+    # '64' -> (64, 64), '128x96' -> (128, 96), height x width
+    if 'x' in size:
+        height, width = size.split('x')
+        return int(height), int(width)
+    return int(size), int(size)
+
+
+def report(model_name, lr_sizes, batch_size, json_file, print_layers=False, **model_kwargs):
+    if model_name.startswith('tier:'):
+        model = build_generator(**load_tier(model_name[len('tier:'):]))
+    elif model_name == 'discriminator_model_sn':
+        model = MODELS[model_name]()
+        # fixed input shape
+        lr_sizes = [(128, 128)]
+    else:
+        model = MODELS[model_name](**model_kwargs)
+    results = []
+    for height, width in lr_sizes:
+        rows = profile_flops(model, (batch_size, height, width, 3))
+        total_macs = sum(r['macs'] for r in rows)
+        by_block = aggregate(rows, 'block')
+        by_inner_block = aggregate(rows, 'inner_block')
+        print(f"\n{model_name} input {batch_size}x{height}x{width}: {total_macs / 1e9:.2f} GMACs, "
+              f"{model.count_params() / 1e6:.2f} M params, "
+              f"activations {sum(r['activation_bytes'] for r in rows) / 2 ** 20:.1f} MB "
+              f"(largest {max(r['activation_bytes'] for r in rows) / 2 ** 20:.1f} MB)")
+        print_table(by_block, 'block', total_macs)
+        print()
+        print_table(by_inner_block, 'inner_block', total_macs)
+        if print_layers:
+            print(f"\n{'layer':<40}{'type':<32}{'block':<24}{'MMACs':>12}{'params':>10}{'act MB':>10}")
+            for r in rows:
+                print(f"{r['layer']:<40}{r['type']:<32}{r['block'] + '/' + r['inner_block']:<24}"
+                      f"{r['macs'] / 1e6:>12.1f}{r['params']:>10}{r['activation_bytes'] / 2 ** 20:>10.2f}")
+        results.append({'height': height, 'width': width, 'macs': total_macs,
+                        'params': model.count_params(), 'blocks': by_block,
+                        'inner_blocks': by_inner_block, 'layers': rows})
+    summary = {'model': model_name, 'batch_size': batch_size, 'model_kwargs': model_kwargs,
+               'results': results}
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=list(MODELS), default='generator_x4')
+    parser.add_argument('--lr_sizes', nargs='+', default=['64'], help='64 or HEIGHTxWIDTH')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--attention_type', choices=['global', 'window'], default='global')
+    parser.add_argument('--window_size', type=int, default=8)
+    parser.add_argument('--cross_scale_top_k', type=int, default=0)
+    parser.add_argument('--tier', default='', help='generator tier of configs/generator_tiers.yaml instead of --model')
+    parser.add_argument('--layers', action='store_true', help='print every layer')
+    parser.add_argument('--json', default='')
+    args = parser.parse_args()
+    model_kwargs = {'attention_type': args.attention_type, 'window_size': args.window_size}
+    if args.model == 'generator_x4':
+        model_kwargs['cross_scale_top_k'] = args.cross_scale_top_k
+    if args.tier:
+        args.model, model_kwargs = 'tier:' + args.tier, {}
+    report(args.model, [parse_size(size) for size in args.lr_sizes], args.batch_size, args.json,
+           print_layers=args.layers, **model_kwargs)
@@ -0,0 +1,140 @@
+"""Layer by layer memory of generator / generator_x4 / discriminator_model_sn for given input sizes.
+Reports activation bytes per layer (plus the attention maps held inside the attention layers),
+the allocator peak while the layer runs (GPU) and the top offenders, and fits
+peak = a + b * pixels + c * pixels^2 over the sizes.
+
+python profile_memory.py --model generator_x4 --sizes 32 48 64 --json outputs/logs/memory_x4.json
+"""
+import sys
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from models.model_builder import generator, generator_x4, discriminator_model_sn
+from models.attention import CrossScaleNonLocalAttention, InsclaeNonLocalAttention, WindowNonLocalAttention
+from utils.model_walk import walk_layers
+from utils.memory import device_memory_info, reset_device_peak, process_rss_bytes
+
+MODELS = {
+    'generator': generator,
+    'generator_x4': generator_x4,
+    'discriminator_model_sn': discriminator_model_sn,
+}
+
+
+def tensor_bytes(tensors):
+    return sum(int(np.prod(t.shape)) * t.dtype.size for t in tf.nest.flatten(tensors) if hasattr(t, 'dtype'))
+
+
+def attention_internal_bytes(layer, input_shape, dtype_size=4):
+    """bytes of the attention maps an attention layer builds internally (logits + softmax)"""
+    b, h, w, c = input_shape
+    if isinstance(layer, InsclaeNonLocalAttention):
+        return 2 * b * (h * w) ** 2 * dtype_size
+    if isinstance(layer, WindowNonLocalAttention):
+        ws = layer.window_size
+        padded_pixels = -(-h // ws) * ws * -(-w // ws) * ws
+        return 2 * b * padded_pixels * ws * ws * dtype_size
+    if isinstance(layer, CrossScaleNonLocalAttention):
+        n = (h // layer.scale) * (w // layer.scale)
+        sp = layer.scale * layer.patch_size
+        # maps of one image at a time (map_fn) + phi and g patches of the batch
+        maps = 2 * h * w * n * dtype_size
+        patches = b * n * (layer.patch_size ** 2 * (c // layer.channel_reduction) + sp * sp * c) * dtype_size
+        return maps + patches
+    return 0
+
+
+def profile_model(model, input_shape):
+    rows = []
+
+    def run_layer(layer, args, kwargs):
+        reset_device_peak()
+        before = device_memory_info()
+        rss_before = process_rss_bytes()
+        outputs = layer(*args, **kwargs)
+        for t in tf.nest.flatten(outputs):
+            if hasattr(t, 'numpy'):
+                t.numpy()
+        after = device_memory_info()
+        layer_input = tf.nest.flatten(args)[0]
+        row = {
+            'layer': layer.name,
+            'type': type(layer).__name__,
+            'output_shape': [list(t.shape) for t in tf.nest.flatten(outputs) if hasattr(t, 'shape')],
+            'activation_bytes': tensor_bytes(outputs),
+            'internal_bytes': attention_internal_bytes(layer, tuple(layer_input.shape))
+            if hasattr(layer_input, 'shape') and len(layer_input.shape) == 4 else 0,
+            'rss_delta_bytes': process_rss_bytes() - rss_before,
+        }
+        if before is not None:
+            row['device_peak_bytes'] = after['peak'] - before['current']
+        rows.append(row)
+        return outputs
+
+    inputs = tf.random.uniform(input_shape, maxval=255)
+    walk_layers(model, inputs, run_layer=run_layer)
+    return rows
+
+
+def print_report(rows, size, top):
+    total = sum(r['activation_bytes'] for r in rows)
+    print(f'input {size}: {len(rows)} layers, activations {total / 2 ** 20:.1f} MB')
+    key = 'device_peak_bytes' if 'device_peak_bytes' in rows[0] else 'activation_bytes'
+    offenders = sorted(rows, key=lambda r: max(r[key], r['activation_bytes'] + r['internal_bytes']),
+                       reverse=True)[:top]
+    print(f"{'layer':<40}{'type':<32}{'act MB':>10}{'internal MB':>13}{'peak MB':>10}")
+    for r in offenders:
+        peak = r.get('device_peak_bytes', 0) / 2 ** 20
+        print(f"{r['layer']:<40}{r['type']:<32}{r['activation_bytes'] / 2 ** 20:>10.1f}"
+              f"{r['internal_bytes'] / 2 ** 20:>13.1f}{peak:>10.1f}")
+
+
+def fit_memory_model(results):
+    """least squares peak = a + b * pixels + c * pixels^2 over the profiled sizes"""
+    pixels = np.array([r['pixels'] for r in results], dtype=np.float64)
+    peaks = np.array([r['peak_bytes'] for r in results], dtype=np.float64)
+    design = np.stack([np.ones_like(pixels), pixels, pixels ** 2], axis=1)
+    coef, *_ = np.linalg.lstsq(design, peaks, rcond=None)
+    return {'a': coef[0], 'b': coef[1], 'c': coef[2]}
+
+
+def profile_memory(model_name, sizes, batch_size, top, json_file, attention_type='global', window_size=8):
+    if model_name == 'discriminator_model_sn':
+        model = MODELS[model_name]()
+    else:
+        model = MODELS[model_name](attention_type=attention_type, window_size=window_size)
+    if model_name == 'discriminator_model_sn':
+        # fixed input shape
+        sizes = [128]
+    results = []
+    for size in sizes:
+        rows = profile_model(model, (batch_size, size, size, 3))
+        print_report(rows, size, top)
+        peak = max(max(r.get('device_peak_bytes', 0), r['activation_bytes'] + r['internal_bytes']) for r in rows)
+        results.append({'size': size, 'pixels': batch_size * size * size, 'peak_bytes': peak, 'layers': rows})
+    summary = {'model': model_name, 'batch_size': batch_size, 'results': results}
+    if len(results) >= 3:
+        summary['fit'] = fit_memory_model(results)
+        print(f"peak bytes ~ {summary['fit']['a']:.3g} + {summary['fit']['b']:.3g} * pixels "
+              f"+ {summary['fit']['c']:.3g} * pixels^2")
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=list(MODELS), default='generator_x4')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--json', default='')
+    parser.add_argument('--attention_type', choices=['global', 'window'], default='global')
+    parser.add_argument('--window_size', type=int, default=8)
+    args = parser.parse_args()
+    profile_memory(args.model, args.sizes, args.batch_size, args.top, args.json,
+                   attention_type=args.attention_type, window_size=args.window_size)
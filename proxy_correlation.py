@@ -0,0 +1,75 @@
+"""How far the proxy validation (validation.proxy) can be trusted: over the history records that have both the proxy
+val_psnr and the full resolution full_val_psnr, the Pearson and Spearman correlation of the two, the iteration
+each one would pick as best and the full resolution psnr lost by picking on the proxy, and the validation speedup.
+
+python proxy_correlation.py
+python proxy_correlation.py -o checkpoint.history_file=outputs/sweeps/run_003/history.jsonl --plot proxy.png
+"""
+import json
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from utils.history import iter_history
+
+
+def ranks(values):
+    # average ranks, ties share theirs
+    order = np.argsort(values, kind='stable')
+    result = np.empty(len(values))
+    result[order] = np.arange(len(values))
+    for value in np.unique(values):
+        tied = values == value
+        result[tied] = result[tied].mean()
+    return result
+
+
+def proxy_correlation(history_file, plot_file=''):
+    records = [r for r in iter_history(history_file) if 'full_val_psnr' in r]
+    if len(records) < 3:
+        raise ValueError(f'{len(records)} records with full_val_psnr in {history_file}, need at least 3 '
+                         f'(validation.proxy with validation.full_every)')
+    iterations = np.array([r['iteration'] for r in records])
+    proxy = np.array([r['val_psnr'] for r in records])
+    full = np.array([r['full_val_psnr'] for r in records])
+    best_proxy = int(np.argmax(proxy))
+    best_full = int(np.argmax(full))
+    report = {
+        'num_records': len(records),
+        'pearson': float(np.corrcoef(proxy, full)[0, 1]),
+        'spearman': float(np.corrcoef(ranks(proxy), ranks(full))[0, 1]),
+        'best_proxy_iteration': int(iterations[best_proxy]),
+        'best_full_iteration': int(iterations[best_full]),
+        # full resolution psnr given up by selecting on the proxy
+        'selection_regret_db': float(full[best_full] - full[best_proxy]),
+        'mean_offset_db': float((full - proxy).mean()),
+    }
+    if all('val_seconds' in r and 'full_val_seconds' in r for r in records):
+        full_seconds = sum(r['full_val_seconds'] for r in records)
+        report['speedup'] = float(full_seconds / sum(r['val_seconds'] for r in records))
+    for key, value in report.items():
+        print(f'{key:<24}{value:.4f}' if isinstance(value, float) else f'{key:<24}{value}')
+
+    if plot_file:
+        plt.figure(figsize=(5, 5))
+        plt.scatter(proxy, full, c=iterations)
+        plt.colorbar(label='iteration')
+        plt.xlabel('proxy val_psnr')
+        plt.ylabel('full_val_psnr')
+        plt.title(f"pearson {report['pearson']:.3f}, spearman {report['spearman']:.3f}")
+        plt.savefig(plot_file)
+    return report
+
+
+if __name__ == '__main__':
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--plot', default='', help='scatter plot of proxy vs full psnr')
+    parser.add_argument('--json', default='')
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    report = proxy_correlation(cfg.history_file, args.plot)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
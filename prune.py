@@ -0,0 +1,285 @@
+"""Structured channel pruning of the growth convs (out1-out4) of every residual_dense_block of an rdb / rrdb / rrdb_ca
+generator. Filters are scored by magnitude or by their first-order effect on the loss (taylor), a removed filter also
+removes its input channel from every later conv of the block (they read it through the concatenates), and the
+physically smaller model is rebuilt with per-conv growth_channels. Every pruning ratio is fine-tuned with
+train_psnr.py and exported as architecture.yaml + weights.h5; report.json / curve.png give params, MACs,
+cpu latency and eval psnr per ratio.
+
+python prune.py --ratios 0.25 0.5 0.75 --criterion taylor
+python prune.py -o model.tier=large --weights_file outputs/weights/psnr/best_weights.h5 --finetune_iterations 0
+"""
+import os
+import sys
+import copy
+import json
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+import yaml
+import matplotlib.pyplot as plt
+from tensorflow.keras.layers import Conv2D, Concatenate
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments, apply_overrides
+from datasets.dataloader import load_img_pair_from_dir, load_img_pair_from_tfrecord, dataset_object
+from models.model_builder import build_generator, generator_settings
+from models.backbone.RDB import SlicedConv2D
+from train_utils.losses import make_pixel_loss
+from benchmark_tiers import measure_latency
+from profile_flops import profile_flops
+from eval import evaluate
+
+PRUNABLE_BLOCKS = ['rdb', 'rrdb', 'rrdb_ca']
+
+
+def rdb_convs(model):
+    """layer indices [conv1, conv2, conv3, conv4, conv5] of every residual_dense_block, in trunk order"""
+    index_of = {id(layer): index for index, layer in enumerate(model.layers)}
+    groups = []
+    for layer in model.layers:
+        if not isinstance(layer, Conv2D) or getattr(layer, 'block_path', '').split('/')[-1] != 'rdb':
+            continue
+        # conv5 reads the block input and the four LeakyReLU(growth conv) outputs,
+        # through a concatenate or directly (SlicedConv2D)
+        if isinstance(layer, SlicedConv2D):
+            inputs = layer.input
+        elif isinstance(layer.input._keras_history.layer, Concatenate):
+            inputs = layer.input._keras_history.layer.input
+        else:
+            continue
+        if len(inputs) != 5:
+            continue
+        growth_convs = [t._keras_history.layer.input._keras_history.layer for t in inputs[1:]]
+        groups.append([index_of[id(conv)] for conv in growth_convs] + [index_of[id(layer)]])
+    return sorted(groups)
+
+
+def magnitude_scores(model, groups):
+    """L1 norm of every growth conv filter"""
+    return [[np.abs(model.layers[index].kernel.numpy()).sum(axis=(0, 1, 2)) for index in group[:4]]
+            for group in groups]
+
+
+def taylor_scores(model, groups, dataset, num_batches):
+    """first-order loss change when a filter is removed, (sum over the filter of w * dL/dw)^2,
+    summed over num_batches training batches"""
+    loss_fn = make_pixel_loss(criterion='l1')
+    convs = [model.layers[index] for group in groups for index in group[:4]]
+    variables = [v for conv in convs for v in (conv.kernel, conv.bias)]
+
+    @tf.function
+    def filter_contributions(lr_batch, hr_batch):
+        with tf.GradientTape() as tape:
+            loss = loss_fn(y_true=hr_batch, y_pred=model(lr_batch, training=False))
+        gradients = tape.gradient(loss, variables)
+        contributions = []
+        for conv, kernel_gradient, bias_gradient in zip(convs, gradients[0::2], gradients[1::2]):
+            contribution = tf.reduce_sum(conv.kernel * kernel_gradient, axis=(0, 1, 2)) + conv.bias * bias_gradient
+            contributions.append(tf.square(contribution))
+        return contributions
+
+    totals = None
+    for lr_batch, hr_batch in dataset.take(num_batches):
+        contributions = [c.numpy() for c in filter_contributions(lr_batch, hr_batch)]
+        totals = contributions if totals is None else [t + c for t, c in zip(totals, contributions)]
+    per_conv = iter(totals)
+    return [[next(per_conv) for _ in group[:4]] for group in groups]
+
+
+def select_filters(scores, ratio, scope='global', round_to=4):
+    """indices of the kept filters of every growth conv, nested like scores.
+    scope 'layer': every conv keeps (1 - ratio) of its filters; 'global': one threshold over all convs,
+    on scores normalized per conv so convs of different magnitude compare.
+    kept counts are rounded to multiples of round_to (at least round_to), which keeps the convs vectorizable"""
+    flat = [s for group in scores for s in group]
+    if scope == 'layer':
+        counts = [len(s) * (1 - ratio) for s in flat]
+    else:
+        normalized = [s / (s.sum() + 1e-12) for s in flat]
+        all_scores = np.sort(np.concatenate(normalized))[::-1]
+        num_keep = int(round(len(all_scores) * (1 - ratio)))
+        threshold = all_scores[num_keep - 1] if num_keep > 0 else np.inf
+        counts = [int((n >= threshold).sum()) for n in normalized]
+    kept = []
+    for s, count in zip(flat, counts):
+        count = min(len(s), max(round_to, round_to * int(round(count / round_to))))
+        kept.append(np.sort(np.argsort(s)[::-1][:count]))
+    kept = iter(kept)
+    return [[next(kept) for _ in group] for group in scores]
+
+
+def pruned_growth(kept, block_type, num_blocks):
+    """kept filters per rdb -> growth_channels of build_generator (one entry per trunk block)"""
+    growth = [[len(k) for k in rdb] for rdb in kept]
+    if block_type == 'rdb':
+        return growth
+    return [growth[3 * b:3 * b + 3] for b in range(num_blocks)]
+
+
+def copy_pruned_weights(model, pruned_model, groups, kept, channels):
+    """weights of model into the rebuilt pruned_model, slicing the output channels of the pruned convs
+    and the matching input channels of the later convs of their block"""
+    slices = {}
+    for group, rdb_kept in zip(groups, kept):
+        # input of conv k: concatenate([x, out1, ..., out{k-1}])
+        in_keep = list(range(channels))
+        offset = channels
+        for k, index in enumerate(group):
+            out_keep = rdb_kept[k] if k < 4 else None
+            slices[index] = (np.array(in_keep), out_keep)
+            if k < 4:
+                in_keep += list(offset + rdb_kept[k])
+                offset += model.layers[index].filters
+    if len(model.layers) != len(pruned_model.layers):
+        raise ValueError('pruned model does not match the layers of the source model')
+    for index, (layer, pruned_layer) in enumerate(zip(model.layers, pruned_model.layers)):
+        if index in slices:
+            in_keep, out_keep = slices[index]
+            kernel, bias = layer.get_weights()
+            kernel = kernel[:, :, in_keep, :]
+            if out_keep is not None:
+                kernel, bias = kernel[..., out_keep], bias[out_keep]
+            pruned_layer.set_weights([kernel, bias])
+        else:
+            pruned_layer.set_weights(layer.get_weights())
+
+
+def finetune_config(cfg, settings, pretrained_weights_file, run_dir, iterations, learning_rate, extra_overrides=None):
+    """config.yaml of a train_psnr.py fine-tuning run of the pruned model, outputs in run_dir"""
+    config_data = copy.deepcopy(cfg.config_data)
+    overrides = {'model.tier': ''}
+    for key, value in settings.items():
+        # conv_ranks are read from model.conv_ranks_file
+        if key not in ('scale', 'conv_ranks'):
+            overrides['model.' + key] = value
+    overrides.update({
+        'training.iterations': iterations,
+        'training.init_learning_rate': learning_rate,
+        'training.lr_decay_iter_list': [iterations // 2],
+        'training.pretrained_weights_file': pretrained_weights_file,
+        'validation.async_validation': False,
+        'checkpoint.latest_checkpoint_dir': os.path.join(run_dir, 'checkpoints'),
+        'checkpoint.best_weights_file': os.path.join(run_dir, 'finetune', 'best_weights.h5'),
+        'checkpoint.history_file': os.path.join(run_dir, 'finetune', 'history.jsonl'),
+        'instrumentation.timing_file': os.path.join(run_dir, 'finetune', 'timing.jsonl'),
+        'instrumentation.profile_dir': os.path.join(run_dir, 'profile'),
+        'logs.eval_log_file': os.path.join(run_dir, 'finetune', 'eval_log.txt'),
+    })
+    overrides.update(extra_overrides or {})
+    apply_overrides(config_data, overrides)
+    os.makedirs(os.path.join(run_dir, 'checkpoints'), exist_ok=True)
+    os.makedirs(os.path.join(run_dir, 'finetune'), exist_ok=True)
+    config_file = os.path.join(run_dir, 'finetune_config.yaml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config_data, f, sort_keys=False)
+    return config_file
+
+
+def measure(model, cfg, latency_size, latency_steps):
+    mean_psnr, mean_ssim = evaluate(model, cfg.eval_lr_dir, cfg.eval_hr_dir, cfg.upscale_factor)
+    latency_ms, _ = measure_latency(model, latency_size, steps=latency_steps)
+    macs = sum(r['macs'] for r in profile_flops(model, (1, latency_size, latency_size, 3)))
+    return {'params': model.count_params(), 'gmacs': macs / 1e9, 'cpu_latency_ms': latency_ms,
+            'psnr': float(mean_psnr), 'ssim': float(mean_ssim)}
+
+
+def plot_curve(results, save_path, series=(('pruned', 'pruned'), ('finetuned', 'pruned + fine-tuned')),
+               label_key='ratio'):
+    plt.figure(figsize=(6, 4))
+    for key, label in series:
+        points = [(r[key]['cpu_latency_ms'], r[key]['psnr'], r[label_key]) for r in results if key in r]
+        if not points:
+            continue
+        plt.plot([p[0] for p in points], [p[1] for p in points], marker='o', label=label)
+        for latency_ms, psnr, ratio in points:
+            plt.annotate(f'{ratio:.2f}', (latency_ms, psnr), textcoords='offset points', xytext=(4, 4))
+    plt.xlabel('CPU latency (ms)')
+    plt.ylabel('PSNR')
+    plt.legend()
+    plt.savefig(save_path)
+
+
+def prune(cfg, weights_file, ratios, criterion='magnitude', scope='global', round_to=4, taylor_batches=20,
+          finetune_iterations=20000, finetune_lr=5e-5, output_dir='outputs/prune', latency_size=64, latency_steps=10):
+    settings = generator_settings(cfg)
+    if settings['block_type'] not in PRUNABLE_BLOCKS:
+        raise ValueError(f"block_type {settings['block_type']} has no rdb growth convs, one of {PRUNABLE_BLOCKS}")
+    if settings.get('conv_ranks'):
+        raise ValueError('prune the full 3x3 model, then factorize it with compress_conv.py')
+    os.makedirs(output_dir, exist_ok=True)
+    model = build_generator(**settings)
+    model.load_weights(weights_file)
+    groups = rdb_convs(model)
+
+    if criterion == 'taylor':
+        if cfg.Use_TFRecord:
+            dataset_cache = load_img_pair_from_tfrecord(cfg.TFRecord_file, cfg.cache_dir)
+        else:
+            dataset_cache = load_img_pair_from_dir(cfg.train_lr_dir, cfg.train_hr_dir, cfg.cache_dir)
+        dataset = dataset_object(dataset_cache, cfg.hr_size, cfg.upscale_factor, cfg.batch_size, training=True)
+        scores = taylor_scores(model, groups, dataset, taylor_batches)
+    else:
+        scores = magnitude_scores(model, groups)
+    num_filters = sum(len(s) for group in scores for s in group)
+
+    results = [{'ratio': 0.0, 'growth_filters': num_filters, 'pruned': measure(model, cfg, latency_size, latency_steps)}]
+    for ratio in ratios:
+        kept = select_filters(scores, ratio, scope, round_to)
+        pruned_settings = dict(settings, growth_channels=pruned_growth(kept, settings['block_type'],
+                                                                       settings['num_blocks']))
+        pruned_model = build_generator(**pruned_settings)
+        copy_pruned_weights(model, pruned_model, groups, kept, settings['channels'])
+        run_dir = os.path.join(output_dir, f'ratio_{ratio:.2f}')
+        os.makedirs(run_dir, exist_ok=True)
+        pruned_weights_file = os.path.join(run_dir, 'pruned_weights.h5')
+        pruned_model.save_weights(pruned_weights_file)
+        result = {'ratio': ratio, 'growth_filters': sum(len(k) for rdb in kept for k in rdb),
+                  'pruned': measure(pruned_model, cfg, latency_size, latency_steps)}
+
+        if finetune_iterations:
+            config_file = finetune_config(cfg, pruned_settings, pruned_weights_file, run_dir,
+                                          finetune_iterations, finetune_lr)
+            subprocess.run([sys.executable, 'train_psnr.py', '--config', config_file], check=True)
+            pruned_model.load_weights(os.path.join(run_dir, 'finetune', 'best_weights.h5'))
+            result['finetuned'] = measure(pruned_model, cfg, latency_size, latency_steps)
+
+        # export: generator_from_settings(architecture=yaml.safe_load(architecture.yaml)) + load_weights
+        with open(os.path.join(run_dir, 'architecture.yaml'), 'w') as f:
+            yaml.safe_dump(pruned_settings, f, sort_keys=False)
+        pruned_model.save_weights(os.path.join(run_dir, 'weights.h5'))
+        results.append(result)
+        tf.keras.backend.clear_session()
+
+    print(f"{'ratio':>6}{'filters':>9}{'params (M)':>12}{'GMACs':>9}{'ms':>9}{'psnr':>9}{'tuned psnr':>12}")
+    for r in results:
+        tuned = f"{r['finetuned']['psnr']:.3f}" if 'finetuned' in r else '-'
+        print(f"{r['ratio']:>6.2f}{r['growth_filters']:>9}{r['pruned']['params'] / 1e6:>12.2f}"
+              f"{r['pruned']['gmacs']:>9.2f}{r['pruned']['cpu_latency_ms']:>9.1f}{r['pruned']['psnr']:>9.3f}{tuned:>12}")
+    report = {'weights_file': weights_file, 'criterion': criterion, 'scope': scope, 'round_to': round_to,
+              'latency_size': latency_size, 'results': results}
+    with open(os.path.join(output_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    plot_curve(results, os.path.join(output_dir, 'curve.png'))
+    return report
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--weights_file', default='', help='weights to prune, default checkpoint.best_weights_file')
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75])
+    parser.add_argument('--criterion', choices=['magnitude', 'taylor'], default='magnitude')
+    parser.add_argument('--scope', choices=['global', 'layer'], default='global')
+    parser.add_argument('--round_to', type=int, default=4)
+    parser.add_argument('--taylor_batches', type=int, default=20)
+    parser.add_argument('--finetune_iterations', type=int, default=20000, help='0 = no fine-tuning')
+    parser.add_argument('--finetune_lr', type=float, default=5e-5)
+    parser.add_argument('--output_dir', default='outputs/prune')
+    parser.add_argument('--latency_size', type=int, default=64)
+    parser.add_argument('--latency_steps', type=int, default=10)
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    prune(cfg, args.weights_file or cfg.best_weights_file, args.ratios, args.criterion, args.scope, args.round_to,
+          args.taylor_batches, args.finetune_iterations, args.finetune_lr, args.output_dir, args.latency_size,
+          args.latency_steps)
@@ -0,0 +1,187 @@
+"""Hyperparameter sweep: expands a grid / list of config overrides, runs every combination as its own
+training process with its own output dirs, pinned cpu cores and tf thread pools, keeps all slots busy
+and collects best_val_psnr and throughput into one summary table.
+
+python sweep.py configs/sweep_example.yaml
+python sweep.py configs/sweep_example.yaml --dry_run
+"""
+import os
+import sys
+import csv
+import time
+import json
+import argparse
+import itertools
+import subprocess
+import yaml
+
+from configs.overrides import apply_overrides, override_list
+from utils.history import load_history_header, read_last_record
+
+# config keys every run writes to, redirected into the run dir
+OUTPUT_KEYS = {
+    'train_psnr.py': ['checkpoint.latest_checkpoint_dir', 'checkpoint.best_weights_file',
+                      'checkpoint.history_file', 'checkpoint.archive_dir', 'logs.eval_log_file',
+                      'instrumentation.timing_file', 'instrumentation.profile_dir'],
+    'train_gan.py': ['checkpoint.latest_checkpoint_dir', 'checkpoint.gen_weights_file',
+                     'checkpoint.history_file', 'checkpoint.archive_dir', 'instrumentation.timing_file',
+                     'instrumentation.profile_dir'],
+    # the teacher cache (distill.cache_file) is shared by all runs
+    'train_distill.py': ['checkpoint.latest_checkpoint_dir', 'checkpoint.best_weights_file',
+                         'checkpoint.history_file', 'report.report_file'],
+}
+OUTPUT_KEYS['train_gan_v2.py'] = OUTPUT_KEYS['train_gan.py']
+# keys that name directories (and their name in the run dir), the others name files
+DIR_KEYS = {'checkpoint.latest_checkpoint_dir': 'checkpoints', 'checkpoint.archive_dir': 'archive',
+            'instrumentation.profile_dir': 'profile'}
+
+
+def expand_runs(grid, runs):
+    """every combination of the grid values, then every explicit run, each as {dotted_key: value}"""
+    expanded = []
+    if grid:
+        keys = list(grid)
+        for values in itertools.product(*(grid[key] for key in keys)):
+            expanded.append(dict(zip(keys, values)))
+    for run in runs or []:
+        expanded.append(dict(run))
+    return expanded or [{}]
+
+
+def get_key(config_data, dotted_key):
+    node = config_data
+    for key in dotted_key.split('.'):
+        node = node[key]
+    return node
+
+
+def cpu_slots(cpus_per_run, max_parallel):
+    """disjoint core sets, one per concurrently running job"""
+    cores = sorted(os.sched_getaffinity(0))
+    cpus_per_run = min(cpus_per_run or len(cores), len(cores))
+    num_slots = len(cores) // cpus_per_run
+    if max_parallel:
+        num_slots = min(num_slots, max_parallel)
+    return [cores[k * cpus_per_run:(k + 1) * cpus_per_run] for k in range(num_slots)]
+
+
+def prepare_run(sweep, index, run_overrides, base_config_file):
+    """run dir with the merged config.yaml and empty output dirs"""
+    run_dir = os.path.join(sweep['output_dir'], f'run_{index:03d}')
+    with open(base_config_file, 'r') as f:
+        config_data = yaml.safe_load(f)
+    apply_overrides(config_data, run_overrides)
+    for key in OUTPUT_KEYS[sweep['script']]:
+        if key in DIR_KEYS:
+            path = os.path.join(run_dir, DIR_KEYS[key])
+        else:
+            path = os.path.join(run_dir, os.path.basename(get_key(config_data, key)))
+        apply_overrides(config_data, {key: path})
+        os.makedirs(path if key in DIR_KEYS else os.path.dirname(path), exist_ok=True)
+    config_file = os.path.join(run_dir, 'config.yaml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config_data, f, sort_keys=False)
+    return {'index': index, 'run_dir': run_dir, 'config_file': config_file, 'config_data': config_data,
+            'overrides': override_list(run_overrides)}
+
+
+def launch(sweep, run, cores, gpu):
+    threads = len(cores)
+    apply_overrides(run['config_data'], {'runtime.intra_op_threads': sweep['intra_op_threads'] or threads,
+                                         'runtime.inter_op_threads': sweep['inter_op_threads']})
+    with open(run['config_file'], 'w') as f:
+        yaml.safe_dump(run['config_data'], f, sort_keys=False)
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(sweep['intra_op_threads'] or threads)
+    if gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    log = open(os.path.join(run['run_dir'], 'train.log'), 'w')
+    process = subprocess.Popen([sys.executable, sweep['script'], '--config', run['config_file']],
+                               stdout=log, stderr=subprocess.STDOUT, env=env,
+                               preexec_fn=lambda: os.sched_setaffinity(0, cores))
+    run.update({'process': process, 'log': log, 'start_time': time.time(), 'cores': cores, 'gpu': gpu})
+    print(f"run_{run['index']:03d} started on cores {cores[0]}-{cores[-1]}"
+          f"{'' if gpu is None else f', gpu {gpu}'}: {' '.join(run['overrides'])}")
+
+
+def summarize(run):
+    config_data = run['config_data']
+    history_file = get_key(config_data, 'checkpoint.history_file')
+    header = load_history_header(history_file) or {}
+    last_record = read_last_record(history_file) or {}
+    iterations = last_record.get('iteration', 0)
+    seconds = run['end_time'] - run['start_time']
+    batch_size = get_key(config_data, 'data.batch_size')
+    return {
+        'run': f"run_{run['index']:03d}",
+        'overrides': ' '.join(run['overrides']),
+        'returncode': run['process'].returncode,
+        'best_val_psnr': header.get('best_val_psnr', ''),
+        'best_iteration': header.get('best_iteration', ''),
+        'iterations': iterations,
+        'hours': round(seconds / 3600, 3),
+        # wall clock, including validation and checkpointing
+        'iters_per_sec': round(iterations / seconds, 3) if seconds > 0 else '',
+        'images_per_sec': round(iterations * batch_size / seconds, 2) if seconds > 0 else '',
+    }
+
+
+def print_summary(rows):
+    columns = list(rows[0])
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for r in rows:
+        print('  '.join(str(r[c]).ljust(widths[c]) for c in columns))
+
+
+def sweep_runs(sweep_file, dry_run=False, poll_seconds=10):
+    with open(sweep_file, 'r') as f:
+        sweep = yaml.safe_load(f)
+    base_config_file = sweep['base_config']
+    runs = [prepare_run(sweep, index, run_overrides, base_config_file)
+            for index, run_overrides in enumerate(expand_runs(sweep.get('grid'), sweep.get('runs')))]
+    slots = cpu_slots(sweep['cpus_per_run'], sweep['max_parallel'])
+    gpus = sweep.get('gpus') or []
+    if gpus:
+        slots = slots[:len(gpus)]
+    print(f'{len(runs)} runs, {len(slots)} parallel slots of {len(slots[0])} cores')
+    if dry_run:
+        for run in runs:
+            print(f"run_{run['index']:03d}: {run['config_file']} {' '.join(run['overrides'])}")
+        return []
+
+    pending = list(runs)
+    running = {}
+    while pending or running:
+        # start a run in every free slot
+        for slot, cores in enumerate(slots):
+            if slot not in running and pending:
+                running[slot] = pending.pop(0)
+                launch(sweep, running[slot], cores, gpus[slot] if gpus else None)
+        time.sleep(poll_seconds)
+        for slot in list(running):
+            run = running[slot]
+            if run['process'].poll() is not None:
+                run['end_time'] = time.time()
+                run['log'].close()
+                print(f"run_{run['index']:03d} finished with code {run['process'].returncode}")
+                del running[slot]
+
+    rows = [summarize(run) for run in runs]
+    print_summary(rows)
+    with open(os.path.join(sweep['output_dir'], 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(os.path.join(sweep['output_dir'], 'summary.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sweep_file')
+    parser.add_argument('--dry_run', action='store_true')
+    parser.add_argument('--poll_seconds', type=int, default=10)
+    args = parser.parse_args()
+    sweep_runs(args.sweep_file, args.dry_run, args.poll_seconds)
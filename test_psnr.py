@@ -1,17 +1,22 @@
 import os
 import tensorflow as tf
 import matplotlib.pyplot as plt
-from models.model_builder import generator_x4
+from models.model_builder import generator_from_config
 from configs.load_psnr_config import cfg
 from tensorflow.keras.utils import load_img, img_to_array, array_to_img
 from utils.postprocess import post_process
+from utils.runtime import set_inference_precision
+from utils.inference import Upscaler
 from matplotlib.patches import Rectangle
 
 
 def test():
     # load model
-    model = generator_x4()
+    set_inference_precision(cfg.inference_precision)
+    model = generator_from_config(cfg)
     model.load_weights(cfg.best_weights_file)
+    upscaler = Upscaler(model, cfg.upscale_factor, cfg.self_ensemble, cfg.ensemble_max_batch, cfg.tile_size,
+                        cfg.tile_overlap)
     # zoom region
     y1 = 100
     y2 = 200
@@ -30,7 +35,7 @@ def test():
         lr_img = img_to_array(load_img(os.path.join(lr_dir, lr_path)))
         hr_img = img_to_array(load_img(os.path.join(hr_dir, hr_path)))
         lr_img = tf.expand_dims(lr_img, axis=0)
-        sr_img = model.predict(lr_img)
+        sr_img = upscaler(lr_img)
         sr_img = post_process(sr_img)
         sr_img = tf.squeeze(sr_img, axis=0)
         lr_img = tf.squeeze(lr_img, axis=0)
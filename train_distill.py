@@ -0,0 +1,189 @@
+"""Distill a trained generator (teacher, generator_x4 by default) into a small student generator.
+The teacher runs once over fixed training crops (datasets/distill_cache.py), the student trains on
+the cached teacher outputs, and the report compares eval psnr / ssim and cpu latency of both.
+
+python train_distill.py
+python train_distill.py --report_only
+python train_distill.py -o student.tier=medium -o distill.feature_weight=0.1 -o distill.cache_features=True
+"""
+import os
+import sys
+import json
+import argparse
+import tensorflow as tf
+import tensorflow.keras as keras
+from tensorflow.keras.layers import Conv2D
+from tensorflow.keras.models import Model
+
+from configs.load_distill_config import load_config
+from configs.overrides import add_config_arguments
+from datasets.dataloader import load_img_pair_from_dir, load_img_pair_from_tfrecord
+from datasets.distill_cache import write_distill_cache, load_cache_meta, load_distill_dataset
+from models.model_builder import generator_from_settings
+from train_utils.lr_schedules import multistep_lr_schedule
+from train_utils.losses import make_pixel_loss, make_perceptual_loss
+from train_utils.initializers import scaled_HeNormal
+from train_utils.validation import load_val_batches, validate
+from utils.history import create_or_continue_history, append_history, save_history_header
+from utils.runtime import configure_threads
+from benchmark_tiers import measure_latency
+from eval import evaluate
+
+
+def build_teacher(cfg):
+    teacher = generator_from_settings(cfg.teacher_tier, cfg.teacher_architecture)
+    teacher.load_weights(cfg.teacher_weights_file)
+    return teacher
+
+
+def prepare_cache(cfg):
+    """teacher outputs on the training crops, computed only if the cache is missing or does not match"""
+    meta = load_cache_meta(cfg.cache_file)
+    if meta is not None:
+        if meta['hr_size'] != cfg.hr_size or meta['scale'] != cfg.upscale_factor:
+            raise ValueError(f'{cfg.cache_file} holds {meta["hr_size"]} px crops at x{meta["scale"]}, '
+                             f'delete it to rebuild for hr_size {cfg.hr_size}')
+        if cfg.feature_weight > 0 and not meta['features']:
+            raise ValueError(f'{cfg.cache_file} has no teacher features, delete it and set distill.cache_features')
+        return meta
+    os.makedirs(os.path.dirname(cfg.cache_file) or '.', exist_ok=True)
+    if cfg.Use_TFRecord:
+        dataset_cache = load_img_pair_from_tfrecord(cfg.TFRecord_file, cfg.cache_dir)
+    else:
+        dataset_cache = load_img_pair_from_dir(cfg.train_lr_dir, cfg.train_hr_dir, cfg.cache_dir)
+    teacher = build_teacher(cfg)
+    return write_distill_cache(teacher, dataset_cache, cfg.cache_file, cfg.hr_size, cfg.upscale_factor,
+                               cfg.crops_per_image, cfg.teacher_batch_size,
+                               cache_features=cfg.cache_features or cfg.feature_weight > 0)
+
+
+def train_distill(cfg):
+    configure_threads(cfg.intra_op_threads, cfg.inter_op_threads)
+    for path in (cfg.latest_checkpoint_dir, os.path.dirname(cfg.best_weights_file),
+                 os.path.dirname(cfg.history_file)):
+        os.makedirs(path, exist_ok=True)
+    meta = prepare_cache(cfg)
+    use_features = cfg.feature_weight > 0
+    train_ds = load_distill_dataset(cfg.cache_file, meta, cfg.batch_size, with_features=use_features)
+
+    student = generator_from_settings(cfg.student_tier, cfg.student_architecture,
+                                      kernel_initializer=scaled_HeNormal(0.1))
+    trainable_models = [student]
+    if use_features:
+        # student trunk features mapped to the teacher's channels, only used for the loss
+        student_with_features = Model(student.input, [student.output, student.get_layer('trunk_output').output])
+        adapter = Conv2D(filters=meta['feature_shape'][-1], kernel_size=(1, 1), padding='same')
+        adapter.build((None, None, None, student.get_layer('trunk_output').output.shape[-1]))
+        trainable_models.append(adapter)
+    pixel_loss_fn = make_pixel_loss(criterion='l1')
+    if cfg.perceptual_weight > 0:
+        perc_loss_fn = make_perceptual_loss(criterion='l1', output='54', before_act=True)
+    val_loss_fn = make_pixel_loss(criterion='l1')
+
+    lr_schedule = multistep_lr_schedule(initial_lr=cfg.init_learning_rate, lr_decay_iter_list=cfg.lr_decay_iter_list,
+                                        lr_decay_rate=cfg.lr_decay_rate)
+    optimizer = keras.optimizers.Adam(learning_rate=lr_schedule, epsilon=1e-8)
+
+    # checkpoint
+    checkpoint_objects = {'optimizer': optimizer, 'model': student}
+    if use_features:
+        checkpoint_objects['adapter'] = adapter
+    latest_checkpoint = tf.train.Checkpoint(**checkpoint_objects)
+    latest_checkpoint_manager = tf.train.CheckpointManager(
+        latest_checkpoint, cfg.latest_checkpoint_dir, max_to_keep=1)
+    if os.listdir(cfg.latest_checkpoint_dir):
+        the_latest_checkpoint = tf.train.latest_checkpoint(cfg.latest_checkpoint_dir)
+        print(f'Restoring from latest checkpoint: {the_latest_checkpoint}')
+        latest_checkpoint.restore(the_latest_checkpoint)
+    else:
+        print('No checkpoints found, training from scratch.')
+
+    val_batches = load_val_batches(cfg.val_lr_dir, cfg.val_hr_dir, cfg.val_batch_size)
+    history_header, start_iteration = create_or_continue_history(cfg.history_file)
+    max_psnr = history_header['best_val_psnr'] if start_iteration else 0.0
+
+    train_loss_metric = keras.metrics.Mean(name='loss')
+    variables = [v for m in trainable_models for v in m.trainable_variables]
+
+    @tf.function
+    def train_step(batch):
+        lr_batch, hr_batch, teacher_sr = batch[:3]
+        with tf.GradientTape() as tape:
+            if use_features:
+                sr_batch, student_feature = student_with_features(lr_batch, training=True)
+            else:
+                sr_batch = student(lr_batch, training=True)
+            loss = cfg.teacher_weight * pixel_loss_fn(teacher_sr, sr_batch) + \
+                cfg.gt_weight * pixel_loss_fn(hr_batch, sr_batch)
+            if cfg.perceptual_weight > 0:
+                loss += cfg.perceptual_weight * perc_loss_fn(teacher_sr, sr_batch)
+            if use_features:
+                loss += cfg.feature_weight * pixel_loss_fn(batch[3], adapter(student_feature))
+        gradient = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradient, variables))
+        train_loss_metric.update_state(loss)
+
+    for i, batch in enumerate(train_ds, start=start_iteration):
+        if i >= cfg.iterations:
+            break
+        train_step(batch)
+
+        if (i + 1) % cfg.save_every == 0:
+            train_loss = train_loss_metric.result()
+            val_loss, val_mean_psnr, val_mean_ssim = validate(
+                student, val_batches, val_loss_fn, cfg.upscale_factor)
+            print(f"Iteration {i + 1}, "
+                  f"loss: {train_loss}, "
+                  f"val_loss: {val_loss}, "
+                  f"val_psnr: {val_mean_psnr}, "
+                  f"val_ssim: {val_mean_ssim}")
+            latest_checkpoint_manager.save()
+            append_history({'iteration': i + 1,
+                            'loss': float(train_loss),
+                            'val_loss': float(val_loss),
+                            'val_psnr': float(val_mean_psnr),
+                            'val_ssim': float(val_mean_ssim)}, cfg.history_file)
+            if val_mean_psnr > max_psnr:
+                max_psnr = val_mean_psnr
+                student.save_weights(cfg.best_weights_file)
+                history_header['best_iteration'] = i + 1
+                history_header['best_val_psnr'] = float(max_psnr)
+                save_history_header(history_header, cfg.history_file)
+                print('save the best')
+            train_loss_metric.reset_state()
+
+
+def distill_report(cfg):
+    """eval psnr / ssim and cpu latency of teacher and best student"""
+    models = {'teacher': build_teacher(cfg)}
+    models['student'] = generator_from_settings(cfg.student_tier, cfg.student_architecture)
+    models['student'].load_weights(cfg.best_weights_file)
+    report = {}
+    for name, model in models.items():
+        mean_psnr, mean_ssim = evaluate(model, cfg.eval_lr_dir, cfg.eval_hr_dir, cfg.upscale_factor)
+        latency_ms, _ = measure_latency(model, cfg.latency_size, steps=cfg.latency_steps)
+        report[name] = {'params': model.count_params(), 'psnr': float(mean_psnr), 'ssim': float(mean_ssim),
+                        f'cpu_latency_ms_{cfg.latency_size}': latency_ms}
+    report['speedup'] = report['teacher'][f'cpu_latency_ms_{cfg.latency_size}'] / \
+        report['student'][f'cpu_latency_ms_{cfg.latency_size}']
+    report['psnr_drop'] = report['teacher']['psnr'] - report['student']['psnr']
+    os.makedirs(os.path.dirname(cfg.report_file) or '.', exist_ok=True)
+    with open(cfg.report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    for name in models:
+        r = report[name]
+        print(f"{name:<8}{r['params'] / 1e6:>8.2f} M params  psnr {r['psnr']:.3f}  ssim {r['ssim']:.4f}  "
+              f"{r[f'cpu_latency_ms_{cfg.latency_size}']:.1f} ms")
+    print(f"speedup x{report['speedup']:.1f}, psnr drop {report['psnr_drop']:.3f} dB")
+    return report
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_distill.yaml')
+    parser.add_argument('--report_only', action='store_true')
+    args = parser.parse_args()
+    cfg = load_config(args.config, args.override)
+    if not args.report_only:
+        train_distill(cfg)
+    distill_report(cfg)
@@ -1,22 +1,31 @@
 import os
 import sys
+import argparse
 import tensorflow as tf
 import tensorflow.keras as keras
 from tensorflow.keras.utils import load_img, img_to_array
 
-from configs.load_gan_config import cfg
+from configs.load_gan_config import load_config
+from configs.overrides import add_config_arguments
 from datasets.dataloader import sr_input_pipline_from_dir, sr_input_pipline_from_tfrecord
-from models.model_builder import generator_x4, discriminator_model_sn
+from models.model_builder import generator_from_config, discriminator_model_sn
 
 from train_utils.metrics import calculate_psnr, calculate_ssim
 from train_utils.lr_schedules import multistep_lr_schedule
+from train_utils.checkpoints import archive_checkpoint
 from train_utils.losses import make_pixel_loss, make_perceptual_loss, make_generator_loss, make_discriminator_loss, make_gradient_loss
-from utils.history import create_or_continue_gan_history, save_history
+from utils.history import create_or_continue_gan_history, append_history
 from train_utils.initializers import scaled_HeNormal
+from train_utils.sn import update_spectral_normalization
+from utils.step_timer import StepTimer
+from utils.memory import MemorySampler
+from utils.profiling import ProfilerWindow
+from utils.runtime import configure_threads
 
 
-def train_gan():
-    generator = generator_x4(kernel_initializer=scaled_HeNormal(0.1))
+def train_gan(cfg):
+    configure_threads(cfg.intra_op_threads, cfg.inter_op_threads)
+    generator = generator_from_config(cfg, kernel_initializer=scaled_HeNormal(0.1))
     discriminator = discriminator_model_sn()
     content_loss_fn = make_pixel_loss(criterion='l1')
     gen_adv_loss_fn = make_generator_loss(gan_type='ragan')
@@ -61,46 +70,69 @@ def train_gan():
             cfg.latest_checkpoint_dir)
         print(f'Restoring from latest checkpoint: {the_latest_checkpoint}')
         latest_checkpoint.restore(the_latest_checkpoint)
+        # v of the restored kernels and u, it is not part of the checkpoint
+        update_spectral_normalization(discriminator)
     else:
         print('No checkpoints found, training from pretrained generator.')
         generator.load_weights(cfg.gen_pretrained_weight_file)
 
-    history, start_iteration = create_or_continue_gan_history(cfg.history_file)
+    start_iteration = create_or_continue_gan_history(cfg.history_file)
     total_gen_loss = 0.0
     total_dis_loss = 0.0
 
-    for i, (x_batch, y_batch) in enumerate(train_ds):
+    # instrumentation
+    timer = StepTimer(enabled=cfg.timing or cfg.memory_tracking, window=cfg.timing_window,
+                      memory=MemorySampler() if cfg.memory_tracking else None)
+    profiler = ProfilerWindow(cfg.profile_dir, cfg.profile_start_step, cfg.profile_stop_step,
+                              cfg.profile_signal_steps)
+
+    for i, (x_batch, y_batch) in enumerate(timer.timed_iter(train_ds)):
         # iterations
         i += start_iteration
         if i >= cfg.iterations:
             break
-
-        # fit
-        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
-            # forward propagationy
-            generator_images = generator(x_batch, training=True)
-            real_output = discriminator(y_batch, training=True)
-            fake_output = discriminator(generator_images, training=True)
-            gen_adv_loss = gen_adv_loss_fn(
-                real_output=real_output, fake_output=fake_output)
-            disc_loss = dis_adv_loss_fn(
-                real_output=real_output, fake_output=fake_output)
-            content_loss = content_loss_fn(
-                y_true=y_batch, y_pred=generator_images)
-            perc_loss = perc_loss_fn(y_true=y_batch, y_pred=generator_images)
-            grad_loss = grad_loss_fn(y_true=y_batch, y_pred=generator_images)
-            gen_loss = perc_loss + 0.5 * grad_loss + \
-                5e-3 * gen_adv_loss + 1e-2 * content_loss
-
-        gradients_of_generator = gen_tape.gradient(
-            gen_loss, generator.trainable_variables)
-        gradients_of_discriminator = disc_tape.gradient(
-            disc_loss, discriminator.trainable_variables)
-
-        gen_optimizer.apply_gradients(
-            zip(gradients_of_generator, generator.trainable_variables))
-        dis_optimizer.apply_gradients(
-            zip(gradients_of_discriminator, discriminator.trainable_variables))
+        profiler.step(i)
+
+        # spectral norm power iteration, once per step for both discriminator calls
+        update_spectral_normalization(discriminator)
+        with timer.phase('forward') as wait_for:
+            # fit
+            with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
+                # forward propagationy
+                generator_images = generator(x_batch, training=True)
+                if cfg.fused_discriminator:
+                    # one discriminator pass, batch norm statistics are shared by real and fake
+                    d_output = discriminator(tf.concat([tf.cast(y_batch, tf.float32), generator_images], axis=0),
+                                             training=True)
+                    real_output, fake_output = tf.split(d_output, 2, axis=0)
+                else:
+                    real_output = discriminator(y_batch, training=True)
+                    fake_output = discriminator(generator_images, training=True)
+                gen_adv_loss = gen_adv_loss_fn(
+                    real_output=real_output, fake_output=fake_output)
+                disc_loss = dis_adv_loss_fn(
+                    real_output=real_output, fake_output=fake_output)
+                content_loss = content_loss_fn(
+                    y_true=y_batch, y_pred=generator_images)
+                perc_loss = perc_loss_fn(y_true=y_batch, y_pred=generator_images)
+                grad_loss = grad_loss_fn(y_true=y_batch, y_pred=generator_images)
+                gen_loss = cfg.perceptual_weight * perc_loss + cfg.gradient_weight * grad_loss + \
+                    cfg.adversarial_weight * gen_adv_loss + cfg.content_weight * content_loss
+            wait_for([gen_loss, disc_loss])
+
+        with timer.phase('backward') as wait_for:
+            gradients_of_generator = gen_tape.gradient(
+                gen_loss, generator.trainable_variables)
+            gradients_of_discriminator = disc_tape.gradient(
+                disc_loss, discriminator.trainable_variables)
+            wait_for([gradients_of_generator, gradients_of_discriminator])
+
+        with timer.phase('apply') as wait_for:
+            gen_optimizer.apply_gradients(
+                zip(gradients_of_generator, generator.trainable_variables))
+            dis_optimizer.apply_gradients(
+                zip(gradients_of_discriminator, discriminator.trainable_variables))
+            wait_for([gen_optimizer.iterations, dis_optimizer.iterations])
 
         total_gen_loss += gen_loss
         total_dis_loss += disc_loss
@@ -115,22 +147,26 @@ def train_gan():
                   f"disc_loss: {mean_disc_loss}, "
                   )
             # history
-            history['iteration'].append(i + 1)
-            history['gen_loss'].append(float(mean_gen_loss))
-            history['disc_loss'].append(float(mean_disc_loss))
-            # save history
-            save_history(history, cfg.history_file)
+            with timer.phase('history'):
+                append_history({'iteration': i + 1,
+                                'gen_loss': float(mean_gen_loss),
+                                'disc_loss': float(mean_disc_loss)}, cfg.history_file)
+            timer.save(i + 1, cfg.timing_file)
             # reset
             total_gen_loss = 0.0
             total_dis_loss = 0.0
         # save n iterations
         if (i + 1) % cfg.save_every == 0:
-            # ModelCheckpoint
-            latest_checkpoint_manager.save()
-            # save weight
-            generator.save_weights(cfg.gen_weights_file)
+            with timer.phase('checkpoint'):
+                # ModelCheckpoint
+                checkpoint_path = latest_checkpoint_manager.save()
+                if cfg.archive_every and (i + 1) % cfg.archive_every == 0:
+                    archive_checkpoint(checkpoint_path, cfg.archive_dir, i + 1)
+                # save weight
+                generator.save_weights(cfg.gen_weights_file)
             # print
             print('save weights')
+    profiler.stop()
 
     ###########################
     # no need to modify
@@ -139,4 +175,6 @@ def train_gan():
 
 if __name__ == '__main__':
     sys.setrecursionlimit(2000)
-    train_gan()
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_gan.yaml')
+    args = parser.parse_args()
+    train_gan(load_config(args.config, args.override))
@@ -1,24 +1,39 @@
 # train_val.py
 import os
 import sys
+import argparse
+import subprocess
 import tensorflow as tf
 import tensorflow.keras as keras
-from tensorflow.keras.utils import load_img, img_to_array
 
-from configs.load_psnr_config import cfg
-from datasets.dataloader import sr_input_pipline_from_dir, sr_input_pipline_from_tfrecord
-from models.model_builder import generator, generator_x4
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from datasets.dataloader import load_img_pair_from_dir, load_img_pair_from_tfrecord, curriculum_stage, \
+    curriculum_datasets
+from models.model_builder import generator_from_config
 
-from train_utils.metrics import calculate_psnr, calculate_ssim
+from train_utils.metrics import image_metrics
 from train_utils.lr_schedules import multistep_lr_schedule
+from train_utils.checkpoints import archive_checkpoint
 from train_utils.losses import make_pixel_loss
-from utils.history import create_or_continue_history, save_history
+from train_utils.validation import load_validation, validation_record
+from utils.history import create_or_continue_history, append_history, save_history_header
+from utils.step_timer import StepTimer
+from utils.memory import MemorySampler
+from utils.profiling import ProfilerWindow
+from utils.runtime import configure_threads
 from train_utils.initializers import scaled_HeNormal
 
 
-def train():
+def train(cfg):
+    configure_threads(cfg.intra_op_threads, cfg.inter_op_threads)
+    if cfg.async_validation:
+        # share the gpu with the validation worker
+        physical_devices = tf.config.list_physical_devices('GPU')
+        for device in physical_devices:
+            tf.config.experimental.set_memory_growth(device, True)
     # self-define
-    model = generator_x4(kernel_initializer=scaled_HeNormal(0.1))
+    model = generator_from_config(cfg, kernel_initializer=scaled_HeNormal(0.1))
     loss_fn = make_pixel_loss(criterion='l1')
 
     ###########################
@@ -26,15 +41,16 @@ def train():
     ###########################
     # load data
     if cfg.Use_TFRecord:
-        train_ds = sr_input_pipline_from_tfrecord(cfg.TFRecord_file, cfg.cache_dir, cfg.hr_size, cfg.upscale_factor,
-                                                  cfg.batch_size, training=True)
+        dataset_cache = load_img_pair_from_tfrecord(
+            cfg.TFRecord_file, cfg.cache_dir)
     else:
-        train_ds = sr_input_pipline_from_dir(cfg.train_lr_dir, cfg.train_hr_dir, cfg.cache_dir, cfg.hr_size, cfg.upscale_factor,
-                                             cfg.batch_size, training=True)
-    val_lr_dir = cfg.val_lr_dir
-    val_hr_dir = cfg.val_hr_dir
-    val_lr_img_paths = sorted(os.listdir(val_lr_dir))
-    val_hr_img_paths = sorted(os.listdir(val_hr_dir))
+        dataset_cache = load_img_pair_from_dir(
+            cfg.train_lr_dir, cfg.train_hr_dir, cfg.cache_dir)
+    # patch size curriculum, every stage crops from the same cache
+    stages = cfg.curriculum or [
+        {'start_iteration': 0, 'hr_size': cfg.hr_size, 'batch_size': cfg.batch_size}]
+    stage_datasets = curriculum_datasets(
+        dataset_cache, stages, cfg.upscale_factor)
     # lr schedule
     lr_schedule = multistep_lr_schedule(initial_lr=cfg.init_learning_rate, lr_decay_iter_list=cfg.lr_decay_iter_list,
                                         lr_decay_rate=cfg.lr_decay_rate)
@@ -42,9 +58,16 @@ def train():
     optimizer = keras.optimizers.Adam(learning_rate=lr_schedule, epsilon=1e-8)
 
     # checkpoint
-    latest_checkpoint = tf.train.Checkpoint(optimizer=optimizer, model=model)
+    # iteration and train_loss are stored for the validation worker
+    iteration = tf.Variable(0, dtype=tf.int64, trainable=False)
+    train_loss_var = tf.Variable(0.0, dtype=tf.float32, trainable=False)
+    stage_var = tf.Variable(0, dtype=tf.int64, trainable=False)
+    latest_checkpoint = tf.train.Checkpoint(optimizer=optimizer, model=model,
+                                            iteration=iteration, train_loss=train_loss_var,
+                                            curriculum_stage=stage_var)
+    # keep one extra checkpoint so the worker is not reading a file that is being deleted
     latest_checkpoint_manager = tf.train.CheckpointManager(
-        latest_checkpoint, cfg.latest_checkpoint_dir, max_to_keep=1)
+        latest_checkpoint, cfg.latest_checkpoint_dir, max_to_keep=2 if cfg.async_validation else 1)
 
     # Check if the checkpoint directory is not empty
     if os.listdir(cfg.latest_checkpoint_dir):
@@ -53,28 +76,38 @@ def train():
             cfg.latest_checkpoint_dir)
         print(f'Restoring from latest checkpoint: {the_latest_checkpoint}')
         latest_checkpoint.restore(the_latest_checkpoint)
+    elif cfg.pretrained_weights_file:
+        print(f'No checkpoints found, starting from {cfg.pretrained_weights_file}.')
+        model.load_weights(cfg.pretrained_weights_file)
     else:
         print('No checkpoints found, training from scratch.')
 
-    # restore history
-    # the latest history
-    history, start_iteration = create_or_continue_history(
-        cfg.history_file)
-    if start_iteration == 0:
-        max_psnr = 0.0
+    if cfg.async_validation:
+        # the worker owns history and best weights, the trainer only writes checkpoints
+        start_iteration = int(iteration.numpy())
+        # same config file and overrides as the trainer
+        worker_args = [sys.executable, 'val_worker.py', '--config', cfg.config_file]
+        for override in cfg.overrides:
+            worker_args += ['--override', override]
+        subprocess.Popen(worker_args)
     else:
-        max_psnr = history['best_val_psnr']
+        val_batches, proxy_batches = load_validation(cfg)
+        # restore history
+        # the latest history
+        history_header, start_iteration = create_or_continue_history(
+            cfg.history_file)
+        if start_iteration == 0:
+            max_psnr = 0.0
+        else:
+            max_psnr = history_header['best_val_psnr']
 
-    total_train_psnr = 0.0
-    total_train_ssim = 0.0
-    total_train_loss = 0.0
-
-    for i, (x_batch, y_batch) in enumerate(train_ds):
-        # iterations
-        i += start_iteration
-        if i >= cfg.iterations:
-            break
+    # train metrics, accumulated on device and only read when logging
+    train_loss_metric = keras.metrics.Mean(name='loss')
+    train_psnr_metric = keras.metrics.Mean(name='psnr')
+    train_ssim_metric = keras.metrics.Mean(name='ssim')
 
+    @tf.function
+    def compute_gradients(x_batch, y_batch):
         # fit
         with tf.GradientTape() as tape:
             # forward propagation
@@ -83,85 +116,155 @@ def train():
             train_loss = loss_fn(y_true=y_batch, y_pred=y_pred)
         # gradient
         gradient = tape.gradient(train_loss, model.trainable_variables)
+        return train_loss, gradient, y_pred
+
+    @tf.function
+    def apply_gradients(gradient):
         # update
         optimizer.apply_gradients(zip(gradient, model.trainable_variables))
 
+    @tf.function
+    def update_metrics(train_loss, y_batch, y_pred, compute_metrics):
         # train metrics
-        train_psnr = calculate_psnr(
-            y_true=y_batch, y_pred=y_pred, scale=cfg.upscale_factor, y_only=True)
-        train_ssim = calculate_ssim(
-            y_true=y_batch, y_pred=y_pred, scale=cfg.upscale_factor, y_only=True)
-        total_train_loss += train_loss
-        total_train_psnr += train_psnr
-        total_train_ssim += train_ssim
-
-        # val_loss
-        # every n iterations
-        if (i + 1) % cfg.save_every == 0:
-            # evaluate metrics in val_ds
-            total_val_loss = 0.0
-            total_psnr = 0.0
-            total_ssim = 0.0
-            num = 0
-            for lr_path, hr_path in zip(val_lr_img_paths, val_hr_img_paths):
-                lr_img = img_to_array(
-                    load_img(os.path.join(val_lr_dir, lr_path)))
-                hr_img = img_to_array(
-                    load_img(os.path.join(val_hr_dir, hr_path)))
-                lr_img = tf.expand_dims(lr_img, axis=0)
-                hr_img = tf.expand_dims(hr_img, axis=0)
-                sr_img = model(lr_img, training=False)
-                total_val_loss += loss_fn(y_true=hr_img, y_pred=sr_img)
-                cur_psnr = calculate_psnr(
-                    y_true=hr_img, y_pred=sr_img, scale=cfg.upscale_factor, y_only=True)
-                cur_ssim = calculate_ssim(
-                    y_true=hr_img, y_pred=sr_img, scale=cfg.upscale_factor, y_only=True)
-                total_psnr += cur_psnr
-                total_ssim += cur_ssim
-                num += 1
-            # calculate mean metrics of train and val
-            val_loss = total_val_loss / num
-            val_mean_psnr = total_psnr / num
-            val_mean_ssim = total_ssim / num
-            train_loss = total_train_loss / cfg.save_every
-            train_mean_psnr = total_train_psnr / cfg.save_every
-            train_mean_ssim = total_train_ssim / cfg.save_every
-            # print loss and metrics
-            print(f"Iteration {i + 1}, "
-                  f"loss: {train_loss}, "
-                  f"val_loss: {val_loss}, "
-                  f"psnr: {train_mean_psnr}, "
-                  f"val_psnr: {val_mean_psnr},"
-                  f"ssim: {train_mean_ssim}, "
-                  f"val_ssim: {val_mean_ssim}")
-
-            # history
-            history['iteration'].append(i + 1)
-            history['loss'].append(float(train_loss))
-            history['val_loss'].append(float(val_loss))
-            history['val_psnr'].append(float(val_mean_psnr))
-            history['val_ssim'].append(float(val_mean_ssim))
-
-            # ModelCheckpoint
-            latest_checkpoint_manager.save()
-            # save history
-            save_history(history, cfg.history_file)
-
-            # save best
-            if val_mean_psnr > max_psnr:
-                max_psnr = val_mean_psnr
-                # weight.h5
-                model.save_weights(cfg.best_weights_file)
-                # save history
-                history['best_iteration'] = i + 1
-                history['best_val_psnr'] = float(max_psnr)
-                save_history(history, cfg.history_file)
-                print('save the best')
-
-            # reset
-            total_train_loss = 0.0
-            total_train_ssim = 0.0
-            total_train_psnr = 0.0
+        train_loss_metric.update_state(train_loss)
+        # compute_metrics is a python bool, so psnr/ssim are only traced into one of the two graphs
+        if compute_metrics:
+            if cfg.metrics_sub_batch > 0:
+                y_batch = y_batch[:cfg.metrics_sub_batch]
+                y_pred = y_pred[:cfg.metrics_sub_batch]
+            metrics = image_metrics(y_true=y_batch, y_pred=y_pred, scale=cfg.upscale_factor, y_only=True)
+            train_psnr_metric.update_state(tf.reduce_mean(metrics['psnr']))
+            train_ssim_metric.update_state(tf.reduce_mean(metrics['ssim']))
+
+    @tf.function
+    def train_step(x_batch, y_batch, compute_metrics):
+        # the three parts are inlined into one graph
+        train_loss, gradient, y_pred = compute_gradients(x_batch, y_batch)
+        apply_gradients(gradient)
+        update_metrics(train_loss, y_batch, y_pred, compute_metrics)
+
+    # instrumentation
+    timer = StepTimer(enabled=cfg.timing or cfg.memory_tracking, window=cfg.timing_window,
+                      memory=MemorySampler() if cfg.memory_tracking else None)
+    profiler = ProfilerWindow(cfg.profile_dir, cfg.profile_start_step, cfg.profile_stop_step,
+                              cfg.profile_signal_steps)
+
+    # pre-trace the compiled step for every stage's input shape
+    for stage_cfg, stage_ds in zip(stages, stage_datasets):
+        x_spec, y_spec = stage_ds.element_spec
+        lr_size = stage_cfg['hr_size'] // cfg.upscale_factor
+        x_spec = tf.TensorSpec(
+            (stage_cfg['batch_size'], lr_size, lr_size, 3), x_spec.dtype)
+        y_spec = tf.TensorSpec(
+            (stage_cfg['batch_size'], stage_cfg['hr_size'], stage_cfg['hr_size'], 3), y_spec.dtype)
+        for compute_metrics in (False, True):
+            train_step.get_concrete_function(x_spec, y_spec, compute_metrics)
+
+    i = start_iteration
+    stage = curriculum_stage(stages, i)
+    if int(stage_var.numpy()) != stage:
+        print(f'Checkpoint was in curriculum stage {int(stage_var.numpy())}, resuming in stage {stage}')
+    while i < cfg.iterations:
+        if stage + 1 < len(stages):
+            stage_end = min(stages[stage + 1]['start_iteration'], cfg.iterations)
+        else:
+            stage_end = cfg.iterations
+        print(f"Curriculum stage {stage}: hr_size {stages[stage]['hr_size']}, "
+              f"batch_size {stages[stage]['batch_size']}, iterations {i}-{stage_end}")
+        for x_batch, y_batch in timer.timed_iter(stage_datasets[stage]):
+            if i >= stage_end:
+                break
+
+            profiler.step(i)
+            compute_metrics = (i + 1) % cfg.metrics_every == 0
+            with profiler.trace(i):
+                if timer.enabled:
+                    # separate graphs so every phase can be synced and timed
+                    with timer.phase('forward_backward') as wait_for:
+                        train_loss, gradient, y_pred = compute_gradients(
+                            x_batch, y_batch)
+                        wait_for(gradient)
+                    with timer.phase('apply') as wait_for:
+                        apply_gradients(gradient)
+                        wait_for(optimizer.iterations)
+                    with timer.phase('metrics') as wait_for:
+                        update_metrics(train_loss, y_batch,
+                                       y_pred, compute_metrics)
+                        wait_for(train_loss_metric.result())
+                else:
+                    train_step(x_batch, y_batch, compute_metrics)
+
+            # every n iterations
+            if (i + 1) % cfg.save_every == 0:
+                train_loss = train_loss_metric.result()
+                train_mean_psnr = train_psnr_metric.result()
+                train_mean_ssim = train_ssim_metric.result()
+
+                if cfg.async_validation:
+                    print(f"Iteration {i + 1}, "
+                          f"loss: {train_loss}, "
+                          f"psnr: {train_mean_psnr}, "
+                          f"ssim: {train_mean_ssim}")
+                    # ModelCheckpoint, picked up by val_worker.py
+                    with timer.phase('checkpoint'):
+                        iteration.assign(i + 1)
+                        train_loss_var.assign(train_loss)
+                        stage_var.assign(stage)
+                        checkpoint_path = latest_checkpoint_manager.save()
+                        if cfg.archive_every and (i + 1) % cfg.archive_every == 0:
+                            archive_checkpoint(checkpoint_path, cfg.archive_dir, i + 1)
+                else:
+                    # evaluate metrics in val_ds
+                    with timer.phase('validation'):
+                        val_record = validation_record(model, loss_fn, cfg.upscale_factor, val_batches,
+                                                       proxy_batches, i + 1, cfg.full_val_every)
+                    val_mean_psnr = val_record['val_psnr']
+                    full_val = ''
+                    if 'full_val_psnr' in val_record:
+                        full_val = f", full_val_psnr: {val_record['full_val_psnr']}"
+                    # print loss and metrics
+                    print(f"Iteration {i + 1}, "
+                          f"loss: {train_loss}, "
+                          f"val_loss: {val_record['val_loss']}, "
+                          f"psnr: {train_mean_psnr}, "
+                          f"val_psnr: {val_mean_psnr},"
+                          f"ssim: {train_mean_ssim}, "
+                          f"val_ssim: {val_record['val_ssim']}{full_val}")
+
+                    # ModelCheckpoint
+                    with timer.phase('checkpoint'):
+                        iteration.assign(i + 1)
+                        train_loss_var.assign(train_loss)
+                        stage_var.assign(stage)
+                        checkpoint_path = latest_checkpoint_manager.save()
+                        if cfg.archive_every and (i + 1) % cfg.archive_every == 0:
+                            archive_checkpoint(checkpoint_path, cfg.archive_dir, i + 1)
+                    # history
+                    append_history(dict({'iteration': i + 1,
+                                         'loss': float(train_loss)}, **val_record), cfg.history_file)
+
+                    # save best
+                    if val_mean_psnr > max_psnr:
+                        max_psnr = val_mean_psnr
+                        # weight.h5
+                        model.save_weights(cfg.best_weights_file)
+                        # save history
+                        history_header['best_iteration'] = i + 1
+                        history_header['best_val_psnr'] = float(max_psnr)
+                        save_history_header(history_header, cfg.history_file)
+                        print('save the best')
+
+                # timing next to the history
+                timer.save(i + 1, cfg.timing_file)
+
+                # reset
+                train_loss_metric.reset_state()
+                train_psnr_metric.reset_state()
+                train_ssim_metric.reset_state()
+
+            i += 1
+        stage += 1
+    profiler.stop()
 
     ###########################
     # no need to modify
@@ -170,4 +273,6 @@ def train():
 
 if __name__ == '__main__':
     sys.setrecursionlimit(2000)
-    train()
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    args = parser.parse_args()
+    train(load_config(args.config, args.override))
@@ -0,0 +1,44 @@
+import os
+import tensorflow as tf
+
+
+def archive_checkpoint(checkpoint_path, archive_dir, iteration):
+    """copy the files of a saved checkpoint to archive_dir/ckpt-<iteration>, out of reach of the
+    CheckpointManager that rotates checkpoint_path away"""
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(archive_dir, f'ckpt-{iteration:08d}')
+    for file in tf.io.gfile.glob(checkpoint_path + '.*'):
+        # ckpt-3.index -> ckpt-00001500.index, a checkpoint is read by its prefix only
+        tf.io.gfile.copy(file, archive_path + file[len(checkpoint_path):], overwrite=True)
+    return archive_path
+
+
+def list_checkpoints(paths):
+    """.h5 weights files and tf checkpoint prefixes of the paths, directories are expanded and sorted by name"""
+    checkpoints = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            checkpoints += [os.path.join(path, name) for name in names if name.endswith('.h5')]
+            checkpoints += [os.path.join(path, name[:-len('.index')]) for name in names if name.endswith('.index')]
+        else:
+            checkpoints.append(path)
+    return checkpoints
+
+
+def checkpoint_files(checkpoint):
+    """the files holding the weights of an .h5 file or a checkpoint prefix"""
+    if checkpoint.endswith('.h5'):
+        return [checkpoint]
+    return sorted(tf.io.gfile.glob(checkpoint + '.data-*'))
+
+
+def load_generator_weights(model, checkpoint):
+    """weights of an .h5 file, or the generator of a train_psnr.py ('model') / train_gan.py ('generator')
+    checkpoint, into model in place"""
+    if checkpoint.endswith('.h5'):
+        model.load_weights(checkpoint)
+        return
+    names = [name for name, _ in tf.train.list_variables(checkpoint)]
+    key = 'generator' if any(name.startswith('generator/') for name in names) else 'model'
+    tf.train.Checkpoint(**{key: model}).restore(checkpoint).expect_partial().assert_existing_objects_matched()
@@ -42,11 +42,16 @@ def make_perceptual_loss(criterion='l1', output='54', before_act=True):
     if before_act:
         vgg.layers[output_layer].activation = None
     fea_out = Model(vgg.input, vgg.layers[output_layer].output)
+    # frozen, no gradients are built for the vgg weights
+    fea_out.trainable = False
 
     def perceptual_loss(y_true, y_pred):
-        y_true = preprocess_input(tf.cast(y_true, tf.float32)) / 12.75
-        y_pred = preprocess_input(y_pred) / 12.75
-        return loss_fn(fea_out(y_true), fea_out(y_pred))
+        # real and fake go through preprocess and vgg as one batch
+        y_true = tf.stop_gradient(tf.cast(y_true, tf.float32))
+        images = preprocess_input(tf.concat([y_true, y_pred], axis=0)) / 12.75
+        features = fea_out(images, training=False)
+        true_features, pred_features = tf.split(features, 2, axis=0)
+        return loss_fn(true_features, pred_features)
 
     return perceptual_loss
 
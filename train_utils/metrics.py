@@ -1,50 +1,100 @@
+import functools
+import numpy as np
 import tensorflow as tf
 from utils.postprocess import post_process
 from utils.color_utils import rgb_to_ycbcr_y
+from utils.gradient_map import gradient_intensity_map
 
+METRICS = ['psnr', 'ssim', 'mse', 'gradient_error']
+# bump when image_metrics changes, cached per image metrics of older versions are not used (utils/eval_cache.py)
+METRICS_VERSION = 1
 
-def calculate_psnr(y_true, y_pred, scale, y_only=True):
+
+def image_metrics(y_true, y_pred, scale, y_only=True, mse=False, gradient_error=False):
     """
+    per image metrics of a batch, the images are post processed, cropped and converted once for all of them
     :param y_true: image batch    :param y_pred: image batch
     :param scale: upscale factor
-    :param y_only:
-    :return:
+    :param y_only: psnr / ssim / mse on the y channel
+    :param mse: add the mse of the compared images
+    :param gradient_error: add the mean abs difference of the gradient intensity maps (rgb)
+    :return: {metric: (batch,) tensor}
     """
     # post process
     y_true = post_process(y_true)
     y_pred = post_process(y_pred)
     # crop edge
     boundarypixels = 6 + scale
-    y_true = y_true[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :]
-    y_pred = y_pred[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :]
+    y_true = tf.cast(y_true[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :], tf.float32)
+    y_pred = tf.cast(y_pred[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :], tf.float32)
+    metrics = {}
+    if gradient_error:
+        metrics['gradient_error'] = tf.reduce_mean(
+            tf.abs(gradient_intensity_map(y_true) - gradient_intensity_map(y_pred)), axis=[1, 2, 3])
     # convert to y
     if y_only:
         y_true = rgb_to_ycbcr_y(y_true)
         y_pred = rgb_to_ycbcr_y(y_pred)
-    # calculate psnr
-    batch_psnr = tf.image.psnr(y_true, y_pred, max_val=255)
-    return tf.reduce_mean(batch_psnr)
+    # psnr from the mse, as tf.image.psnr
+    batch_mse = tf.reduce_mean(tf.square(y_true - y_pred), axis=[1, 2, 3])
+    metrics['psnr'] = 20.0 * np.log10(255.0) - 10.0 * tf.math.log(batch_mse) / np.log(10.0)
+    metrics['ssim'] = tf.image.ssim(y_true, y_pred, max_val=255)
+    if mse:
+        metrics['mse'] = batch_mse
+    return metrics
 
 
-def calculate_ssim(y_true, y_pred, scale, y_only=True):
-    """
-    :param y_true: image batch    :param y_pred: image batch
-    :param scale: upscale factor
-    :param y_only:
-    :return:
-    """
-    # post process
-    y_true = post_process(y_true)
-    y_pred = post_process(y_pred)
-    # crop edge
-    boundarypixels = 6 + scale
-    y_true = y_true[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :]
-    y_pred = y_pred[:, boundarypixels:-boundarypixels, boundarypixels:-boundarypixels, :]
-    # convert to y
-    if y_only:
-        y_true = rgb_to_ycbcr_y(y_true)
-        y_pred = rgb_to_ycbcr_y(y_pred)
+@functools.lru_cache(maxsize=None)
+def compiled_image_metrics(scale, y_only=True, mse=False, gradient_error=False):
+    """image_metrics as a tf.function for any batch / image size, one per process and setting so that every
+    validation / evaluation reuses the same trace"""
+    spec = tf.TensorSpec([None, None, None, 3], tf.float32)
+    return tf.function(lambda y_true, y_pred: image_metrics(y_true, y_pred, scale, y_only, mse, gradient_error),
+                       input_signature=[spec, spec])
+
+
+class MetricsEngine:
+    """image_metrics of batches in one compiled call each, aggregated over every image since reset.
+    Any batch / image size; engines with the same settings share the compiled call, it is traced once."""
+
+    def __init__(self, scale, y_only=True, mse=False, gradient_error=False):
+        self.keys = [key for key, enabled in zip(METRICS, (True, True, mse, gradient_error)) if enabled]
+        self._compute = compiled_image_metrics(scale, y_only, mse, gradient_error)
+        self.reset()
+
+    def reset(self):
+        self.values = {key: [] for key in self.keys}
+
+    def update(self, y_true, y_pred):
+        """per image metrics of one batch as numpy arrays, also added to the aggregate"""
+        batch = {key: value.numpy() for key, value in
+                 self._compute(tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)).items()}
+        for key in self.keys:
+            self.values[key].append(batch[key])
+        return batch
+
+    def add(self, per_image):
+        """per image metrics computed elsewhere (e.g. cached), {metric: value or array}"""
+        for key in self.keys:
+            self.values[key].append(np.atleast_1d(np.asarray(per_image[key], dtype=np.float32)))
+
+    @property
+    def count(self):
+        return sum(len(v) for v in self.values['psnr'])
 
-    # calculate psnr
-    batch_ssim = tf.image.ssim(y_true, y_pred, max_val=255)
-    return tf.reduce_mean(batch_ssim)
+    def per_image(self):
+        return {key: np.concatenate(values) if values else np.zeros(0) for key, values in self.values.items()}
+
+    def result(self):
+        """per image mean of every metric"""
+        return {key: float(values.mean()) for key, values in self.per_image().items()}
+
+
+def calculate_psnr(y_true, y_pred, scale, y_only=True):
+    """batch mean psnr, see image_metrics"""
+    return tf.reduce_mean(image_metrics(y_true, y_pred, scale, y_only)['psnr'])
+
+
+def calculate_ssim(y_true, y_pred, scale, y_only=True):
+    """batch mean ssim, see image_metrics"""
+    return tf.reduce_mean(image_metrics(y_true, y_pred, scale, y_only)['ssim'])
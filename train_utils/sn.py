@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 
@@ -27,6 +28,8 @@ class SpectralNormalization(tf.keras.layers.Wrapper):
       AssertionError: If not initialized with a `Layer` instance.
       ValueError: If initialized with negative `power_iterations`.
       AttributeError: If `layer` does not has `kernel` or `embeddings` attribute.
+    The kernel variable holds the raw weights, the previous version of this wrapper assigned w / sigma into it.
+    Kernels of its checkpoints are already normalized (sigma ~ 1) and give the same outputs.
     """
 
     def __init__(self, layer: tf.keras.layers, power_iterations: int = 1, **kwargs):
@@ -65,27 +68,42 @@ class SpectralNormalization(tf.keras.layers.Wrapper):
             name="sn_u",
             dtype=self.w.dtype,
         )
+        # v is not saved: the variables stay those of the previous wrapper (kernel, sn_u), so its checkpoints and
+        # h5 weights load unchanged. It starts as the v of u and the kernel and is refreshed with u, also after a
+        # restore (update_spectral_normalization), so it is never random
+        with tf.init_scope():
+            v = tf.Variable(self._v_of(self.u), trainable=False, name="sn_v", dtype=self.w.dtype)
+        # bypass keras attribute tracking
+        object.__setattr__(self, "v", v)
 
-    def call(self, inputs, training=None):
-        """Call `Layer`"""
-        if training is None:
-            training = tf.keras.backend.learning_phase()
-
-        if training:
-            self.normalize_weights()
+    def _v_of(self, u):
+        w = tf.reshape(self.w, [-1, self.w_shape[-1]])
+        return tf.stop_gradient(tf.math.l2_normalize(tf.matmul(u, w, transpose_b=True)))
 
-        output = self.layer(inputs)
+    def call(self, inputs, training=None):
+        """Call `Layer` with the spectral normalized kernel.
+        The kernel variable itself is never rescaled, the normalized kernel
+        is swapped in for the duration of the wrapped layer's call.
+        """
+        w_bar = self.normalized_weights()
+        # bypass keras attribute tracking, which would untrack the kernel variable
+        attr = "kernel" if hasattr(self.layer, "kernel") else "embeddings"
+        object.__setattr__(self.layer, attr, w_bar)
+        try:
+            output = self.layer(inputs)
+        finally:
+            object.__setattr__(self.layer, attr, self.w)
         return output
 
     def compute_output_shape(self, input_shape):
         return tf.TensorShape(self.layer.compute_output_shape(input_shape).as_list())
 
-    def normalize_weights(self):
-        """Generate spectral normalized weights.
-        This method will update the value of `self.w` with the
-        spectral normalized value, so that the layer is ready for `call()`.
+    def update_power_iteration(self):
+        """Refine the cached singular vectors `u`, `v` of the kernel.
+        Run once per optimizer step (see `update_spectral_normalization`),
+        every call within that step then reuses the same `u`, `v`.
+        Also run it after restoring the variables, `v` is not saved.
         """
-
         w = tf.reshape(self.w, [-1, self.w_shape[-1]])
         u = self.u
 
@@ -93,15 +111,27 @@ class SpectralNormalization(tf.keras.layers.Wrapper):
             for _ in range(self.power_iterations):
                 v = tf.math.l2_normalize(tf.matmul(u, w, transpose_b=True))
                 u = tf.math.l2_normalize(tf.matmul(v, w))
-            u = tf.stop_gradient(u)
-            v = tf.stop_gradient(v)
-            sigma = tf.matmul(tf.matmul(v, w), u, transpose_b=True)
-            self.u.assign(tf.cast(u, self.u.dtype))
-            self.w.assign(
-                tf.cast(tf.reshape(self.w / sigma, self.w_shape), self.w.dtype)
-            )
+            self.u.assign(tf.cast(tf.stop_gradient(u), self.u.dtype))
+            self.v.assign(tf.cast(tf.stop_gradient(v), self.v.dtype))
+
+    def normalized_weights(self):
+        """Spectral normalized kernel `w / sigma`.
+        `sigma = v w u^T` is differentiable in `w`, `u` and `v` are constants.
+        """
+        w = tf.reshape(self.w, [-1, self.w_shape[-1]])
+        sigma = tf.matmul(tf.matmul(self.v, w), self.u, transpose_b=True)
+        return tf.cast(tf.reshape(w / sigma, self.w_shape), self.w.dtype)
 
     def get_config(self):
         config = {"power_iterations": self.power_iterations}
         base_config = super().get_config()
         return {**base_config, **config}
+
+
+def update_spectral_normalization(model):
+    """One power iteration step for every `SpectralNormalization` layer of the model.
+    Call it once per optimizer step before the forward passes of that step, and after restoring a checkpoint.
+    """
+    for layer in model.submodules:
+        if isinstance(layer, SpectralNormalization):
+            layer.update_power_iteration()
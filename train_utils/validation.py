@@ -0,0 +1,80 @@
+import time
+import numpy as np
+from datasets.dataloader import load_img_pairs_to_memory, batch_img_pairs_by_shape
+from train_utils.metrics import MetricsEngine
+
+
+def load_val_batches(lr_dir, hr_dir, batch_size):
+    """decoded validation set, kept in memory and batched by image shape"""
+    return batch_img_pairs_by_shape(load_img_pairs_to_memory(lr_dir, hr_dir), batch_size)
+
+
+def proxy_crop_batches(img_pairs, crop_size, crops_per_image, batch_size, scale, seed=0):
+    """fixed lr crops of crop_size x crop_size with their hr crops, batched: the center crop and crops_per_image - 1
+    random crops of every image, the same for every call with the same seed.
+    Images smaller than crop_size are skipped"""
+    rng = np.random.RandomState(seed)
+    crops = []
+    for lr_img, hr_img in img_pairs:
+        height, width = lr_img.shape[:2]
+        if height < crop_size or width < crop_size:
+            continue
+        corners = [((height - crop_size) // 2, (width - crop_size) // 2)]
+        corners += [(rng.randint(0, height - crop_size + 1), rng.randint(0, width - crop_size + 1))
+                    for _ in range(crops_per_image - 1)]
+        for y, x in corners:
+            crops.append((lr_img[y:y + crop_size, x:x + crop_size],
+                          hr_img[y * scale:(y + crop_size) * scale, x * scale:(x + crop_size) * scale]))
+    if not crops:
+        raise ValueError(f'no validation image is at least {crop_size} x {crop_size}')
+    return batch_img_pairs_by_shape(crops, batch_size)
+
+
+def load_validation(cfg):
+    """(full resolution batches, proxy crop batches) of the validation set, None for the unused one"""
+    img_pairs = load_img_pairs_to_memory(cfg.val_lr_dir, cfg.val_hr_dir)
+    val_batches = None
+    if not cfg.proxy_validation or cfg.full_val_every:
+        val_batches = batch_img_pairs_by_shape(img_pairs, cfg.val_batch_size)
+    proxy_batches = None
+    if cfg.proxy_validation:
+        proxy_batches = proxy_crop_batches(img_pairs, cfg.proxy_crop_size, cfg.proxy_crops_per_image,
+                                           cfg.proxy_batch_size, cfg.upscale_factor, cfg.proxy_seed)
+    return val_batches, proxy_batches
+
+
+def validate(model, val_batches, loss_fn, scale):
+    """
+    :param model: generator
+    :param val_batches: list of (lr_batch, hr_batch) from load_val_batches
+    :param loss_fn: pixel loss
+    :param scale: upscale factor
+    :return: per image mean of val_loss, val_psnr, val_ssim
+    """
+    total_val_loss = 0.0
+    num = 0
+    metrics = MetricsEngine(scale, y_only=True)
+    for lr_batch, hr_batch in val_batches:
+        n = lr_batch.shape[0]
+        sr_batch = model(lr_batch, training=False)
+        # the loss is a batch mean over equally sized images, weight it by batch size
+        total_val_loss += float(loss_fn(y_true=hr_batch, y_pred=sr_batch)) * n
+        metrics.update(hr_batch, sr_batch)
+        num += n
+    result = metrics.result()
+    return total_val_loss / num, result['psnr'], result['ssim']
+
+
+def validation_record(model, loss_fn, scale, val_batches, proxy_batches, iteration, full_every=0):
+    """val_loss / val_psnr / val_ssim of one validation for the history, on the proxy crops when there are
+    proxy_batches (full resolution otherwise); with proxy_batches also full_val_* every full_every iterations"""
+    start = time.perf_counter()
+    val_loss, val_psnr, val_ssim = validate(model, proxy_batches or val_batches, loss_fn, scale)
+    record = {'val_loss': float(val_loss), 'val_psnr': float(val_psnr), 'val_ssim': float(val_ssim),
+              'val_seconds': time.perf_counter() - start}
+    if proxy_batches and full_every and iteration % full_every == 0:
+        start = time.perf_counter()
+        val_loss, val_psnr, val_ssim = validate(model, val_batches, loss_fn, scale)
+        record.update({'full_val_loss': float(val_loss), 'full_val_psnr': float(val_psnr),
+                       'full_val_ssim': float(val_ssim), 'full_val_seconds': time.perf_counter() - start})
+    return record
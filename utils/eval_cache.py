@@ -0,0 +1,99 @@
+"""
+Content addressed cache of per image evaluation results, one sqlite file.
+An entry is keyed by
+    model key   sha256 of the weights file(s) + the build settings / inference precision of the model
+    image key   sha256 of the lr and hr image files
+    version     train_utils.metrics.METRICS_VERSION
+and holds the per image metrics as JSON, optionally with the sr output as png.
+The least recently used entries are dropped when the store grows above max_bytes.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_key(weights_files, settings, precision='float32'):
+    """weights_files: an .h5 file, or the data files of a tf checkpoint"""
+    if isinstance(weights_files, str):
+        weights_files = [weights_files]
+    description = json.dumps({'settings': settings, 'precision': precision}, sort_keys=True, default=str)
+    return hashlib.sha256((''.join(file_hash(f) for f in weights_files) + description).encode()).hexdigest()
+
+
+def image_pair_key(lr_file, hr_file):
+    return hashlib.sha256((file_hash(lr_file) + file_hash(hr_file)).encode()).hexdigest()
+
+
+class EvalCache:
+    def __init__(self, path, max_bytes=512 * 2 ** 20, store_outputs=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.store_outputs = store_outputs
+        self.hits = 0
+        self.misses = 0
+        # parallel eval workers share the file: write ahead log so that readers never wait, and every write is
+        # committed right away so that no worker holds the write lock for longer than one statement
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (model_key TEXT, image_key TEXT, version INTEGER, '
+                                'metrics TEXT, output BLOB, size INTEGER, last_used REAL, '
+                                'PRIMARY KEY (model_key, image_key, version))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+
+    def get(self, model_key, image_key, version):
+        """cached metrics dict, or None"""
+        row = self.connection.execute('SELECT metrics FROM entries WHERE model_key=? AND image_key=? AND version=?',
+                                      (model_key, image_key, version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute('UPDATE entries SET last_used=? WHERE model_key=? AND image_key=? AND version=?',
+                                (time.time(), model_key, image_key, version))
+        self.connection.commit()
+        return json.loads(row[0])
+
+    def get_output(self, model_key, image_key, version):
+        """cached png bytes of the sr output, or None"""
+        row = self.connection.execute('SELECT output FROM entries WHERE model_key=? AND image_key=? AND version=?',
+                                      (model_key, image_key, version)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, model_key, image_key, version, metrics, output=None):
+        metrics = json.dumps(metrics)
+        output = output if self.store_outputs else None
+        size = len(metrics) + (len(output) if output is not None else 0)
+        self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (model_key, image_key, version, metrics, output, size, time.time()))
+        self.connection.commit()
+
+    def flush(self):
+        """drop least recently used entries down to max_bytes"""
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        evicted = []
+        if total > self.max_bytes:
+            for rowid, size in self.connection.execute('SELECT rowid, size FROM entries ORDER BY last_used'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                total -= size
+            self.connection.executemany('DELETE FROM entries WHERE rowid=?', evicted)
+        self.connection.commit()
+        if evicted:
+            # give the pages of evicted outputs back to the file system
+            self.connection.execute('VACUUM')
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -1,133 +1,220 @@
 """
-history = {
-    'iteration': [],
-    'loss': [],
-    'val_loss': [],
-    'val_psnr': [],
-    'val_ssim': [],
-    'best_iteration': 0,
-    'best_val_psnr': float('inf'),
-}
+Append-only training history.
+history_file is JSON Lines, one record per logging event:
+    {"iteration": 50, "loss": ..., "val_loss": ..., "val_psnr": ..., "val_ssim": ...}   (psnr)
+    {"iteration": 10, "gen_loss": ..., "disc_loss": ...}                              (gan)
+the small header next to it (history_file + '.header.json') holds
+    {"best_iteration": 0, "best_val_psnr": 0.0}
+Appends are O(1), resuming reads only the tail of the file.
+Legacy whole-dict JSON histories are migrated on first use (or with `python -m utils.history old new`).
 """
 import os
+import sys
 import json
+import argparse
 import matplotlib.pyplot as plt
 
 
-def is_history_complete(history):
-    keys = ['iteration', 'loss', 'val_loss', 'val_psnr',
-            'val_ssim', 'best_iteration', 'best_val_psnr']
-    for key in keys:
-        if key not in history or not history[key]:
-            return False
-    return True
-
-
-def is_gan_history_complete(history):
-    keys = ['iteration', 'gen_loss', 'disc_loss']
-    for key in keys:
-        if key not in history or not history[key]:
-            return False
-    return True
+def header_file_of(history_file):
+    return history_file + '.header.json'
+
+
+def append_history(record, history_file):
+    """append one record, O(1) in the length of the history"""
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+def save_history_header(header, history_file):
+    """atomically replace the header"""
+    header_file = header_file_of(history_file)
+    tmp_file = header_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_file, header_file)
+
+
+def load_history_header(history_file):
+    header_file = header_file_of(history_file)
+    if not os.path.exists(header_file):
+        return None
+    with open(header_file, 'r') as f:
+        return json.load(f)
+
+
+def iter_history(history_file):
+    """stream the records, a torn last line (crash while appending) is skipped"""
+    if not os.path.exists(history_file):
+        return
+    with open(history_file, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                return
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_last_record(history_file, block_size=4096):
+    """last complete record without parsing the whole file, None if there is none"""
+    if not os.path.exists(history_file):
+        return None
+    with open(history_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+            # ignore a torn last line, then find where the last complete line starts
+            complete = data[:data.rfind(b'\n') + 1].rstrip(b'\n')
+            line_start = complete.rfind(b'\n')
+            if complete and (line_start != -1 or position == 0):
+                return json.loads(complete[line_start + 1:])
+    return None
+
+
+def _repair_tail(history_file):
+    """drop a torn last line so the next append starts on a fresh line"""
+    with open(history_file, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        position = size
+        while position > 0:
+            read_size = min(4096, position)
+            position -= read_size
+            f.seek(position)
+            newline = f.read(read_size).rfind(b'\n')
+            if newline != -1:
+                f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+
+def load_history(history_file):
+    """the whole history as a dict of lists plus the header keys (for plotting and analysis)"""
+    history = {}
+    for record in iter_history(history_file):
+        for key, value in record.items():
+            history.setdefault(key, []).append(value)
+    header = load_history_header(history_file)
+    if header is not None:
+        history.update(header)
+    return history
+
+
+def migrate_json_history(json_file, history_file):
+    """convert a legacy whole-dict JSON history into records + header"""
+    with open(json_file, 'r') as f:
+        legacy = json.load(f)
+    list_keys = [key for key, value in legacy.items() if isinstance(value, list)]
+    num = len(legacy.get('iteration', []))
+    tmp_file = history_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        for index in range(num):
+            record = {key: legacy[key][index] for key in list_keys if index < len(legacy[key])}
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_file, history_file)
+    header = {key: value for key, value in legacy.items() if key not in list_keys}
+    if header:
+        save_history_header(header, history_file)
+    print(f'Migrated {num} records from {json_file} to {history_file}')
+
+
+def _legacy_file_of(history_file):
+    legacy_file = os.path.splitext(history_file)[0] + '.json'
+    if legacy_file != history_file and os.path.exists(legacy_file):
+        return legacy_file
+    return None
+
+
+def _continue(history_file, header):
+    if not os.path.exists(history_file):
+        legacy_file = _legacy_file_of(history_file)
+        if legacy_file is not None:
+            migrate_json_history(legacy_file, history_file)
+    if os.path.exists(history_file):
+        _repair_tail(history_file)
+        last_record = read_last_record(history_file)
+        if last_record is not None and 'iteration' in last_record:
+            start_iteration = last_record['iteration']
+            print(
+                f'Restoring from latest history,start from iteration{start_iteration}')
+            return start_iteration
+    print('No history found, recording from scratch')
+    with open(history_file, 'w'):
+        pass
+    if header is not None:
+        save_history_header(header, history_file)
+    return 0
 
 
 def create_or_continue_history(history_file):
-    if os.path.exists(history_file):
-        with open(history_file, 'r') as f:
-            history = json.load(f)
-            if is_history_complete(history):
-                start_iteration = history['iteration'][-1]
-                print(
-                    f'Restoring from latest history,start from iteration{start_iteration}')
-            else:
-                print('No history found, recording from scratch')
-                history = {
-                    'iteration': [],
-                    'loss': [],
-                    'val_loss': [],
-                    'val_psnr': [],
-                    'val_ssim': [],
-                    'best_iteration': 0,
-                    'best_val_psnr': float('inf'),
-                }
-                with open(history_file, 'w') as f:
-                    json.dump(history, f)
-                start_iteration = 0
-
-    else:
-        print('No history found, recording from scratch')
-        history = {
-            'iteration': [],
-            'loss': [],
-            'val_loss': [],
-            'val_psnr': [],
-            'val_ssim': [],
-            'best_iteration': 0,
-            'best_val_psnr': float('inf'),
-        }
-        with open(history_file, 'w') as f:
-            json.dump(history, f)
-        start_iteration = 0
-    return history, start_iteration
+    """:return: header {best_iteration, best_val_psnr}, iteration to start from"""
+    start_iteration = _continue(
+        history_file, {'best_iteration': 0, 'best_val_psnr': 0.0})
+    header = load_history_header(history_file)
+    if header is None:
+        # records without header, rebuild it from the records
+        header = {'best_iteration': 0, 'best_val_psnr': 0.0}
+        for record in iter_history(history_file):
+            if record.get('val_psnr', 0.0) > header['best_val_psnr']:
+                header = {'best_iteration': record['iteration'], 'best_val_psnr': record['val_psnr']}
+        save_history_header(header, history_file)
+    return header, start_iteration
 
 
 def create_or_continue_gan_history(history_file):
-    if os.path.exists(history_file):
-        with open(history_file, 'r') as f:
-            history = json.load(f)
-            if is_gan_history_complete(history):
-                start_iteration = history['iteration'][-1]
-                print(
-                    f'Restoring from latest history,start from iteration{start_iteration}')
-            else:
-                print('No history found, recording from scratch')
-                history = {
-                    'iteration': [],
-                    'gen_loss': [],
-                    'disc_loss': [],
-                }
-                with open(history_file, 'w') as f:
-                    json.dump(history, f)
-                start_iteration = 0
-
-    else:
-        print('No history found, recording from scratch')
-        history = {
-            'iteration': [],
-            'gen_loss': [],
-            'disc_loss': [],
-        }
-        with open(history_file, 'w') as f:
-            json.dump(history, f)
-        start_iteration = 0
-    return history, start_iteration
-
-
-def save_history(history, history_file):
-    with open(history_file, 'w') as f:
-        json.dump(history, f)
-
-
-def plot_history(history):
-    # plot loss and metrics after train_val
+    """:return: iteration to start from"""
+    return _continue(history_file, None)
+
+
+def plot_history(history_file, save_path):
+    # plot loss and metrics after train_val, streaming only the plotted keys
+    iterations, loss, val_loss, val_psnr, val_ssim = [], [], [], [], []
+    for record in iter_history(history_file):
+        iterations.append(record['iteration'])
+        loss.append(record['loss'])
+        val_loss.append(record['val_loss'])
+        val_psnr.append(record['val_psnr'])
+        val_ssim.append(record['val_ssim'])
+
     plt.figure(figsize=(12, 4))
 
     plt.subplot(1, 3, 1)
-    plt.plot(history['loss'], label='Train Loss')
-    plt.plot(history['val_loss'], label='Validation Loss')
+    plt.plot(iterations, loss, label='Train Loss')
+    plt.plot(iterations, val_loss, label='Validation Loss')
     plt.xlabel('Iteration')
     plt.ylabel('Loss')
     plt.legend()
 
     plt.subplot(1, 3, 2)
-    plt.plot(history['val_psnr'], label='Validation PSNR')
+    plt.plot(iterations, val_psnr, label='Validation PSNR')
     plt.xlabel('Iteration')
     plt.ylabel('PSNR')
     plt.legend()
 
     plt.subplot(1, 3, 3)
-    plt.plot(history['val_ssim'], label='Validation SSIM')
+    plt.plot(iterations, val_ssim, label='Validation SSIM')
     plt.xlabel('Iteration')
     plt.ylabel('SSIM')
     plt.legend()
-    plt.savefig()
+    plt.savefig(save_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='migrate a legacy JSON history')
+    parser.add_argument('json_file')
+    parser.add_argument('history_file')
+    args = parser.parse_args()
+    if os.path.exists(args.history_file):
+        sys.exit(f'{args.history_file} already exists')
+    migrate_json_history(args.json_file, args.history_file)
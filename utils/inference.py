@@ -0,0 +1,100 @@
+import numpy as np
+import tensorflow as tf
+
+# (number of 90 degree rotations, flipped first) of the x8 geometric self-ensemble
+ENSEMBLE_TRANSFORMS = [(k, flip) for k in range(4) for flip in (False, True)]
+
+
+def transform(x, k, flip):
+    if flip:
+        x = tf.image.flip_left_right(x)
+    return tf.image.rot90(x, k)
+
+
+def inverse_transform(x, k, flip):
+    x = tf.image.rot90(x, (4 - k) % 4)
+    if flip:
+        x = tf.image.flip_left_right(x)
+    return x
+
+
+def tile_starts(size, tile_size, tile_overlap):
+    """start offsets of tiles covering [0, size), the last one flush with the end so every tile has tile_size"""
+    if tile_size <= 0 or size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - tile_overlap))
+    return starts + [size - tile_size]
+
+
+class Upscaler:
+    """sr of lr image batches, a drop-in for model(lr, training=False) with
+    self_ensemble: the 8 flips / 90 degree rotations of the input run through one compiled forward pass as one batch
+        (two for non-square inputs, whose rotated copies have transposed shapes, more under max_batch), the outputs
+        are inverse transformed and averaged on device
+    tile_size: lr tiles of tile_size x tile_size overlapping by tile_overlap, each with its ensemble, overlaps averaged;
+        0 = whole images
+    cost_multiplier: forward pass pixels per input pixel since reset_cost, 1 for a plain model call
+    """
+
+    def __init__(self, model, scale, self_ensemble=False, max_batch=8, tile_size=0, tile_overlap=8):
+        if tile_size and tile_overlap >= tile_size:
+            raise ValueError(f'tile_overlap {tile_overlap} must be smaller than tile_size {tile_size}')
+        self.scale = scale
+        self.self_ensemble = self_ensemble
+        self.max_batch = max(1, max_batch)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        # any batch / image size, traced once
+        self._compiled_forward = tf.function(lambda x: model(x, training=False),
+                                             input_signature=[tf.TensorSpec([None, None, None, 3], tf.float32)])
+        self.reset_cost()
+
+    def reset_cost(self):
+        self.input_pixels = 0
+        self.forward_pixels = 0
+
+    @property
+    def cost_multiplier(self):
+        return self.forward_pixels / self.input_pixels if self.input_pixels else 1.0
+
+    def _forward(self, x):
+        self.forward_pixels += x.shape[0] * x.shape[1] * x.shape[2]
+        return self._compiled_forward(x)
+
+    def _ensemble(self, x):
+        if not self.self_ensemble:
+            return self._forward(x)
+        n = x.shape[0]
+        # transforms with the same output shape share a batch
+        groups = {}
+        for k, flip in ENSEMBLE_TRANSFORMS:
+            transformed = transform(x, k, flip)
+            groups.setdefault(tuple(transformed.shape), []).append((k, flip, transformed))
+        total = 0.0
+        for group in groups.values():
+            # whole transformed copies per forward pass, at most max_batch images
+            per_pass = max(1, self.max_batch // n)
+            for start in range(0, len(group), per_pass):
+                chunk = group[start:start + per_pass]
+                outputs = self._forward(tf.concat([t for _, _, t in chunk], axis=0))
+                for (k, flip, _), output in zip(chunk, tf.split(outputs, len(chunk), axis=0)):
+                    total += inverse_transform(output, k, flip)
+        return total / len(ENSEMBLE_TRANSFORMS)
+
+    def __call__(self, lr_batch, training=False):
+        lr_batch = tf.cast(lr_batch, tf.float32)
+        n, height, width, _ = lr_batch.shape
+        self.input_pixels += n * height * width
+        if not self.tile_size or (height <= self.tile_size and width <= self.tile_size):
+            return self._ensemble(lr_batch)
+        s = self.scale
+        output = np.zeros((n, height * s, width * s, 3), dtype=np.float32)
+        counts = np.zeros((1, height * s, width * s, 1), dtype=np.float32)
+        tile_height = min(height, self.tile_size)
+        tile_width = min(width, self.tile_size)
+        for y in tile_starts(height, self.tile_size, self.tile_overlap):
+            for x in tile_starts(width, self.tile_size, self.tile_overlap):
+                tile = self._ensemble(lr_batch[:, y:y + tile_height, x:x + tile_width])
+                output[:, y * s:(y + tile_height) * s, x * s:(x + tile_width) * s] += tile.numpy()
+                counts[:, y * s:(y + tile_height) * s, x * s:(x + tile_width) * s] += 1
+        return tf.constant(output / counts)
@@ -0,0 +1,75 @@
+import os
+import resource
+import collections
+import tensorflow as tf
+
+
+def process_rss_bytes():
+    """current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # no procfs, fall back to the peak
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """peak resident set size of this process (ru_maxrss is in KB on linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def device_memory_info(device='GPU:0'):
+    """allocator stats {'current', 'peak'} in bytes, None without that device"""
+    if not tf.config.list_physical_devices('GPU'):
+        return None
+    try:
+        return tf.config.experimental.get_memory_info(device)
+    except (ValueError, tf.errors.OpError):
+        return None
+
+
+def reset_device_peak(device='GPU:0'):
+    if not tf.config.list_physical_devices('GPU'):
+        return
+    try:
+        tf.config.experimental.reset_memory_stats(device)
+    except (ValueError, tf.errors.OpError):
+        pass
+
+
+class MemorySampler:
+    """Process RSS and device allocator stats sampled around training phases,
+    keeps the maximum per phase since the last reset.
+    """
+
+    def __init__(self, device='GPU:0'):
+        self.device = device
+        self.samples = collections.OrderedDict()
+
+    def begin(self, name):
+        reset_device_peak(self.device)
+
+    def end(self, name):
+        sample = {'rss': process_rss_bytes()}
+        info = device_memory_info(self.device)
+        if info is not None:
+            sample['device_current'] = info['current']
+            sample['device_peak'] = info['peak']
+        if name not in self.samples:
+            self.samples[name] = sample
+        else:
+            for key, value in sample.items():
+                self.samples[name][key] = max(self.samples[name].get(key, 0), value)
+
+    def summary(self):
+        """max bytes per phase, in MB"""
+        summary = collections.OrderedDict()
+        for name, sample in self.samples.items():
+            summary[name] = {key: value / 2 ** 20 for key, value in sample.items()}
+        summary['process'] = {'peak_rss': peak_rss_bytes() / 2 ** 20}
+        return summary
+
+    def reset(self):
+        self.samples.clear()
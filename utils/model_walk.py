@@ -0,0 +1,78 @@
+import tensorflow as tf
+
+
+def walk_layers(model, inputs, run_layer=None):
+    """Run a functional keras model one layer call at a time, in the same order keras does.
+    Intermediate tensors are released as soon as their last consumer ran, so memory
+    measured around a layer is close to what the whole model needs at that point.
+    :param model: functional keras model
+    :param inputs: input tensor (or nested inputs) of the model
+    :param run_layer: run_layer(layer, args, kwargs) -> outputs, wraps every layer call
+        (e.g. to measure it), defaults to layer(*args, **kwargs)
+    :return: model outputs
+    """
+    if run_layer is None:
+        def run_layer(layer, args, kwargs):
+            return layer(*args, **kwargs)
+
+    values = {}
+    for keras_tensor, value in zip(tf.nest.flatten(model.inputs), tf.nest.flatten(inputs)):
+        values[id(keras_tensor)] = value
+
+    # consumers per tensor, the model outputs are never released
+    consumers = {}
+    depth_keys = sorted(model._nodes_by_depth.keys(), reverse=True)
+    for depth in depth_keys:
+        for node in model._nodes_by_depth[depth]:
+            if node.is_input:
+                continue
+            for keras_tensor in node.keras_inputs:
+                consumers[id(keras_tensor)] = consumers.get(id(keras_tensor), 0) + 1
+    for keras_tensor in tf.nest.flatten(model.outputs):
+        consumers[id(keras_tensor)] = consumers.get(id(keras_tensor), 0) + 1
+
+    def to_value(x):
+        return values[id(x)] if id(x) in values else x
+
+    for depth in depth_keys:
+        for node in model._nodes_by_depth[depth]:
+            if node.is_input:
+                continue
+            args = tf.nest.map_structure(to_value, node.call_args)
+            kwargs = tf.nest.map_structure(to_value, node.call_kwargs)
+            outputs = run_layer(node.layer, args, kwargs)
+            for keras_tensor, value in zip(tf.nest.flatten(node.outputs), tf.nest.flatten(outputs)):
+                values[id(keras_tensor)] = value
+            # release inputs nobody needs anymore
+            for keras_tensor in node.keras_inputs:
+                consumers[id(keras_tensor)] -= 1
+                if consumers[id(keras_tensor)] == 0:
+                    values.pop(id(keras_tensor), None)
+
+    outputs = [values[id(keras_tensor)] for keras_tensor in tf.nest.flatten(model.outputs)]
+    return tf.nest.pack_sequence_as(model.outputs, outputs)
+
+
+def tag_block(inputs, outputs, block_type):
+    """While building a functional model: mark every layer between inputs and outputs (keras tensors)
+    as part of a block_type block. Nested blocks give paths like 'rrdb_ca/rdb' in layer.block_path
+    (outermost first), read by the cost report.
+    """
+    stop = set(id(t) for t in tf.nest.flatten(inputs))
+    visited = set()
+    pending = list(tf.nest.flatten(outputs))
+    while pending:
+        keras_tensor = pending.pop()
+        if id(keras_tensor) in stop or not hasattr(keras_tensor, '_keras_history'):
+            continue
+        layer, node_index, _ = keras_tensor._keras_history
+        if id(layer) in visited:
+            continue
+        visited.add(id(layer))
+        # a plain string, so keras does not track it
+        inner_path = getattr(layer, 'block_path', '')
+        # blocks that tag themselves are not tagged twice by their caller
+        if inner_path.split('/')[0] != block_type:
+            layer.block_path = block_type + ('/' + inner_path if inner_path else '')
+        pending.extend(tf.nest.flatten(layer._inbound_nodes[node_index].keras_inputs))
+    return outputs
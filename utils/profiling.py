@@ -0,0 +1,55 @@
+import signal
+import contextlib
+import tensorflow as tf
+
+
+class ProfilerWindow:
+    """tf.profiler trace windows over training steps.
+    A window is opened at `start_step` until `stop_step` (from the yaml), or for the next
+    `signal_steps` steps after the process receives SIGUSR1 (`kill -USR1 <pid>`).
+    Traces are written to log_dir and open in TensorBoard's profiler.
+    """
+
+    def __init__(self, log_dir, start_step=-1, stop_step=-1, signal_steps=20):
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.stop_step = stop_step
+        self.signal_steps = signal_steps
+        self.requested = False
+        self.active = False
+        self.stop_at = -1
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self.requested = True
+
+    def step(self, step):
+        """call once before every training step"""
+        if not self.active:
+            if step == self.start_step and self.stop_step > self.start_step:
+                self._start(self.stop_step)
+            elif self.requested:
+                self.requested = False
+                self._start(step + self.signal_steps)
+        elif step >= self.stop_at:
+            self.stop()
+
+    def trace(self, step):
+        """step context, only annotates while a window is open"""
+        if self.active:
+            return tf.profiler.experimental.Trace('train', step_num=step, _r=1)
+        return contextlib.nullcontext()
+
+    def _start(self, stop_at):
+        print(f'Profiler trace started, writing to {self.log_dir}')
+        tf.profiler.experimental.start(self.log_dir)
+        self.active = True
+        self.stop_at = stop_at
+
+    def stop(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
+            print('Profiler trace stopped')
+
@@ -0,0 +1,26 @@
+import tensorflow as tf
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    """size the tf thread pools, 0 keeps the tensorflow default.
+    must run before the first op executes"""
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+PRECISIONS = ['float32', 'mixed_float16', 'mixed_bfloat16', 'float16', 'bfloat16']
+
+
+def set_inference_precision(precision='float32'):
+    """keras dtype policy of the models built after this call, for inference only.
+    mixed_float16 / mixed_bfloat16: reduced precision activations, float32 weights;
+    float16 / bfloat16: weights too. Attention softmaxes and the generator output stay float32."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, one of {PRECISIONS}')
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def is_reduced_precision():
+    return tf.keras.mixed_precision.global_policy().compute_dtype != 'float32'
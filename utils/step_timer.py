@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import collections
+import contextlib
+import numpy as np
+
+
+class StepTimer:
+    """Wall time per training phase (data, forward, backward, apply, metrics, checkpoint, ...)
+    kept in a rolling window per phase. Disabled timers record nothing and never sync the device.
+    With a `utils.memory.MemorySampler` the memory around every phase is sampled as well.
+    """
+
+    def __init__(self, enabled=True, window=1000, memory=None):
+        self.enabled = enabled
+        self.window = window
+        self.memory = memory
+        self.times = collections.OrderedDict()
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        if name not in self.times:
+            self.times[name] = collections.deque(maxlen=self.window)
+        self.times[name].append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        with timer.phase('forward') as wait_for:
+            loss = ...
+            wait_for(loss, gradients)  # block on the device so the phase holds the actual compute
+        """
+        if not self.enabled:
+            yield lambda *tensors: None
+            return
+        pending = []
+        if self.memory is not None:
+            self.memory.begin(name)
+        start = time.perf_counter()
+        yield lambda *tensors: pending.extend(tensors)
+        for tensor in pending:
+            for t in _flatten(tensor):
+                if hasattr(t, 'numpy'):
+                    t.numpy()
+        self.record(name, time.perf_counter() - start)
+        if self.memory is not None:
+            self.memory.end(name)
+
+    def timed_iter(self, iterable, name='data'):
+        """iterate and record the time spent waiting for every element"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def summary(self):
+        """mean and rolling percentiles in ms per phase"""
+        summary = collections.OrderedDict()
+        for name, times in self.times.items():
+            times_ms = np.asarray(times) * 1000
+            summary[name] = {
+                'count': len(times_ms),
+                'mean': float(np.mean(times_ms)),
+                'p50': float(np.percentile(times_ms, 50)),
+                'p90': float(np.percentile(times_ms, 90)),
+                'p99': float(np.percentile(times_ms, 99)),
+            }
+        return summary
+
+    def save(self, iteration, timing_file):
+        """append the current summary as one json line"""
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(timing_file) or '.', exist_ok=True)
+        record = {'iteration': iteration, 'phases': self.summary()}
+        if self.memory is not None:
+            # peak since the previous save
+            record['memory_mb'] = self.memory.summary()
+            self.memory.reset()
+        with open(timing_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def _flatten(tensor):
+    if isinstance(tensor, (list, tuple)):
+        for t in tensor:
+            yield from _flatten(t)
+    else:
+        yield tensor
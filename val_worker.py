@@ -0,0 +1,85 @@
+"""Out-of-band validation for train_psnr.py (validation.async_validation: True).
+Watches latest_checkpoint_dir, evaluates every new checkpoint on the resident validation set,
+writes val metrics into the history and keeps the best weights.
+"""
+import sys
+import argparse
+import tensorflow as tf
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import generator_from_config
+from train_utils.losses import make_pixel_loss
+from train_utils.validation import load_validation, validation_record
+from utils.history import create_or_continue_history, append_history, save_history_header
+from utils.runtime import configure_threads
+
+
+def val_worker(cfg):
+    configure_threads(cfg.intra_op_threads, cfg.inter_op_threads)
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+    model = generator_from_config(cfg)
+    loss_fn = make_pixel_loss(criterion='l1')
+    # only the parts written by the trainer that validation needs, the optimizer is skipped
+    iteration = tf.Variable(0, dtype=tf.int64, trainable=False)
+    train_loss = tf.Variable(0.0, dtype=tf.float32, trainable=False)
+    checkpoint = tf.train.Checkpoint(
+        model=model, iteration=iteration, train_loss=train_loss)
+
+    # decoded once, evaluated for every checkpoint
+    val_batches, proxy_batches = load_validation(cfg)
+
+    history_header, last_iteration = create_or_continue_history(
+        cfg.history_file)
+    if last_iteration == 0:
+        max_psnr = 0.0
+    else:
+        max_psnr = history_header['best_val_psnr']
+
+    for checkpoint_path in tf.train.checkpoints_iterator(cfg.latest_checkpoint_dir,
+                                                         timeout=cfg.val_worker_timeout):
+        try:
+            checkpoint.restore(checkpoint_path).expect_partial()
+        except (tf.errors.NotFoundError, tf.errors.DataLossError):
+            # the trainer already rotated this checkpoint away
+            print(f'Skipping removed checkpoint: {checkpoint_path}')
+            continue
+        i = int(iteration.numpy())
+        if i <= last_iteration:
+            continue
+
+        val_record = validation_record(model, loss_fn, cfg.upscale_factor, val_batches, proxy_batches, i,
+                                       cfg.full_val_every)
+        val_mean_psnr = val_record['val_psnr']
+        print(f"Iteration {i}, "
+              f"loss: {float(train_loss.numpy())}, "
+              f"val_loss: {val_record['val_loss']}, "
+              f"val_psnr: {val_mean_psnr}, "
+              f"val_ssim: {val_record['val_ssim']}"
+              + (f", full_val_psnr: {val_record['full_val_psnr']}" if 'full_val_psnr' in val_record else ''))
+
+        # history
+        append_history(dict({'iteration': i,
+                             'loss': float(train_loss.numpy())}, **val_record), cfg.history_file)
+        last_iteration = i
+
+        # save best
+        if val_mean_psnr > max_psnr:
+            max_psnr = val_mean_psnr
+            model.save_weights(cfg.best_weights_file)
+            history_header['best_iteration'] = i
+            history_header['best_val_psnr'] = float(max_psnr)
+            save_history_header(history_header, cfg.history_file)
+            print('save the best')
+
+        if i >= cfg.iterations:
+            break
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    args = parser.parse_args()
+    val_worker(load_config(args.config, args.override))
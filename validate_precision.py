@@ -0,0 +1,87 @@
+"""Eval set PSNR / SSIM, latency and memory of the best weights at every inference precision
+(runtime.inference_precision), each in its own process. A precision passes when its PSNR is within
+--tolerance dB of float32; the exit code is 1 if any fails.
+
+python validate_precision.py --precisions mixed_float16 mixed_bfloat16 --tolerance 0.05
+python validate_precision.py -o model.tier=large --latency_size 128 --json outputs/logs/precision.json
+"""
+import sys
+import json
+import argparse
+import subprocess
+import tensorflow as tf
+
+from configs.load_psnr_config import load_config
+from configs.overrides import add_config_arguments
+from models.model_builder import generator_from_config
+from utils.memory import device_memory_info, reset_device_peak, process_rss_bytes, peak_rss_bytes
+from utils.runtime import set_inference_precision, PRECISIONS
+from benchmark_tiers import measure_latency
+from eval import evaluate, upscaler_from_config
+
+
+def measure_precision(cfg, precision, latency_size, latency_steps):
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+    set_inference_precision(precision)
+    model = generator_from_config(cfg)
+    model.load_weights(cfg.best_weights_file)
+    rss_before = process_rss_bytes()
+    reset_device_peak()
+    mean_psnr, mean_ssim = evaluate(upscaler_from_config(model, cfg), cfg.eval_lr_dir, cfg.eval_hr_dir,
+                                    cfg.upscale_factor)
+    result = {'precision': precision, 'psnr': float(mean_psnr), 'ssim': float(mean_ssim),
+              'weights_bytes': sum(v.shape.num_elements() * v.dtype.size for v in model.weights),
+              'rss_growth_bytes': peak_rss_bytes() - rss_before}
+    info = device_memory_info()
+    if info is not None:
+        result['device_peak_bytes'] = info['peak']
+    latency_ms, p90_ms = measure_latency(model, latency_size, steps=latency_steps,
+                                         device='/GPU:0' if physical_devices else '/CPU:0')
+    result.update({'latency_ms': latency_ms, 'p90_ms': p90_ms})
+    return result
+
+
+def validate_precision(precisions, tolerance, json_file=''):
+    # float32 is the reference
+    precisions = ['float32'] + [p for p in precisions if p != 'float32']
+    results = []
+    for precision in precisions:
+        # the dtype policy is process wide, and peaks of one precision must not hide the next
+        child = subprocess.run([sys.executable, 'validate_precision.py'] + sys.argv[1:] + ['--precision', precision],
+                               capture_output=True, text=True, check=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    reference = results[0]
+    memory_key = 'device_peak_bytes' if 'device_peak_bytes' in reference else 'rss_growth_bytes'
+    print(f"{'precision':<16}{'psnr':>9}{'d_psnr':>9}{'ssim':>9}{'weights MB':>12}{'memory MB':>11}{'ms':>9}  ok")
+    for r in results:
+        r['d_psnr'] = r['psnr'] - reference['psnr']
+        r['passed'] = abs(r['d_psnr']) <= tolerance
+        print(f"{r['precision']:<16}{r['psnr']:>9.3f}{r['d_psnr']:>9.3f}{r['ssim']:>9.4f}"
+              f"{r['weights_bytes'] / 2 ** 20:>12.1f}{r[memory_key] / 2 ** 20:>11.1f}{r['latency_ms']:>9.1f}"
+              f"  {'yes' if r['passed'] else 'NO'}")
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'tolerance': tolerance, 'memory': memory_key, 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(2000)
+    parser = add_config_arguments(argparse.ArgumentParser(), 'configs/config_psnr.yaml')
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=['mixed_float16', 'mixed_bfloat16'])
+    parser.add_argument('--tolerance', type=float, default=0.05, help='max PSNR difference to float32 in dB')
+    parser.add_argument('--latency_size', type=int, default=64)
+    parser.add_argument('--latency_steps', type=int, default=10)
+    parser.add_argument('--json', default='')
+    parser.add_argument('--precision', choices=PRECISIONS, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.precision:
+        # child process of validate_precision
+        result = measure_precision(load_config(args.config, args.override), args.precision,
+                                   args.latency_size, args.latency_steps)
+        print(json.dumps(result))
+    else:
+        results = validate_precision(args.precisions, args.tolerance, args.json)
+        sys.exit(0 if all(r['passed'] for r in results) else 1)